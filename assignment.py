@@ -0,0 +1,190 @@
+# \package assignment
+#
+#     \brief   Best overall pairing of packing slips with shipping labels.
+#
+#     Matching slips one at a time lets an early slip take a label that a later slip fits better. Here every
+#     candidate pair gets a score and the pairing with the highest total score is solved for at once, as a
+#     linear sum assignment. Only items that share a blocking key (reference number, ZIP and name prefix, ...)
+#     are compared, and every connected group of them is solved on its own, so thousands of pages stay cheap.
+#     A group too big for a dense score matrix is paired greedily over the pairs that share a key instead.
+#
+
+from collections import defaultdict
+from typing import Callable, Dict, Hashable, Iterable, List, Sequence, Set, Tuple
+
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment as _scipy_linear_sum_assignment
+except ImportError:
+    _scipy_linear_sum_assignment = None
+
+# Most items (left and right together) in a block that is solved as one assignment. A bigger block would need a
+# score matrix of up to (MAX_BLOCK_SIZE / 2)^2 entries.
+MAX_BLOCK_SIZE = 1000
+
+
+# Rows and columns of the minimum cost assignment of cost (rows x columns), like scipy.optimize.linear_sum_assignment.
+# Every row is assigned when there are at least as many columns as rows, otherwise every column is.
+def linear_sum_assignment(cost: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    cost = np.asarray(cost, dtype=float)
+    if cost.size == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    if _scipy_linear_sum_assignment is not None:
+        return _scipy_linear_sum_assignment(cost)
+
+    if cost.shape[0] > cost.shape[1]:
+        columns, rows = _shortest_augmenting_path(cost.T)
+        order = np.argsort(rows)
+        return rows[order], columns[order]
+    return _shortest_augmenting_path(cost)
+
+
+# Shortest augmenting path algorithm (Jonker-Volgenant, as described by Crouse, 2016) for rows <= columns.
+# Each row is added with one Dijkstra search over the columns, done with numpy a row at a time.
+def _shortest_augmenting_path(cost: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    row_count, column_count = cost.shape
+    u = np.zeros(row_count)
+    v = np.zeros(column_count)
+    column_of_row = np.full(row_count, -1)
+    row_of_column = np.full(column_count, -1)
+
+    for current_row in range(row_count):
+        shortest = np.full(column_count, np.inf)
+        path = np.full(column_count, -1)
+        unscanned = np.ones(column_count, dtype=bool)
+        scanned_rows = np.zeros(row_count, dtype=bool)
+
+        min_value = 0.0
+        row = current_row
+        sink = -1
+        while sink == -1:
+            scanned_rows[row] = True
+            reduced = min_value + cost[row] - u[row] - v
+            improved = unscanned & (reduced < shortest)
+            path[improved] = row
+            shortest[improved] = reduced[improved]
+
+            candidates = np.flatnonzero(unscanned)
+            lowest = shortest[candidates].min()
+            if not np.isfinite(lowest):
+                raise ValueError("cost matrix is infeasible")
+            tied = candidates[shortest[candidates] == lowest]
+            # Ending the search on a free column is always at least as good as going on
+            free = tied[row_of_column[tied] == -1]
+            column = free[0] if len(free) else tied[0]
+
+            min_value = lowest
+            unscanned[column] = False
+            if row_of_column[column] == -1:
+                sink = column
+            else:
+                row = row_of_column[column]
+
+        # Update the dual variables
+        u[current_row] += min_value
+        other_rows = scanned_rows.copy()
+        other_rows[current_row] = False
+        u[other_rows] += min_value - shortest[column_of_row[other_rows]]
+        scanned = ~unscanned
+        v[scanned] -= min_value - shortest[scanned]
+
+        # Flip the assignments along the augmenting path
+        column = sink
+        while True:
+            row = path[column]
+            row_of_column[column] = row
+            column_of_row[row], column = column, column_of_row[row]
+            if row == current_row:
+                break
+
+    return np.arange(row_count), column_of_row
+
+
+# Pairs (left index, right index) with the highest total score. score is left x right, pairs scoring
+# below min_score are never made, so some items can stay unpaired.
+def best_pairs(score: np.ndarray, min_score: float = 0.0) -> List[Tuple[int, int]]:
+    score = np.asarray(score, dtype=float)
+    allowed = score >= min_score
+    # A disallowed pair costs nothing, so pairing two items is only worth it when they score
+    cost = np.where(allowed, -score, 0.0)
+    rows, columns = linear_sum_assignment(cost)
+    return [(int(row), int(column)) for row, column in zip(rows, columns) if allowed[row, column]]
+
+
+# Groups of (left indices, right indices) connected through shared blocking keys. Two items can only be
+# paired when they are in the same group, so every group can be solved on its own.
+def blocks(left_keys: Sequence[Iterable[Hashable]],
+           right_keys: Sequence[Iterable[Hashable]]) -> List[Tuple[List[int], List[int]]]:
+    parent = list(range(len(left_keys) + len(right_keys)))
+
+    def find(node: int) -> int:
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    first_with_key: Dict[Hashable, int] = {}
+    for node, keys in enumerate(list(left_keys) + list(right_keys)):
+        for key in keys:
+            if key in first_with_key:
+                parent[find(node)] = find(first_with_key[key])
+            else:
+                first_with_key[key] = node
+
+    groups: Dict[int, Tuple[List[int], List[int]]] = {}
+    for i in range(len(left_keys)):
+        groups.setdefault(find(i), ([], []))[0].append(i)
+    for j in range(len(right_keys)):
+        groups.setdefault(find(len(left_keys) + j), ([], []))[1].append(j)
+    return [group for group in groups.values() if group[0] and group[1]]
+
+
+# The highest scoring pairing of left with right items. score_block(left indices, right indices) returns the
+# score matrix of one block. Only pairs that share a key are made. Blocks of more than max_block_size items are
+# paired greedily instead, see greedy_pairs. Returns the right index paired with every left item, -1 for unpaired ones.
+def assign(left_keys: Sequence[Iterable[Hashable]], right_keys: Sequence[Iterable[Hashable]],
+           score_block: Callable[[List[int], List[int]], np.ndarray], min_score: float = 0.0,
+           max_block_size: int = MAX_BLOCK_SIZE) -> List[int]:
+    left_keys = [set(keys) for keys in left_keys]
+    right_keys = [set(keys) for keys in right_keys]
+    pairing = [-1] * len(left_keys)
+    for left, right in blocks(left_keys, right_keys):
+        if len(left) + len(right) > max_block_size:
+            pairs = greedy_pairs(left, right, left_keys, right_keys, score_block, min_score)
+        else:
+            score = np.array(score_block(left, right), dtype=float)
+            shared = np.array([[not left_keys[i].isdisjoint(right_keys[j]) for j in right] for i in left], dtype=bool)
+            score[~shared] = min_score - 1
+            pairs = best_pairs(score, min_score)
+        for row, column in pairs:
+            pairing[left[row]] = right[column]
+    return pairing
+
+
+# Pairs (row in left, column in right) of one block, taking the highest scoring pair that is still free first.
+# Only pairs that share a key are scored, one left item at a time, so memory stays linear in the candidates.
+def greedy_pairs(left: List[int], right: List[int], left_keys: Sequence[Set[Hashable]],
+                 right_keys: Sequence[Set[Hashable]], score_block: Callable[[List[int], List[int]], np.ndarray],
+                 min_score: float = 0.0) -> List[Tuple[int, int]]:
+    columns_with_key: Dict[Hashable, List[int]] = defaultdict(list)
+    for column, j in enumerate(right):
+        for key in right_keys[j]:
+            columns_with_key[key].append(column)
+
+    candidates = []
+    for row, i in enumerate(left):
+        columns = sorted({column for key in left_keys[i] for column in columns_with_key.get(key, ())})
+        if not columns:
+            continue
+        scores = np.asarray(score_block([i], [right[column] for column in columns]), dtype=float)[0]
+        candidates.extend((-score, row, column) for score, column in zip(scores, columns) if score >= min_score)
+
+    pairs = []
+    used_rows, used_columns = set(), set()
+    for _, row, column in sorted(candidates):
+        if row not in used_rows and column not in used_columns:
+            used_rows.add(row)
+            used_columns.add(column)
+            pairs.append((row, column))
+    return pairs
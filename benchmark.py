@@ -0,0 +1,384 @@
+# \package benchmark
+#
+#     \brief   Times the label sorting pipelines over the bundled samples and compares runs.
+#
+#     `run` sorts every sample batch (a pick list and the label pdf numbered right after it) with the delivery
+#     sort_slips pipeline, at its own size and with its pages repeated to 10x and 100x the size. Packing slip
+#     batches for pdf_combo_new's processAndSortPackingSlips are not bundled; pass them with --combo. Every case
+#     runs in a fresh process, so peak RSS is that case's alone. Wall time per stage, peak RSS, pages/sec and
+#     match rate go to a JSON results file. `compare` lines up two results files and flags regressions.
+#     --synthetic adds batches of any size made by synthetic_batch, which also score how many labels were sorted
+#     to the pick list row they belong to.
+#
+#     python benchmark.py run -o before.json
+#     python benchmark.py run -o after.json --pipeline
+#     python benchmark.py compare before.json after.json
+#
+
+import argparse
+import builtins
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from PyPDF2 import PdfReader
+
+import pdf_output
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is left out there
+    resource = None
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# (pick list, labels) of the bundled samples
+SAMPLE_BATCHES = [("1.pdf", "2.pdf"), ("3.pdf", "4.pdf"), ("5.pdf", "6.pdf"), ("11.pdf", "12.pdf")]
+DEFAULT_SCALES = (1, 10, 100)
+# Relative change past which compare reports a case as slower or bigger
+DEFAULT_TOLERANCE = 0.10
+RESULTS_FORMAT = 1
+
+
+# Adds the time spent in calls to module.name to stage_times[stage], for as long as the context is open
+@contextlib.contextmanager
+def timed(module, name: str, stage: str, stage_times: Dict[str, float]):
+    function = getattr(module, name)
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stage_times[stage] += time.perf_counter() - start
+
+    setattr(module, name, wrapper)
+    try:
+        yield
+    finally:
+        setattr(module, name, function)
+
+
+@contextlib.contextmanager
+def timed_stage(stage: str, stage_times: Dict[str, float]):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_times[stage] += time.perf_counter() - start
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    # The OCR and render work happens in worker processes and subprocesses, count the biggest of them too
+    peaks = [resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss]
+    # kilobytes on Linux, bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return max(peaks) * unit / (1 << 20)
+
+
+def page_count(pdf_path: str) -> int:
+    return len(PdfReader(pdf_path).pages)
+
+
+# Write the pages of pdf_path repeated scale times to output_path. The copies share their streams,
+# so the file stays about the size of the original while every page still has to be read again.
+def scale_pdf(pdf_path: str, scale: int, output_path: str) -> None:
+    reader = PdfReader(pdf_path)
+    pdf_output.write_pages(reader, list(range(len(reader.pages))) * scale, output_path)
+
+
+def run_delivery_case(spec: dict) -> dict:
+    import delivery_08_29 as delivery
+
+    options = delivery.LabelOptions(workers=spec["workers"], pipeline=spec["pipeline"],
+                                    ocr_backend=spec["ocr_backend"],
+                                    cache_path=delivery.ocr_cache.DEFAULT_CACHE_PATH if spec["cache"] else None)
+    stage_times = defaultdict(float)
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(timed(delivery, "read_pick_list", "pick_list", stage_times))
+        stack.enter_context(timed(delivery, "read_conversion", "conversion", stage_times))
+        stack.enter_context(timed(delivery, "parse_label_pdf", "labels", stage_times))
+        stack.enter_context(timed(delivery, "read_labels_pipelined", "labels", stage_times))
+        stack.enter_context(timed(delivery, "match_label", "match", stage_times))
+        # With the pipeline, matching runs alongside reading the labels and its time overlaps the labels stage
+        labels = delivery.sort_slips(spec["pick_list"], spec["labels"], spec["conversion"], options)
+        with timed_stage("write", stage_times):
+            delivery.write_pdf(labels, spec["labels"], os.path.join(spec["work_dir"], "sorted.pdf"))
+    wall_time = time.perf_counter() - start
+
+    matched = sum(1 for label in labels if label.pick_list_rank < delivery.MAX_LABEL_NUMBER)
+    result = {"wall_time": wall_time, "stages": dict(stage_times), "items": len(labels), "matched": matched}
+    if spec.get("ground_truth"):
+        import synthetic_batch
+
+        result["accuracy"] = synthetic_batch.score_labels(labels, synthetic_batch.load_ground_truth(spec["ground_truth"]))
+    return result
+
+
+def run_combo_case(spec: dict) -> dict:
+    import pdf_combo_new as combo
+
+    # The run can't stop for questions. Labels without a name are left blank, as when a user skips them.
+    builtins.input = lambda prompt="": "n"
+    combo.ocr_backend.set_backend(spec["ocr_backend"])
+    combo.ocr_cache.configure(combo.ocr_cache.DEFAULT_CACHE_PATH if spec["cache"] else None)
+    mode = combo.get_mode(spec["slips"], spec["labels"])
+
+    stage_times = defaultdict(float)
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(timed(combo, "processPackingSlips", "slips", stage_times))
+        stack.enter_context(timed(combo, "parseShippingLabel", "labels", stage_times))
+        stack.enter_context(timed(combo, "belk_sort", "labels", stage_times))
+        stack.enter_context(timed(combo, "bedbath_sort", "labels", stage_times))
+        with timed_stage("sort", stage_times):
+            ordered, no_match = combo.processAndSortPackingSlips(mode, spec["match_mode"], spec["pipeline"])
+        # What the sort spent outside reading slips and labels is matching
+        stage_times["match"] = stage_times.pop("sort") - stage_times["slips"] - stage_times["labels"]
+        if spec["pipeline"]:
+            # Slips are read while the labels are, only the labels add to the wall time
+            stage_times["match"] += stage_times["slips"]
+        with timed_stage("write", stage_times):
+            reader = PdfReader(spec["slips"])
+            pdf_output.write_pages(reader, [slip.page for slip in ordered], os.path.join(spec["work_dir"], "sorted.pdf"))
+            pdf_output.write_pages(reader, [slip.page for slip in no_match], os.path.join(spec["work_dir"], "no_match.pdf"))
+    wall_time = time.perf_counter() - start
+
+    return {"wall_time": wall_time, "stages": dict(stage_times), "items": len(ordered) + len(no_match),
+            "matched": len(ordered)}
+
+
+CASE_RUNNERS = {"delivery": run_delivery_case, "combo": run_combo_case}
+
+
+# Run one case in this process and write its measurements to result_path
+def run_case(spec: dict, result_path: str) -> None:
+    result = CASE_RUNNERS[spec["pipeline_name"]](spec)
+    result["peak_rss_mb"] = peak_rss_mb()
+    with open(result_path, "w") as f:
+        json.dump(result, f)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Run spec in a fresh python process and return its result, with the error instead when it failed
+def _run_isolated(spec: dict) -> dict:
+    with tempfile.TemporaryDirectory() as work_dir:
+        spec = dict(spec, work_dir=work_dir)
+        result_path = os.path.join(work_dir, "result.json")
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), "case", json.dumps(spec), result_path],
+                                 cwd=REPO_DIR, stdin=subprocess.DEVNULL)
+        if process.returncode != 0 or not os.path.exists(result_path):
+            return {"error": f"exited with code {process.returncode}"}
+        with open(result_path) as f:
+            return json.load(f)
+
+
+def _case_record(name: str, spec: dict, pages: int, result: dict) -> dict:
+    record = {"name": name, "pipeline": spec["pipeline_name"], "scale": spec["scale"], "pages": pages}
+    if "error" in result:
+        record["error"] = result["error"]
+        return record
+    record.update({
+        "wall_time": result["wall_time"],
+        "stages": result["stages"],
+        "peak_rss_mb": result["peak_rss_mb"],
+        "pages_per_sec": pages / result["wall_time"] if result["wall_time"] > 0 else None,
+        "match_rate": result["matched"] / result["items"] if result["items"] else None,
+        "accuracy": result.get("accuracy"),
+    })
+    return record
+
+
+def run(args) -> None:
+    common = {"workers": args.workers, "pipeline": args.pipeline, "ocr_backend": args.ocrBackend,
+              "cache": args.cache, "match_mode": args.matchMode}
+    batches: List[Tuple[str, str, str, Optional[str]]] = [("delivery", pick_list, labels, None) for pick_list, labels
+                                                          in (args.batch or SAMPLE_BATCHES)]
+    batches += [("combo", slips, labels, None) for slips, labels in (args.combo or [])]
+
+    cases = []
+    with tempfile.TemporaryDirectory() as scaled_dir:
+        for count in args.synthetic or []:
+            import synthetic_batch
+
+            print(f"Generating a synthetic batch of {count} labels")
+            paths = synthetic_batch.generate_batch(os.path.join(scaled_dir, f"synthetic{count}"), count,
+                                                   seed=args.seed, noise=args.noise,
+                                                   conversion_file_path=os.path.join(REPO_DIR, args.conversion))
+            batches.append(("delivery", paths["pick_list"], paths["labels"], paths["ground_truth"]))
+
+        for pipeline_name, first_path, labels_path, ground_truth in batches:
+            first_path, labels_path = (os.path.join(REPO_DIR, path) for path in (first_path, labels_path))
+            # Synthetic batches are made at the size they are wanted
+            for scale in args.scales if ground_truth is None else [1]:
+                name = f"{pipeline_name} {os.path.basename(first_path)}+{os.path.basename(labels_path)} x{scale}"
+                if ground_truth is not None:
+                    name = f"{pipeline_name} synthetic {page_count(labels_path)} noise {args.noise:g}"
+                scaled = {}
+                for key, path in (("first", first_path), ("labels", labels_path)):
+                    if scale == 1:
+                        scaled[key] = path
+                    else:
+                        scaled[key] = os.path.join(scaled_dir, f"x{scale}_{os.path.basename(path)}")
+                        if not os.path.exists(scaled[key]):
+                            scale_pdf(path, scale, scaled[key])
+                if pipeline_name == "delivery":
+                    spec = dict(common, pick_list=scaled["first"], labels=scaled["labels"],
+                                conversion=os.path.join(REPO_DIR, args.conversion), ground_truth=ground_truth)
+                else:
+                    # Packing slips are matched by page position, so they keep the name the store is detected from
+                    spec = dict(common, slips=scaled["first"], labels=scaled["labels"])
+                spec.update(pipeline_name=pipeline_name, scale=scale)
+
+                print(f"Running {name}")
+                record = _case_record(name, spec, page_count(scaled["labels"]), _run_isolated(spec))
+                cases.append(record)
+                if "error" in record:
+                    print(f"  failed: {record['error']}")
+                else:
+                    print(f"  {record['wall_time']:.1f}s, {record['pages_per_sec']:.1f} pages/s, "
+                          f"match rate {record['match_rate']:.1%}"
+                          + ("" if record["accuracy"] is None else f", accuracy {record['accuracy']:.1%}"))
+
+    results = {
+        "format": RESULTS_FORMAT,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "options": common,
+        "cases": cases,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+def _change(old: Optional[float], new: Optional[float]) -> Optional[float]:
+    if old is None or new is None or old == 0:
+        return None
+    return (new - old) / old
+
+
+def _format_change(change: Optional[float]) -> str:
+    return "" if change is None else f"{change:+.0%}"
+
+
+# Printable comparison of two results files, and whether any case regressed
+def compare_results(old: dict, new: dict, tolerance: float = DEFAULT_TOLERANCE) -> Tuple[str, bool]:
+    old_cases = {case["name"]: case for case in old["cases"]}
+    lines = [f"{'case':<36}{'wall time':>25}{'pages/s':>10}{'peak RSS':>20}{'match rate':>17}"]
+    regressed = False
+    for case in new["cases"]:
+        before = old_cases.get(case["name"])
+        if before is None:
+            lines.append(f"{case['name']:<36}  only in the new results")
+            continue
+        if "error" in case or "error" in before:
+            lines.append(f"{case['name']:<36}  failed: {case.get('error') or before.get('error')}")
+            regressed = regressed or "error" in case
+            continue
+
+        wall_change = _change(before["wall_time"], case["wall_time"])
+        rss_change = _change(before["peak_rss_mb"], case["peak_rss_mb"])
+        flags = []
+        if wall_change is not None and wall_change > tolerance:
+            flags.append("SLOWER")
+        if rss_change is not None and rss_change > tolerance:
+            flags.append("MORE MEMORY")
+        if (case["match_rate"] or 0) < (before["match_rate"] or 0):
+            flags.append("FEWER MATCHES")
+        if (case.get("accuracy") or 0) < (before.get("accuracy") or 0):
+            flags.append("LESS ACCURATE")
+        regressed = regressed or bool(flags)
+
+        rss = "" if case["peak_rss_mb"] is None else f"{case['peak_rss_mb']:.0f}MB {_format_change(rss_change)}"
+        lines.append(f"{case['name']:<36}"
+                     f"{before['wall_time']:>8.1f}s ->{case['wall_time']:>6.1f}s {_format_change(wall_change):>5}"
+                     f"{case['pages_per_sec']:>10.1f}{rss:>20}"
+                     f"{before['match_rate'] or 0:>8.1%} ->{case['match_rate'] or 0:>6.1%}"
+                     f"  {' '.join(flags)}")
+
+        for stage, seconds in case["stages"].items():
+            stage_change = _change(before["stages"].get(stage), seconds)
+            lines.append(f"    {stage:<32}{before['stages'].get(stage, 0):>8.1f}s ->{seconds:>6.1f}s "
+                         f"{_format_change(stage_change):>5}")
+    return "\n".join(lines), regressed
+
+
+def compare(args) -> None:
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    report, regressed = compare_results(old, new, args.tolerance)
+    print(report)
+    if regressed:
+        sys.exit(1)
+
+
+def Main():
+    parser = argparse.ArgumentParser(description='Benchmark the label sorting pipelines and compare results.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Run the benchmark and write a results file')
+    run_parser.add_argument('-o', dest='output', default='benchmark_results.json', help='Results file to write')
+    run_parser.add_argument('--scales', type=int, nargs='+', default=list(DEFAULT_SCALES),
+                            help='Sizes to run every batch at, as multiples of its pages')
+    run_parser.add_argument('--batch', nargs=2, action='append', metavar=('PICKLIST', 'LABELS'),
+                            help='Delivery batch to run instead of the bundled samples, can be repeated')
+    run_parser.add_argument('--combo', nargs=2, action='append', metavar=('SLIPS', 'LABELS'),
+                            help='Packing slips and labels to run through pdf_combo_new, can be repeated. '
+                                 'The store is detected from the slips file name')
+    run_parser.add_argument('-c', dest='conversion', default='Conversion File.xlsx', help='UPC conversion file')
+    run_parser.add_argument('-j', type=int, default=os.cpu_count() or 1, dest='workers',
+                            help='Number of processes reading labels in parallel')
+    run_parser.add_argument('--pipeline', action='store_true', help='Run the pipelined label readers')
+    run_parser.add_argument('--ocr-backend', default='auto', dest='ocrBackend', help='OCR engine')
+    run_parser.add_argument('--match-mode', default='greedy', dest='matchMode', help='pdf_combo_new match mode')
+    run_parser.add_argument('--cache', action='store_true',
+                            help='Use the OCR result cache. Off by default, so every run does the full work')
+    run_parser.add_argument('--synthetic', type=int, nargs='+', metavar='LABELS',
+                            help='Also run synthetic batches of these numbers of labels, scored against their answers')
+    run_parser.add_argument('--noise', type=float, default=0.0, help='OCR confusion rate of the synthetic labels')
+    run_parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic batches')
+
+    compare_parser = commands.add_parser('compare', help='Compare two results files')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                                help='Relative slow down or memory growth reported as a regression')
+
+    case_parser = commands.add_parser('case', help=argparse.SUPPRESS)
+    case_parser.add_argument('spec')
+    case_parser.add_argument('result_path')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'compare':
+        compare(args)
+    else:
+        run_case(json.loads(args.spec), args.result_path)
+
+
+if __name__ == "__main__":
+    Main()
@@ -1,23 +1,60 @@
 import argparse
+import functools
+import hashlib
 import os
+import pickle
+import subprocess
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from typing import List, Dict, Tuple
+from typing import Callable, Iterable, List, Dict, Optional, Set, Tuple
 
+import numpy as np
 import pdf2image
+import pdfplumber
 import pytesseract
-import tabula
 from PIL import Image
-# from PyPDF2 import PdfWriter, PdfReader
-from PyPDF2 import PdfFileWriter, PdfFileReader
+from PyPDF2 import PdfReader
 from collections import defaultdict
 import re
-import pandas as pd
 from tqdm import tqdm
-from PIL import ImageEnhance, ImageFilter
+from rapidfuzz.distance import Levenshtein
+
+import metrics
+import ocr_backend
+import ocr_cache
+import page_text
+import pdf_output
+import profiling
+from pipeline import Pipeline, Stage
 
 # Arbitrarily large integer for sorting rank
 MAX_LABEL_NUMBER = 1000000
 DEFAULT_CONVERSION_FILE = 'Conversion File.xlsx'
+# Compiled conversion lookup, stored next to the conversion file
+CONVERSION_CACHE_SUFFIX = '.cache'
+# Bump when the compiled conversion format changes
+CONVERSION_CACHE_VERSION = 1
+# "native" reads the pick list with pdfplumber and only starts tabula's JVM for layouts it does not recognize
+PICK_LIST_PARSERS = ("native", "tabula")
+# Vertical distance within which words of the Item # column are on the same row, in pdf points
+PICK_LIST_ROW_TOLERANCE = 2
+# Resolution the reference number coordinates below are measured at
+LABEL_DPI = 500
+# Number of label pages rasterized per poppler call. Only one window of page images is held in memory at a time.
+DEFAULT_PAGE_WINDOW = 10
+# Largest edit distance at which an unmatched label is still resolved to the closest known SKU.
+# Off unless asked for (--max-distance), so a misread label is never moved silently.
+DEFAULT_MAX_DISTANCE = 0
+# Shorter references are too ambiguous to resolve approximately
+MIN_APPROXIMATE_LENGTH = 4
+# Strips of a LABEL_DPI page that hold the reference number, (left, top, right, bottom)
+USPS_REF_COORDS = (0, 2033, 1437, 2100)
+UPS_REF_COORDS = (0, 380, 1437, 500)
+REF_OCR_CONFIG = '''-c tessedit_char_whitelist="Trx Ref No.: 1234567890ABCDEFGHIJKLMNOPQRSTUVWXYZ-" --dpi {dpi} --psm 6'''
+# Bump whenever the padding or preprocess_image changes, so OCR text cached from the old images is not reused
+PREPROCESS_VERSION = 1
 
 # poppler_path = "C:/Users/Administrator/Downloads/Release-24.07.0-0/poppler-24.07.0/Library/bin/"
 # pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
@@ -28,6 +65,32 @@ class ShippingLabel:
     pick_list_rank: int
     upc_ref: str
 
+@dataclass
+class LabelOptions:
+    page_window: int = DEFAULT_PAGE_WINDOW
+    # Render only the reference number strips instead of whole pages
+    region_only: bool = True
+    # Number of OCR worker processes. Each one renders and reads whole page windows on its own.
+    # 1 reads them in this process, the pool is only started when asked for.
+    workers: int = 1
+    # OCR engine, one of ocr_backend.BACKENDS or "auto"
+    ocr_backend: str = ocr_backend.DEFAULT_BACKEND
+    # OCR result cache file, None to always run tesseract
+    cache_path: str = ocr_cache.DEFAULT_CACHE_PATH
+    # Read the reference number from the pdf's own text when the label has one, before falling back to OCR
+    text_layer: bool = True
+    # Number of reference strips stacked into one tesseract call, 1 to OCR every strip on its own
+    batch_size: int = 1
+    # Read labels at this lower dpi first and only re-render the ones whose result is not a known SKU at LABEL_DPI.
+    # 0 always reads at LABEL_DPI.
+    adaptive_dpi: int = 0
+    # Edit distance for resolving OCR misreads to the closest known SKU, 0 for exact matches only
+    max_distance: int = DEFAULT_MAX_DISTANCE
+    # How the pick list is read, one of PICK_LIST_PARSERS
+    pick_list_parser: str = "native"
+    # Render, OCR and match different windows at the same time on threads, instead of whole windows per process
+    pipeline: bool = False
+
 # Character replacement for pseudo fuzzy matching to counteract OCR failures
 fuzzy_replacements = {
     r'[OQ]': '0',
@@ -39,12 +102,34 @@ fuzzy_replacements = {
     r'B00': 'B0',
 }
 
+# fuzzy_replacements compiled for fuzz(). The single character rules ('[...]') collapse into one translation
+# table. Every codepoint up to U+3000 is run through them, which covers all characters \s matches.
+# The remaining rules run in a single regex pass together with the 'II+' -> 'I' clean up. This gives the
+# same result as applying each rule in turn, because the translated characters are never touched by a
+# later single character rule and the multi character rules match disjoint letters.
+_single_char_rules = [(re.compile(k), v) for k, v in fuzzy_replacements.items() if re.fullmatch(r'\[[^\]]+\]', k)]
+_fuzz_translation = {}
+for _codepoint in range(0x3001):
+    _translated = chr(_codepoint)
+    for _pattern, _replacement in _single_char_rules:
+        _translated = _pattern.sub(_replacement, _translated)
+    if _translated != chr(_codepoint):
+        _fuzz_translation[_codepoint] = _translated
+
+_multi_char_rules = [(k, v) for k, v in fuzzy_replacements.items() if not re.fullmatch(r'\[[^\]]+\]', k)]
+_multi_char_rules.append((r'II+', 'I'))
+_fuzz_pattern = re.compile('|'.join(f'(?P<rule{n}>{k})' for n, (k, _) in enumerate(_multi_char_rules)))
+
 
+def _fuzz_rule_replacement(match) -> str:
+    return _multi_char_rules[int(match.lastgroup[len('rule'):])][1]
+
+
+# The same SKUs come through here over and over (pick list rows, conversion entries, every label)
+@metrics.timed("fuzz")
+@functools.lru_cache(maxsize=65536)
 def fuzz(text):
-    # Remove consecutive 'I's
-    for k, v in fuzzy_replacements.items():
-        text = re.sub(k, v, text)
-    text = re.sub(r'II+', 'I', text)
+    text = _fuzz_pattern.sub(_fuzz_rule_replacement, text.translate(_fuzz_translation))
     if text.endswith("I"):
         text = text[:-1] + "L"
 
@@ -54,108 +139,729 @@ def fuzz(text):
 
     return text
 
+# Compare/swap pairs of a 9 element sorting network that leaves the median in position 4
+_MEDIAN9_NETWORK = ((1, 2), (4, 5), (7, 8), (0, 1), (3, 4), (6, 7), (1, 2), (4, 5), (7, 8),
+                    (0, 3), (5, 8), (4, 7), (3, 6), (1, 4), (2, 5), (4, 7), (4, 2), (6, 4), (4, 2))
+
+# Grayscale contrast x3 followed by a 3x3 median filter, on an (H, W) array or an (N, H, W) stack of crops.
+# Gives exactly the pixels of ImageEnhance.Contrast(image).enhance(3).filter(ImageFilter.MedianFilter()).
+def preprocess_pixels(pixels: np.ndarray) -> np.ndarray:
+    pixels = pixels.astype(np.int16)
+
+    # Contrast blends every pixel away from the (rounded) mean grey of its own image
+    mean = np.floor(pixels.mean(axis=(-2, -1), keepdims=True) + 0.5).astype(np.int16)
+    pixels = np.clip(mean + 3 * (pixels - mean), 0, 255).astype(np.uint8)
+
+    # The median filter repeats the edge pixels past the border, like PIL does
+    height, width = pixels.shape[-2:]
+    edged = np.pad(pixels, [(0, 0)] * (pixels.ndim - 2) + [(1, 1), (1, 1)], mode='edge')
+    neighbours = [edged[..., dy:dy + height, dx:dx + width] for dy in range(3) for dx in range(3)]
+    for a, b in _MEDIAN9_NETWORK:
+        neighbours[a], neighbours[b] = np.minimum(neighbours[a], neighbours[b]), np.maximum(neighbours[a], neighbours[b])
+    return neighbours[4]
+
 def preprocess_image(image: Image) -> Image:
-    image = image.convert('L')
-    enhancer = ImageEnhance.Contrast(image)
-    image = enhancer.enhance(3)
-    image = image.filter(ImageFilter.MedianFilter())
-    return image
+    return Image.fromarray(preprocess_pixels(np.asarray(image.convert('L'))))
+
+# Approximate lookup of a misread reference among the known SKUs.
+# Each SKU is cut into max_distance + 1 segments and indexed by them. A SKU within max_distance edits of the
+# query must have at least one segment that the edits did not touch, and that segment shows up in the query
+# shifted by at most max_distance. So a lookup only gathers the SKUs sharing such a segment and computes
+# the real edit distance for those few, instead of scanning every SKU.
+class SkuMatcher:
+    def __init__(self, skus: Iterable[str], max_distance: int = DEFAULT_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self._by_length: Dict[int, List[str]] = defaultdict(list)
+        self._segments: Dict[Tuple[int, int, str], List[str]] = defaultdict(list)
+        if max_distance <= 0:
+            return
+        for sku in sorted(set(skus)):
+            self._by_length[len(sku)].append(sku)
+            for n, (start, end) in enumerate(self._segment_bounds(len(sku))):
+                self._segments[(len(sku), n, sku[start:end])].append(sku)
+
+    def _segment_bounds(self, length: int) -> List[Tuple[int, int]]:
+        size = length // (self.max_distance + 1)
+        bounds = [(n * size, (n + 1) * size) for n in range(self.max_distance + 1)]
+        bounds[-1] = (bounds[-1][0], length)
+        return bounds
+
+    def _candidates(self, text: str) -> Set[str]:
+        candidates = set()
+        for length in range(len(text) - self.max_distance, len(text) + self.max_distance + 1):
+            if length not in self._by_length:
+                continue
+            if length // (self.max_distance + 1) == 0:
+                # Segments would be empty, too short to index
+                candidates.update(self._by_length[length])
+                continue
+            for n, (start, end) in enumerate(self._segment_bounds(length)):
+                for shift in range(-self.max_distance, self.max_distance + 1):
+                    if 0 <= start + shift and end + shift <= len(text):
+                        candidates.update(self._segments.get((length, n, text[start + shift:end + shift]), ()))
+        return candidates
+
+    # The single closest SKU within max_distance, or None when there is none or two are equally close
+    def match(self, text: str) -> Optional[str]:
+        if self.max_distance <= 0 or len(text) < MIN_APPROXIMATE_LENGTH:
+            return None
+
+        best, best_distance, tied = None, self.max_distance + 1, False
+        for sku in sorted(self._candidates(text)):
+            distance = Levenshtein.distance(text, sku, score_cutoff=self.max_distance)
+            if distance < best_distance:
+                best, best_distance, tied = sku, distance, False
+            elif distance == best_distance:
+                tied = True
+        if best is None or tied:
+            return None
+        return best
 
 def get_packing_rank(upc_ref, packing_order):
     return packing_order[upc_ref]
 
-def sort_slips(pick_list_path, shipping_label_path, conversion_file_path) -> List[ShippingLabel]:
-    pick_list = tabula.read_pdf(pick_list_path, pages='all', area=(0, 0, 100000, 100000),
-                                pandas_options={"header": None})
-    
+def sort_slips(pick_list_path, shipping_label_path, conversion_file_path,
+               options: LabelOptions = None) -> List[ShippingLabel]:
+    options = options or LabelOptions()
+    # Pick list pages are cached next to the OCR results. The label workers open their own connection to the cache,
+    # so this one is closed again before they start.
+    with profiling.stage("pick_list"):
+        ocr_cache.configure(options.cache_path)
+        pick_list = read_pick_list(pick_list_path, options.pick_list_parser, options.workers)
+        ocr_cache.configure(None)
+        upc_lookup = read_conversion(conversion_file_path)
+
     packing_order = defaultdict(lambda: MAX_LABEL_NUMBER)
-    upc_lookup = read_conversion(conversion_file_path)
 
-    i = 0
-    for table in pick_list:
-        entries = [row for row in table.values if isinstance(row[0], str)]
-        for entry in entries:
-            fuzzed_entry = fuzz(entry[0])
-            packing_order[fuzzed_entry] = i
-            i += 1
+    for i, entry in enumerate(pick_list):
+        fuzzed_entry = fuzz(entry)
+        packing_order[fuzzed_entry] = i
+
+    # Every SKU a correctly read label can resolve to, used to decide which low resolution reads to trust
+    vocabulary = set(upc_lookup) | set(packing_order)
+
+    sku_matcher = SkuMatcher(vocabulary, options.max_distance)
+    match = functools.partial(match_label, upc_lookup=upc_lookup, packing_order=packing_order, sku_matcher=sku_matcher)
+    if options.pipeline:
+        # Labels are matched on the pipeline's match thread while the next ones are read
+        with profiling.stage("labels"):
+            slips = read_labels_pipelined(shipping_label_path, options, vocabulary, match)
+    else:
+        with profiling.stage("labels"):
+            slips = parse_label_pdf(shipping_label_path, options, vocabulary)
+        with profiling.stage("matching"):
+            for label in tqdm(slips, desc="Processing labels"):
+                match(label)
 
-    slips = parse_label_pdf(shipping_label_path)
+    # Sort all slips, unmatched ones will get the MAX_LABEL_NUMBER rank and go to the end
+    all_slips = sorted(slips, key=lambda label: (label.pick_list_rank, label.pdf_index))
+    return all_slips
 
-    unmatched_labels = []
-    for label in tqdm(slips, desc="Processing labels"):
-        fuzzed_ref = fuzz(label.upc_ref)
+# Resolve the reference read off a label to its SKU in the conversion file, and rank it by the pick list
+@metrics.timed("match")
+def match_label(label: ShippingLabel, upc_lookup: Dict[str, str], packing_order: Dict[str, int],
+                sku_matcher: SkuMatcher) -> ShippingLabel:
+    fuzzed_ref = fuzz(label.upc_ref)
+    if fuzzed_ref not in upc_lookup and fuzzed_ref not in packing_order:
+        # Try approximate match
+        with metrics.timer("approximate_match"):
+            closest = sku_matcher.match(fuzzed_ref)
+        if closest is not None:
+            print(f"Label {label.pdf_index + 1} read as {label.upc_ref}, matched to the closest SKU {closest}")
+            fuzzed_ref = label.upc_ref = closest
+            metrics.count("labels_approximate")
+
+    with metrics.timer("conversion_lookup"):
         if fuzzed_ref in upc_lookup:
             label.upc_ref = upc_lookup[fuzzed_ref]
-        else:
-            unmatched_labels.append(label)
-        
-        label.pick_list_rank = get_packing_rank(fuzz(label.upc_ref), packing_order)
+            metrics.count("labels_converted")
 
-    # Sort all slips, unmatched ones will get the MAX_LABEL_NUMBER rank and go to the end
-    all_slips = sorted(slips, key=lambda label: (label.pick_list_rank, label.pdf_index))
-    return all_slips
+    label.pick_list_rank = get_packing_rank(fuzz(label.upc_ref), packing_order)
+    metrics.count("labels_matched" if label.pick_list_rank < MAX_LABEL_NUMBER else "labels_unmatched")
+    return label
 
-# Read in the UPC conversion file
+# Read in the UPC conversion file.
+# The fuzzed lookup is compiled once into a pickle next to the workbook and reused until the workbook changes,
+# so a sort does not pay for pandas/openpyxl parsing the xlsx every time.
+@metrics.timed("conversion_load")
 def read_conversion(conversion_file_path) -> Dict[str, str]:
+    compiled_path = conversion_file_path + CONVERSION_CACHE_SUFFIX
+    stat = os.stat(conversion_file_path)
+    compiled = _load_compiled_conversion(compiled_path)
+    if compiled is not None and (compiled["mtime"], compiled["size"]) == (stat.st_mtime_ns, stat.st_size):
+        return compiled["lookup"]
+
+    # Touched but not edited (copied, re-saved without changes) still reuses the compiled lookup
+    with open(conversion_file_path, 'rb') as f:
+        source_hash = hashlib.sha1(f.read()).hexdigest()
+    if compiled is not None and compiled["sha1"] == source_hash:
+        lookup = compiled["lookup"]
+    else:
+        lookup = compile_conversion(conversion_file_path)
+
+    _save_compiled_conversion(compiled_path, {
+        "format": _conversion_cache_format(),
+        "mtime": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "sha1": source_hash,
+        "lookup": lookup,
+    })
+    return lookup
+
+def compile_conversion(conversion_file_path) -> Dict[str, str]:
+    # Only needed when the workbook has to be parsed again
+    import pandas as pd
+
     lookup = {}
     conversions = pd.read_excel(conversion_file_path)
     for conversion in conversions.values:
         lookup[fuzz(conversion[1].upper().strip())] = fuzz(conversion[0].upper().strip())
     return lookup
 
-# Parse the entire label pdf into a list of labels
-def parse_label_pdf(label_file_name: str) -> List[ShippingLabel]:
-    refs = []
-    page_images = pdf2image.convert_from_path(label_file_name, dpi=500, grayscale=True, thread_count=10)
-
-    for i, page in tqdm(enumerate(page_images), "Reading reference numbers...", total=len(page_images)):
-        ref_number = read_reference_number_usps(page)
-        if ref_number == "":
-            ref_number = read_reference_number_ups(page)
-        refs.append(ShippingLabel(i, MAX_LABEL_NUMBER, ref_number))
-    return refs
+# A compiled lookup is only valid for the fuzz rules it was built with
+def _conversion_cache_format() -> str:
+    return f"{CONVERSION_CACHE_VERSION} {fuzzy_replacements!r}"
+
+def _load_compiled_conversion(compiled_path: str) -> Optional[dict]:
+    try:
+        with open(compiled_path, 'rb') as f:
+            compiled = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+    if not isinstance(compiled, dict) or compiled.get("format") != _conversion_cache_format():
+        return None
+    return compiled
+
+def _save_compiled_conversion(compiled_path: str, compiled: dict) -> None:
+    # Write next to the target and swap it in, so an interrupted run never leaves half a file behind.
+    # A read-only folder just means the workbook is parsed every run.
+    try:
+        temp_path = compiled_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, compiled_path)
+    except OSError:
+        pass
+
+# SKUs of the pick list, in pick order
+@metrics.timed("pick_list")
+def read_pick_list(pick_list_path, parser: str = "native", workers: int = 1) -> List[str]:
+    if parser == "native":
+        entries = read_pick_list_native(pick_list_path, workers)
+        if entries is not None:
+            return entries
+        print(f"Pick list layout not recognized, reading {pick_list_path} with tabula")
+    return read_pick_list_tabula(pick_list_path)
+
+@metrics.timed("tabula")
+def read_pick_list_tabula(pick_list_path) -> List[str]:
+    # tabula starts a JVM, only pay for it when it is actually used
+    import tabula
 
-def read_reference_number(image: Image, coords: Tuple[int, int, int, int]) -> str:
-    cropped_image = image.crop(coords)
-    padded_image = Image.new(cropped_image.mode, (cropped_image.width, cropped_image.height + 200), 'white')
-    padded_image.paste(cropped_image, (0, 100))
+    pick_list = tabula.read_pdf(pick_list_path, pages='all', area=(0, 0, 100000, 100000),
+                                pandas_options={"header": None})
+    entries = []
+    for table in pick_list:
+        entries.extend(row[0] for row in table.values if isinstance(row[0], str))
+    return entries
+
+# ShipStation pick lists have an "Item # | Description | Warehouse Location | # Required" table. The item
+# column is everything left of the Description header, one SKU per row, and descriptions that wrap onto
+# more lines leave it empty. Returns None when the pdf has no such header, so the caller can fall back to tabula.
+def read_pick_list_native(pick_list_path, workers: int = 1) -> Optional[List[str]]:
+    entries = []
+    item_column_right = None
+    for words in page_text.page_words(pick_list_path, workers):
+        table_top = 0
+        header = _find_pick_list_header(words)
+        if header is not None:
+            table_top, item_column_right = header
+        if item_column_right is None:
+            # Still no table header, not a layout this reader knows
+            continue
+
+        item_words = [w for w in words if w["top"] > table_top and w["x0"] < item_column_right]
+        item_words.sort(key=lambda w: (w["top"], w["x0"]))
+        row, row_top = [], None
+        for word in item_words:
+            if row and word["top"] - row_top > PICK_LIST_ROW_TOLERANCE:
+                entries.append(" ".join(row))
+                row = []
+            if not row:
+                row_top = word["top"]
+            row.append(word["text"])
+        if row:
+            entries.append(" ".join(row))
+
+    if item_column_right is None:
+        return None
+    return entries
+
+# (bottom of the header row, left edge of the Description column) of the pick list table header on this page
+def _find_pick_list_header(words) -> Optional[Tuple[float, float]]:
+    for i, word in enumerate(words[:-1]):
+        if word["text"] == "Item" and words[i + 1]["text"] == "#":
+            for other in words[i + 2:]:
+                if other["text"] == "Description" and abs(other["top"] - word["top"]) <= PICK_LIST_ROW_TOLERANCE:
+                    return max(word["bottom"], other["bottom"]), other["x0"]
+    return None
+
+def count_label_pages(label_file_name: str) -> int:
+    return pdf2image.pdfinfo_from_path(label_file_name)["Pages"]
+
+# Rasterize only the given regions of pages first_page..last_page (1-based, inclusive) straight from the pdf.
+# Returns {region: [image per page]}. Each region is rendered by one pdftoppm call using its crop options,
+# which produces the same pixels as cropping a full page rendered at the same dpi.
+@metrics.timed("rasterize")
+def render_label_regions(label_file_name: str, first_page: int, last_page: int,
+                         regions: List[Tuple[int, int, int, int]], dpi: int = LABEL_DPI) -> Dict[Tuple[int, int, int, int], List[Image.Image]]:
+    rendered = {}
+    with tempfile.TemporaryDirectory() as output_folder:
+        for n, (left, top, right, bottom) in enumerate(regions):
+            output_root = os.path.join(output_folder, f"region{n}")
+            subprocess.run(["pdftoppm", "-r", str(dpi), "-gray",
+                            "-f", str(first_page), "-l", str(last_page),
+                            "-x", str(left), "-y", str(top), "-W", str(right - left), "-H", str(bottom - top),
+                            label_file_name, output_root],
+                           check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            # pdftoppm zero pads the page numbers, so the names sort in page order
+            file_names = sorted(name for name in os.listdir(output_folder) if name.startswith(f"region{n}-"))
+            images = []
+            for file_name in file_names:
+                with Image.open(os.path.join(output_folder, file_name)) as image:
+                    images.append(image.copy())
+            rendered[(left, top, right, bottom)] = images
+    return rendered
+
+def _scale_coords(coords: Tuple[int, int, int, int], dpi: int) -> Tuple[int, int, int, int]:
+    return tuple(round(c * dpi / LABEL_DPI) for c in coords)
+
+def _ref_ocr_config(dpi: int) -> str:
+    return REF_OCR_CONFIG.format(dpi=dpi)
+
+def _ref_cache_key(page_digest: str, coords: Tuple[int, int, int, int], dpi: int = LABEL_DPI) -> str:
+    return ocr_cache.make_key(page_digest, _scale_coords(coords, dpi), _ref_ocr_config(dpi), PREPROCESS_VERSION)
+
+# The reference number of a page from the cache alone, or None if a strip it needs has not been read before
+def _cached_reference_number(cache: ocr_cache.OcrCache, keys: Dict[Tuple[int, int, int, int], str]) -> str:
+    for coords in (USPS_REF_COORDS, UPS_REF_COORDS):
+        text = cache.get(keys[coords])
+        if text is None:
+            return None
+        ref_number = clean_reference_text(text)
+        if ref_number != "":
+            return ref_number
+    return ""
+
+# Render both reference strips of the given pages (1-based) at dpi, as {strip coords: [image per page]}.
+# Consecutive pages are rendered together, so a sparse set of pages only costs one call per run.
+def _render_reference_strips(label_file_name: str, page_numbers: List[int], dpi: int,
+                             region_only: bool) -> Dict[Tuple[int, int, int, int], List[Image.Image]]:
+    strips = {USPS_REF_COORDS: [], UPS_REF_COORDS: []}
+    runs = []
+    for page_number in page_numbers:
+        if runs and runs[-1][1] == page_number - 1:
+            runs[-1][1] = page_number
+        else:
+            runs.append([page_number, page_number])
+    metrics.count("pages_rendered", len(page_numbers))
+
+    for first_page, last_page in runs:
+        if region_only:
+            regions = [_scale_coords(coords, dpi) for coords in strips]
+            rendered = render_label_regions(label_file_name, first_page, last_page, regions, dpi)
+            for coords, region in zip(strips, regions):
+                strips[coords].extend(rendered[region])
+        else:
+            with metrics.timer("rasterize"):
+                window = pdf2image.convert_from_path(label_file_name, dpi=dpi, grayscale=True,
+                                                     first_page=first_page, last_page=last_page,
+                                                     thread_count=min(10, last_page - first_page + 1))
+            with metrics.timer("crop"):
+                for coords in strips:
+                    strips[coords].extend(page.crop(_scale_coords(coords, dpi)) for page in window)
+            del window
+    return strips
+
+# Reference strips of some pages of a window, rendered at dpi and waiting for OCR
+@dataclass
+class RenderedStrips:
+    dpi: int
+    # Reference number of every page asked for, None for the pages still to be read from the strips
+    ref_numbers: List[Optional[str]]
+    # OCR cache key of every page's strips, by strip coords
+    keys: List[Dict[Tuple[int, int, int, int], str]]
+    # {strip coords: {page: image}} for the pages still to be read, pages being positions in ref_numbers
+    strips: Dict[Tuple[int, int, int, int], Dict[int, Image.Image]]
+
+# Answer the given pages (0-based offsets into the window) from the cache at dpi, and render the strips of the rest
+def _render_window_at_dpi(label_file_name: str, first_page: int, pages: List[int], digests: List[str],
+                          dpi: int, options: LabelOptions) -> RenderedStrips:
+    cache = ocr_cache.get_cache()
+    keys = [{} for _ in pages]
+    ref_numbers = [None] * len(pages)
+    if cache is not None:
+        keys = [{coords: _ref_cache_key(digests[page], coords, dpi) for coords in (USPS_REF_COORDS, UPS_REF_COORDS)}
+                for page in pages]
+        ref_numbers = [_cached_reference_number(cache, page_keys) for page_keys in keys]
+
+    pending = [i for i, ref_number in enumerate(ref_numbers) if ref_number is None]
+    strips = {USPS_REF_COORDS: {}, UPS_REF_COORDS: {}}
+    if pending:
+        rendered = _render_reference_strips(label_file_name, [first_page + pages[i] for i in pending], dpi,
+                                            options.region_only)
+        strips = {coords: dict(zip(pending, images)) for coords, images in rendered.items()}
+    return RenderedStrips(dpi, ref_numbers, keys, strips)
+
+# OCR the strips _render_window_at_dpi left to read
+def _ocr_window_strips(rendered: RenderedStrips, options: LabelOptions) -> List[str]:
+    ref_numbers = list(rendered.ref_numbers)
+    pending = [i for i, ref_number in enumerate(ref_numbers) if ref_number is None]
+
+    # USPS strip first, then the UPS strip for the pages where that came up empty
+    for coords in (USPS_REF_COORDS, UPS_REF_COORDS):
+        strips = rendered.strips[coords]
+        results = read_reference_strips([strips[i] for i in pending], [rendered.keys[i].get(coords) for i in pending],
+                                        options.batch_size, rendered.dpi)
+        for i, ref_number in zip(pending, results):
+            ref_numbers[i] = ref_number
+        pending = [i for i in pending if ref_numbers[i] == ""]
+    return ref_numbers
+
+# OCR the given pages (0-based offsets into the window) at dpi, using cached results where there are any
+def _read_window_at_dpi(label_file_name: str, first_page: int, pages: List[int], digests: List[str],
+                        dpi: int, options: LabelOptions) -> List[str]:
+    rendered = _render_window_at_dpi(label_file_name, first_page, pages, digests, dpi, options)
+    return _ocr_window_strips(rendered, options)
+
+# Read the reference number from the text layer of a vector label, looking in the same strips the OCR uses.
+# Returns None when the page has no usable text there, e.g. labels that are a single scanned image.
+def read_reference_text_layer(page) -> str:
+    if not page.chars:
+        return None
+
+    scale = 72 / LABEL_DPI
+    for coords in (USPS_REF_COORDS, UPS_REF_COORDS):
+        left, top, right, bottom = (c * scale for c in coords)
+
+        def in_strip(obj) -> bool:
+            return (obj.get("object_type") == "char"
+                    and left <= (obj["x0"] + obj["x1"]) / 2 <= right
+                    and top <= (obj["top"] + obj["bottom"]) / 2 <= bottom)
+
+        ref_number = clean_reference_text(page.filter(in_strip).extract_text().upper())
+        if ref_number != "":
+            return ref_number
+    return None
+
+# Read the reference numbers of pages first_page..last_page (1-based, inclusive).
+# Each page is answered from the first source that has it: the pdf text layer, the OCR cache, then OCR.
+# Only this window of pages is ever rasterized at once, and only the pages that still need OCR are rendered.
+# With options.adaptive_dpi, pages are first read at that resolution and only the ones that do not come out
+# as a word of vocabulary are read again at LABEL_DPI.
+def read_label_window(label_file_name: str, first_page: int, last_page: int, options: LabelOptions,
+                      vocabulary: Set[str] = None) -> List[str]:
+    ocr_backend.set_backend(options.ocr_backend)
+    ocr_cache.configure(options.cache_path)
+    return ocr_label_window(render_label_window(label_file_name, first_page, last_page, options, vocabulary),
+                            options, vocabulary)
+
+# A window of label pages read as far as it goes without OCR, see render_label_window
+@dataclass
+class LabelWindow:
+    label_file_name: str
+    first_page: int
+    last_page: int
+    # Reference number of every page of the window, None where it is still to be read
+    ref_numbers: List[Optional[str]]
+    digests: Optional[List[str]]
+    dpis: List[int]
+    # Strips rendered at dpis[0] for the pages still to be read, None when there are none
+    rendered: Optional[RenderedStrips] = None
+
+def _label_dpis(options: LabelOptions, vocabulary: Set[str] = None) -> List[int]:
+    if options.adaptive_dpi and vocabulary:
+        return [options.adaptive_dpi, LABEL_DPI]
+    return [LABEL_DPI]
+
+# The part of reading a window that needs no OCR: the text layer, the cache, and rendering the strips
+# of the remaining pages at the first dpi of the ladder. Uses the cache configured in this process.
+def render_label_window(label_file_name: str, first_page: int, last_page: int, options: LabelOptions,
+                        vocabulary: Set[str] = None) -> LabelWindow:
+    ref_numbers = [None] * (last_page - first_page + 1)
+    dpis = _label_dpis(options, vocabulary)
+    window = LabelWindow(label_file_name, first_page, last_page, ref_numbers, None, dpis)
+
+    if options.text_layer:
+        with metrics.timer("text_layer"), \
+                pdfplumber.open(label_file_name, pages=list(range(first_page, last_page + 1))) as pdf:
+            window.ref_numbers = [read_reference_text_layer(page) for page in pdf.pages]
+        metrics.count("labels_from_text_layer", len(window.ref_numbers) - window.ref_numbers.count(None))
+        if None not in window.ref_numbers:
+            return window
+
+    if ocr_cache.get_cache() is not None:
+        with metrics.timer("page_digest"):
+            window.digests = ocr_cache.page_digests(label_file_name, first_page, last_page)
+
+    pending = [i for i, ref_number in enumerate(window.ref_numbers) if ref_number is None]
+    window.rendered = _render_window_at_dpi(label_file_name, first_page, pending, window.digests, dpis[0], options)
+    return window
+
+# Finish reading a window from render_label_window: OCR its rendered strips, then climb the rest of the dpi ladder
+def ocr_label_window(window: LabelWindow, options: LabelOptions, vocabulary: Set[str] = None) -> List[str]:
+    ref_numbers = list(window.ref_numbers)
+    for dpi in window.dpis:
+        pending = [i for i, ref_number in enumerate(ref_numbers) if ref_number is None]
+        if not pending:
+            break
+        if dpi == window.dpis[0]:
+            results = _ocr_window_strips(window.rendered, options)
+        else:
+            results = _read_window_at_dpi(window.label_file_name, window.first_page, pending, window.digests, dpi,
+                                          options)
+        for i, ref_number in zip(pending, results):
+            # The last rung is always taken, earlier ones only when they read as a known SKU
+            if dpi == window.dpis[-1] or fuzz(ref_number) in vocabulary:
+                ref_numbers[i] = ref_number
+    return ref_numbers
+
+def _init_ocr_worker():
+    # Tesseract's own threading only fights with the other workers for cores. Only run in the worker processes,
+    # which end with the pool.
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+# The vocabulary of a worker process, handed to it once when it starts instead of with every window
+_worker_vocabulary: Optional[Set[str]] = None
+
+def _init_ocr_process(measure: bool, vocabulary: Optional[Set[str]]):
+    global _worker_vocabulary
+    _init_ocr_worker()
+    _worker_vocabulary = vocabulary
+    # A forked worker starts with a copy of the parent's metrics, it should only send back its own
+    metrics.enable(measure)
+    metrics.reset()
+
+# read_label_window in a worker process
+def _read_label_window_pooled(label_file_name: str, first_page: int, last_page: int,
+                              options: LabelOptions) -> List[str]:
+    return read_label_window(label_file_name, first_page, last_page, options, _worker_vocabulary)
+
+# read_label_window in a worker process, sending back the metrics it recorded along with the reference numbers
+def _read_label_window_measured(label_file_name: str, first_page: int, last_page: int,
+                                options: LabelOptions) -> Tuple[List[str], dict]:
+    return _read_label_window_pooled(label_file_name, first_page, last_page, options), metrics.collect()
+
+# Run read_label_window over every window, yielding the results in window order.
+# With more than one worker the windows are spread over a process pool. Only the file name and page
+# range are sent to a worker and only the reference strings come back, so no image crosses the process boundary.
+# The vocabulary goes to every worker once, when the pool starts it.
+# At most two windows per worker are in flight, which keeps memory flat on big batches.
+def _read_label_windows(label_file_name: str, windows: List[Tuple[int, int]], options: LabelOptions,
+                        vocabulary: Set[str] = None):
+    if options.workers <= 1 or len(windows) <= 1:
+        for first_page, last_page in windows:
+            yield read_label_window(label_file_name, first_page, last_page, options, vocabulary)
+        return
+
+    measure = metrics.enabled()
+    read = _read_label_window_measured if measure else _read_label_window_pooled
+
+    def result(future) -> List[str]:
+        if not measure:
+            return future.result()
+        ref_numbers, worker_metrics = future.result()
+        metrics.merge(worker_metrics)
+        return ref_numbers
+
+    with ProcessPoolExecutor(max_workers=options.workers, initializer=_init_ocr_process,
+                             initargs=(measure, vocabulary)) as executor:
+        pending = deque()
+        for first_page, last_page in windows:
+            pending.append(executor.submit(read, label_file_name, first_page, last_page, options))
+            if len(pending) >= options.workers * 2:
+                yield result(pending.popleft())
+        while pending:
+            yield result(pending.popleft())
+
+# (page count, [(first page, last page) of every window]) of the label pdf, pages 1-based and inclusive
+def _label_windows(label_file_name: str, options: LabelOptions) -> Tuple[int, List[Tuple[int, int]]]:
+    page_count = count_label_pages(label_file_name)
+    page_window = max(1, options.page_window)
+    if options.workers > 1:
+        # Small batches still get split across every worker
+        page_window = max(1, min(page_window, -(-page_count // options.workers)))
+    windows = [(first_page, min(first_page + page_window - 1, page_count))
+               for first_page in range(1, page_count + 1, page_window)]
+    return page_count, windows
+
+# Read the labels and match them with match, rendering, OCR and matching different windows at the same time.
+# Runs in threads of this process: strips are rendered on workers // 2 threads and read on workers threads,
+# each tesseract on one core. Prints how busy and how idle every stage was.
+def read_labels_pipelined(label_file_name: str, options: LabelOptions, vocabulary: Set[str],
+                          match: Callable[[ShippingLabel], ShippingLabel]) -> List[ShippingLabel]:
+    ocr_backend.set_backend(options.ocr_backend)
+    ocr_cache.configure(options.cache_path)
+    page_count, windows = _label_windows(label_file_name, options)
+
+    def render(window: Tuple[int, int]) -> LabelWindow:
+        return render_label_window(label_file_name, window[0], window[1], options, vocabulary)
+
+    def read(window: LabelWindow) -> Tuple[int, List[str]]:
+        return window.first_page, ocr_label_window(window, options, vocabulary)
+
+    def resolve(read_window: Tuple[int, List[str]]) -> List[ShippingLabel]:
+        first_page, ref_numbers = read_window
+        return [match(ShippingLabel(first_page - 1 + i, MAX_LABEL_NUMBER, ref_number))
+                for i, ref_number in enumerate(ref_numbers)]
+
+    stages = Pipeline([Stage("render", render, max(1, options.workers // 2)),
+                       Stage("ocr", read, max(1, options.workers)),
+                       Stage("match", resolve)])
+    labels = []
+    # The OCR threads run in this process, its environment is only changed while they do
+    with ocr_backend.single_threaded(), tqdm(desc="Reading reference numbers...", total=page_count) as progress:
+        for window_labels in stages.run(windows):
+            labels.extend(window_labels)
+            progress.update(len(window_labels))
+    ocr_cache.configure(None)
+    print(stages.report())
+    return labels
+
+# Parse the entire label pdf into a list of labels.
+# vocabulary holds the SKUs a label can be expected to read as, see LabelOptions.adaptive_dpi.
+def parse_label_pdf(label_file_name: str, options: LabelOptions = None, vocabulary: Set[str] = None) -> List[ShippingLabel]:
+    options = options or LabelOptions()
+    page_count, windows = _label_windows(label_file_name, options)
 
-    # Preprocess the image to enhance OCR accuracy
-    padded_image = preprocess_image(padded_image)
+    refs = []
+    with tqdm(desc="Reading reference numbers...", total=page_count) as progress:
+        for ref_numbers in _read_label_windows(label_file_name, windows, options, vocabulary):
+            for ref_number in ref_numbers:
+                refs.append(ShippingLabel(len(refs), MAX_LABEL_NUMBER, ref_number))
+            progress.update(len(ref_numbers))
+    return refs
 
-    text = str(pytesseract.image_to_string(padded_image,
-                                           config='''-c tessedit_char_whitelist="Trx Ref No.: 1234567890ABCDEFGHIJKLMNOPQRSTUVWXYZ-" --dpi 500 --psm 6'''))
+def read_reference_number(image: Image, coords: Tuple[int, int, int, int], cache_key: str = None) -> str:
+    with metrics.timer("crop"):
+        cropped_image = image.crop(coords)
+    return read_reference_strip(cropped_image, cache_key)
+
+# OCR a strip that has already been cropped out of the label.
+# cache_key identifies the strip in the OCR cache; without one the strip's pixels are hashed instead.
+def read_reference_strip(cropped_image: Image, cache_key: str = None) -> str:
+    return read_reference_strips([cropped_image], [cache_key])[0]
+
+# Read the reference number of every strip, batch_size strips per tesseract call.
+# Strips already in the OCR cache are not OCRed again.
+def read_reference_strips(strips: List[Image.Image], cache_keys: List[str], batch_size: int = 1,
+                          dpi: int = LABEL_DPI) -> List[str]:
+    config = _ref_ocr_config(dpi)
+    cache = ocr_cache.get_cache()
+    texts = [None] * len(strips)
+    if cache is not None:
+        for i, strip in enumerate(strips):
+            if cache_keys[i] is None:
+                cache_keys[i] = ocr_cache.make_key(ocr_cache.image_digest(strip), config, PREPROCESS_VERSION)
+            texts[i] = cache.get(cache_keys[i])
+
+    missing = [i for i, text in enumerate(texts) if text is None]
+    batch_size = max(1, batch_size)
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        padded_images = pad_reference_strips([strips[i] for i in batch], dpi)
+        if len(batch) == 1:
+            results = [ocr_backend.image_to_string(padded_images[0], config=config)]
+        else:
+            results = ocr_reference_sheet(padded_images, config)
+        for i, text in zip(batch, results):
+            texts[i] = text
+            if cache is not None:
+                cache.put(cache_keys[i], text)
+
+    return [clean_reference_text(text) for text in texts]
+
+def pad_reference_strip(cropped_image: Image, dpi: int = LABEL_DPI) -> Image:
+    return pad_reference_strips([cropped_image], dpi)[0]
+
+# Pad every strip with white above and below, then preprocess them all in one go.
+# Strips of the same size (every strip of one region) are stacked and preprocessed as a single array.
+@metrics.timed("preprocess")
+def pad_reference_strips(cropped_images: List[Image.Image], dpi: int = LABEL_DPI) -> List[Image.Image]:
+    # 100px of white above and below at LABEL_DPI
+    margin = 100 * dpi // LABEL_DPI
+    padded_images = [None] * len(cropped_images)
+
+    by_size = defaultdict(list)
+    for i, image in enumerate(cropped_images):
+        by_size[image.size].append(i)
+
+    for (width, height), indices in by_size.items():
+        stack = np.full((len(indices), height + 2 * margin, width), 255, dtype=np.uint8)
+        for n, i in enumerate(indices):
+            stack[n, margin:margin + height] = np.asarray(cropped_images[i].convert('L'))
+        # Preprocess the image to enhance OCR accuracy
+        for n, pixels in zip(indices, preprocess_pixels(stack)):
+            padded_images[n] = Image.fromarray(pixels)
+    return padded_images
+
+# OCR several padded strips with a single tesseract call. The strips are stacked into one tall sheet and
+# every recognized line is handed back to the strip its vertical centre falls in.
+def ocr_reference_sheet(padded_images: List[Image.Image], config: str) -> List[str]:
+    width = max(image.width for image in padded_images)
+    height = max(image.height for image in padded_images)
+    sheet = Image.new(padded_images[0].mode, (width, height * len(padded_images)), 'white')
+    for i, image in enumerate(padded_images):
+        sheet.paste(image, (0, i * height))
+
+    lines = [[] for _ in padded_images]
+    for top, bottom, text in sorted(ocr_backend.image_to_lines(sheet, config=config)):
+        index = min((top + bottom) // 2 // height, len(padded_images) - 1)
+        lines[index].append(text)
+    return ["\n".join(strip_lines) for strip_lines in lines]
+
+# "-<quantity>X" between the recipient and the SKU of a reference line, "KEITH FOX-1XCAB130742"
+REFERENCE_SEPARATOR = re.compile(r'-\s*\d+\s*[xX]\s*')
+# The same when OCR misread it, e.g. "-IX" or "-1 K X"
+LOOSE_REFERENCE_SEPARATOR = re.compile(r'-\s*\d*[^xXyY]*[xXI1]\s*')
+
+# Pull the SKU out of the raw OCR text of a reference strip.
+# Everything after the first clean separator is the SKU, hyphens and all (C-AB1-307-38, C38-135-SW1). When OCR
+# garbled the separator, the SKU is what follows the last thing that looks like one.
+def clean_reference_text(text: str) -> str:
     text = re.sub(r'[^A-Z0-9]+$', '', text)
-    text = re.split(r'-\s*\d*[^xXyY]*[xXI1]\s*', text)[-1]
+    separator = REFERENCE_SEPARATOR.search(text)
+    if separator is not None:
+        text = text[separator.end():]
+    else:
+        text = LOOSE_REFERENCE_SEPARATOR.split(text)[-1]
     text = re.sub(r'\s', '', text)
     return fuzz(text.upper())
 
 def read_reference_number_ups(image: Image) -> str:
-    coords = (0, 380, 1437, 500)
-    return read_reference_number(image, coords)
+    return read_reference_number(image, UPS_REF_COORDS)
 
 def read_reference_number_usps(image: Image) -> str:
-    coords = (0, 2033, 1437, 2100)
-    return read_reference_number(image, coords)
+    return read_reference_number(image, USPS_REF_COORDS)
 
 def write_pdf(slips: List[ShippingLabel], labels_pdf_path: str, output_path: str) -> None:
-    output_writer = PdfFileWriter()
-    input_reader = PdfFileReader(labels_pdf_path)
+    input_reader = PdfReader(labels_pdf_path)
     for i, slip in enumerate(slips):
-        output_writer.addPage(input_reader.getPage(slip.pdf_index))
         if slip.pick_list_rank >= MAX_LABEL_NUMBER:
             print(f"Slip {slip.pdf_index + 1} cannot be matched. Appended as page {slips.index(slip) + 1}")
 
-    written = False
-    while not written:
+    # Only opening the output is retried, it fails while the file is open in a viewer.
+    # A page that cannot be copied is a real error and is raised.
+    writer = None
+    while writer is None:
         try:
-            with open(output_path, 'wb') as of:
-                output_writer.write(of)
-            written = True
-        except Exception as e:
+            writer = pdf_output.PageStreamWriter(output_path)
+        except OSError:
             if input(f"ERROR: Cannot open {output_path}. Please make sure it is not open elsewhere\n"
                      f"To retry, press ENTER. To exit, enter 'e'\n") == 'e':
-                break
+                return
+    with metrics.timer("pdf_write"), writer:
+        pdf_output.add_pages(writer, input_reader, [slip.pdf_index for slip in slips])
 
 def Main():
     argParseDescription = (
@@ -167,6 +873,42 @@ def Main():
     parser.add_argument('-l', required=False, dest='shippingLabels', metavar='labels', help='The PDF for the pick list')
     parser.add_argument('-o', dest='outputFile', help='The path to the desired output file')
     parser.add_argument('-c', default=DEFAULT_CONVERSION_FILE, dest='conversionFile', help='The path to the UPC conversion file')
+    parser.add_argument('-w', type=int, default=DEFAULT_PAGE_WINDOW, dest='pageWindow',
+                        help='Number of label pages rasterized at a time')
+    parser.add_argument('--full-page', action='store_true', dest='fullPage',
+                        help='Rasterize whole label pages instead of only the reference number strips')
+    parser.add_argument('-j', type=int, default=1, dest='workers',
+                        help='Number of processes reading labels in parallel, e.g. the number of cores')
+    parser.add_argument('--ocr-backend', default=ocr_backend.DEFAULT_BACKEND, dest='ocrBackend',
+                        choices=['auto'] + list(ocr_backend.BACKENDS),
+                        help='OCR engine. tesserocr keeps tesseract loaded instead of starting it for every crop')
+    parser.add_argument('--no-cache', action='store_true', dest='noCache',
+                        help='Always run OCR instead of reusing results from earlier runs')
+    parser.add_argument('--clear-cache', action='store_true', dest='clearCache',
+                        help='Empty the OCR result cache before sorting')
+    parser.add_argument('--no-text-layer', action='store_true', dest='noTextLayer',
+                        help='OCR every label even when the pdf has its own text')
+    parser.add_argument('--batch-ocr', type=int, default=1, dest='batchSize',
+                        help='Stack this many reference strips into each tesseract call')
+    parser.add_argument('--max-distance', type=int, default=DEFAULT_MAX_DISTANCE, dest='maxDistance',
+                        help='Match a label that matches no SKU to the closest SKU within this many edits. '
+                             'Off (0) by default, every match made is printed')
+    parser.add_argument('--adaptive-dpi', type=int, default=0, dest='adaptiveDpi',
+                        help=f'Read labels at this dpi first (e.g. 200) and only re-read the ones that do not match '
+                             f'a known SKU at {LABEL_DPI} dpi')
+    parser.add_argument('--pick-list-parser', default="native", dest='pickListParser', choices=PICK_LIST_PARSERS,
+                        help='Read the pick list natively, or with tabula (needs Java)')
+    parser.add_argument('--pipeline', action='store_true', dest='pipeline',
+                        help='Render, OCR and match different labels at the same time and report how busy each stage was')
+    parser.add_argument('--metrics', dest='metricsFile',
+                        help='Time every stage and write the timings and counters to this file at the end, '
+                             'as JSON for a .json file and as a Prometheus textfile otherwise')
+    parser.add_argument('--profile', nargs='?', const='profile', dest='profileDir', metavar='dir',
+                        help='Profile the pick list, labels, matching and export stages, writing a .pstats and a '
+                             '.collapsed stack file per stage to dir (default ./profile), and print the hottest '
+                             'functions of each')
+    parser.add_argument('--profile-top', type=int, default=profiling.DEFAULT_TOP, dest='profileTop',
+                        help='Number of functions listed per stage in the profile summary')
     args = parser.parse_args()
 
     if args.pickList is None:
@@ -183,9 +925,37 @@ def Main():
     if args.conversionFile == DEFAULT_CONVERSION_FILE:
         args.conversionFile = os.path.join(os.path.abspath(os.path.dirname(__file__)), args.conversionFile)
 
-    sorted_slips = sort_slips(args.pickList, args.shippingLabels, args.conversionFile)
-    write_pdf(sorted_slips, args.shippingLabels, args.outputFile)
+    if args.clearCache:
+        ocr_cache.clear()
+
+    if args.metricsFile:
+        metrics.enable()
+
+    if args.profileDir:
+        if args.workers > 1 and not args.pipeline:
+            print("Labels are read in worker processes, which are not profiled. "
+                  "Run with -j 1 or --pipeline to profile reading them.")
+        profiling.start(args.profileDir)
+
+    options = LabelOptions(page_window=args.pageWindow, region_only=not args.fullPage, workers=args.workers,
+                           ocr_backend=args.ocrBackend,
+                           cache_path=None if args.noCache else ocr_cache.DEFAULT_CACHE_PATH,
+                           text_layer=not args.noTextLayer, batch_size=args.batchSize,
+                           adaptive_dpi=args.adaptiveDpi, max_distance=args.maxDistance,
+                           pick_list_parser=args.pickListParser, pipeline=args.pipeline)
+    try:
+        sorted_slips = sort_slips(args.pickList, args.shippingLabels, args.conversionFile, options)
+        with profiling.stage("export"):
+            write_pdf(sorted_slips, args.shippingLabels, args.outputFile)
+    finally:
+        # Also written when the run fails or is interrupted with Ctrl+C
+        profiling.finish(args.profileTop)
     print(f"Ordered list written at {args.outputFile}")
 
+    if args.metricsFile:
+        metrics.export(args.metricsFile)
+        print(metrics.report())
+        print(f"Metrics written to {args.metricsFile}")
+
 if __name__ == "__main__":
     Main()
\ No newline at end of file
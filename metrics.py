@@ -0,0 +1,234 @@
+# \package metrics
+#
+#     \brief   Times and counts the stages of a run, and writes the numbers out at the end of it.
+#
+#     Stages (rasterize, crop, preprocess, tesseract, fuzz, conversion lookup, tabula, pdf write, ...) record
+#     how long every call took into a duration histogram, and events (labels read, cache hits, labels without a
+#     match, ...) into counters. Nothing is recorded until enable() is called, so runs that do not ask for
+#     metrics only pay for a flag check. Worker processes collect() their own numbers and send them back to be
+#     merged. export() writes a JSON file, or a Prometheus textfile for node_exporter's textfile collector.
+#
+
+import contextlib
+import functools
+import json
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List
+
+# Upper bounds of the duration histogram buckets, in seconds. A fuzz call takes microseconds,
+# rendering a window of pages or starting tabula's JVM takes seconds.
+DURATION_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+METRIC_PREFIX = "ocr_pdf"
+# Bump when the JSON layout changes
+EXPORT_FORMAT = 1
+
+
+@dataclass
+class Histogram:
+    # Observations per bucket of DURATION_BUCKETS, not cumulative, with one more for the ones past the last bound
+    buckets: List[int] = field(default_factory=lambda: [0] * (len(DURATION_BUCKETS) + 1))
+    count: int = 0
+    sum: float = 0.0
+    max: float = 0.0
+
+    def observe(self, seconds: float) -> None:
+        index = 0
+        while index < len(DURATION_BUCKETS) and seconds > DURATION_BUCKETS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other: "Histogram") -> None:
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+
+class Registry:
+    def __init__(self):
+        # Stages run on the pipeline's threads at the same time
+        self._lock = threading.Lock()
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, float] = {}
+        self.started = time.time()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name: str, amount: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def reset(self) -> None:
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+            self.started = time.time()
+
+    # Plain dicts and lists, small enough to send back from a worker process
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "histograms": {stage: vars(histogram).copy() for stage, histogram in self.histograms.items()},
+                "counters": dict(self.counters),
+            }
+
+    def merge(self, snapshot: dict) -> None:
+        with self._lock:
+            for stage, values in snapshot["histograms"].items():
+                other = Histogram(**values)
+                if stage in self.histograms:
+                    self.histograms[stage].merge(other)
+                else:
+                    self.histograms[stage] = other
+            for name, amount in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+
+
+_registry = Registry()
+_enabled = False
+
+
+def enable(enabled: bool = True) -> None:
+    global _enabled
+    if enabled and not _enabled:
+        # The run is timed from here
+        _registry.started = time.time()
+    _enabled = enabled
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def reset() -> None:
+    _registry.reset()
+
+
+# Adds the time spent inside the block to the histogram of stage
+@contextlib.contextmanager
+def timer(stage: str) -> Iterator[None]:
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _registry.observe(stage, time.perf_counter() - start)
+
+
+# Decorator version of timer, for functions that are a stage on their own
+def timed(stage: str) -> Callable[[Callable], Callable]:
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _registry.observe(stage, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def count(name: str, amount: float = 1) -> None:
+    if _enabled:
+        _registry.count(name, amount)
+
+
+# The numbers recorded in this process since the last collect, for a worker to send back with its results
+def collect() -> dict:
+    snapshot = _registry.snapshot()
+    _registry.reset()
+    return snapshot
+
+
+# Add the numbers a worker process collected to this process's
+def merge(snapshot: dict) -> None:
+    _registry.merge(snapshot)
+
+
+def to_json() -> dict:
+    snapshot = _registry.snapshot()
+    return {
+        "format": EXPORT_FORMAT,
+        "started": _registry.started,
+        "wall_time": time.time() - _registry.started,
+        "buckets": list(DURATION_BUCKETS),
+        "stages": snapshot["histograms"],
+        "counters": snapshot["counters"],
+    }
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Prometheus text exposition format
+def to_prometheus() -> str:
+    snapshot = _registry.snapshot()
+    duration = f"{METRIC_PREFIX}_stage_duration_seconds"
+    lines = [f"# HELP {duration} Time spent in every call of a stage.", f"# TYPE {duration} histogram"]
+    for stage, values in sorted(snapshot["histograms"].items()):
+        cumulative = 0
+        for bound, observations in zip(list(DURATION_BUCKETS) + ["+Inf"], values["buckets"]):
+            cumulative += observations
+            lines.append(f'{duration}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'{duration}_sum{{stage="{stage}"}} {_number(values["sum"])}')
+        lines.append(f'{duration}_count{{stage="{stage}"}} {values["count"]}')
+
+    for name, amount in sorted(snapshot["counters"].items()):
+        metric = f"{METRIC_PREFIX}_{_metric_name(name)}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {_number(amount)}")
+
+    run_seconds = f"{METRIC_PREFIX}_run_seconds"
+    lines.append(f"# TYPE {run_seconds} gauge")
+    lines.append(f"{run_seconds} {_number(time.time() - _registry.started)}")
+    return "\n".join(lines) + "\n"
+
+
+# Write the metrics to path, as JSON when it ends in .json and as a Prometheus textfile otherwise.
+# The file is replaced in one go, so a collector never reads half of it.
+def export(path: str) -> None:
+    if path.endswith(".json"):
+        content = json.dumps(to_json(), indent=2)
+    else:
+        content = to_prometheus()
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+
+# Printable table of the stages, the one that took longest first, followed by the counters.
+# Stages running on several threads or processes at once can add up to more than the wall time.
+def report() -> str:
+    snapshot = _registry.snapshot()
+    lines = [f"{'stage':<20}{'calls':>9}{'total':>10}{'mean':>10}{'max':>10}"]
+    for stage, values in sorted(snapshot["histograms"].items(), key=lambda item: -item[1]["sum"]):
+        mean = values["sum"] / values["count"] if values["count"] else 0.0
+        lines.append(f"{stage:<20}{values['count']:>9}{values['sum']:>9.2f}s{mean * 1000:>8.3f}ms"
+                     f"{values['max']:>9.2f}s")
+    for name, amount in sorted(snapshot["counters"].items()):
+        lines.append(f"{name:<20}{amount:>9g}")
+    lines.append(f"wall time {time.time() - _registry.started:.1f}s")
+    return "\n".join(lines)
@@ -0,0 +1,190 @@
+# \package ocrBackend
+#
+#     \brief   Pluggable OCR engines used by the label readers.
+#
+#     pytesseract starts a new tesseract process and writes temporary image files for every call.
+#     The tesserocr backend keeps tesseract loaded in-process instead, so each crop only pays for recognition.
+#
+
+
+import contextlib
+import os
+import shlex
+import threading
+from typing import Dict, Iterator, List, Tuple
+
+import pytesseract
+
+import metrics
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+
+class OcrBackend:
+    name = ""
+
+    # config uses the same command line syntax as pytesseract, e.g. '-c tessedit_char_whitelist="0123" --psm 6'
+    def image_to_string(self, image, config: str = "") -> str:
+        raise NotImplementedError
+
+    # Recognized text lines with their vertical position, as (top, bottom, text)
+    def image_to_lines(self, image, config: str = "") -> List[Tuple[int, int, str]]:
+        raise NotImplementedError
+
+
+class PytesseractBackend(OcrBackend):
+    name = "pytesseract"
+
+    def image_to_string(self, image, config: str = "") -> str:
+        return str(pytesseract.image_to_string(image, config=config))
+
+    def image_to_lines(self, image, config: str = "") -> List[Tuple[int, int, str]]:
+        data = pytesseract.image_to_data(image, config=config, output_type=pytesseract.Output.DICT)
+
+        # image_to_data reports words, group them back into their lines
+        lines = {}
+        for i, word in enumerate(data["text"]):
+            if not word.strip():
+                continue
+            key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+            top = data["top"][i]
+            bottom = top + data["height"][i]
+            if key in lines:
+                line_top, line_bottom, words = lines[key]
+                lines[key] = (min(line_top, top), max(line_bottom, bottom), words + [word])
+            else:
+                lines[key] = (top, bottom, [word])
+
+        return [(top, bottom, " ".join(words)) for top, bottom, words in lines.values()]
+
+
+# Split a pytesseract config string into (lang, psm, oem, variables)
+def parse_config(config: str) -> Tuple[str, int, int, Tuple[Tuple[str, str], ...]]:
+    lang = "eng"
+    psm = 3  # tesseract's default, fully automatic page segmentation
+    oem = 3  # default, based on what is available
+    variables: Dict[str, str] = {}
+
+    args = shlex.split(config)
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        value = args[i + 1] if i + 1 < len(args) else ""
+        if arg == "-c":
+            name, _, var_value = value.partition("=")
+            variables[name] = var_value
+        elif arg == "--psm":
+            psm = int(value)
+        elif arg == "--oem":
+            oem = int(value)
+        elif arg == "--dpi":
+            variables["user_defined_dpi"] = value
+        elif arg == "-l":
+            lang = value
+        else:
+            i += 1
+            continue
+        i += 2
+
+    return lang, psm, oem, tuple(sorted(variables.items()))
+
+
+class TesserocrBackend(OcrBackend):
+    name = "tesserocr"
+
+    def __init__(self):
+        if tesserocr is None:
+            raise RuntimeError("The tesserocr backend needs the tesserocr package. Install it with `pip3 install tesserocr`")
+        # tesseract API handles are not thread safe, so every thread keeps its own set
+        self._local = threading.local()
+
+    # One loaded API per distinct config, reused for every crop that uses it
+    def _get_api(self, config: str):
+        apis = getattr(self._local, "apis", None)
+        if apis is None:
+            apis = self._local.apis = {}
+
+        key = parse_config(config)
+        api = apis.get(key)
+        if api is None:
+            lang, psm, oem, variables = key
+            api = tesserocr.PyTessBaseAPI(lang=lang, psm=psm, oem=oem)
+            for name, value in variables:
+                api.SetVariable(name, value)
+            apis[key] = api
+        return api
+
+    def image_to_string(self, image, config: str = "") -> str:
+        api = self._get_api(config)
+        api.SetImage(image)
+        return api.GetUTF8Text()
+
+    def image_to_lines(self, image, config: str = "") -> List[Tuple[int, int, str]]:
+        api = self._get_api(config)
+        api.SetImage(image)
+        api.Recognize()
+
+        lines = []
+        level = tesserocr.RIL.TEXTLINE
+        iterator = api.GetIterator()
+        if iterator is None:
+            return lines
+        for line in tesserocr.iterate_level(iterator, level):
+            text = line.GetUTF8Text(level)
+            box = line.BoundingBox(level)
+            if text and box:
+                lines.append((box[1], box[3], text.strip()))
+        return lines
+
+
+BACKENDS = {
+    PytesseractBackend.name: PytesseractBackend,
+    TesserocrBackend.name: TesserocrBackend,
+}
+# "auto" uses the in-process engine when it is installed and falls back to pytesseract otherwise
+DEFAULT_BACKEND = "auto"
+
+_backend: OcrBackend = None
+
+
+def set_backend(name: str = DEFAULT_BACKEND) -> OcrBackend:
+    global _backend
+    if name == "auto":
+        name = TesserocrBackend.name if tesserocr is not None else PytesseractBackend.name
+    if _backend is None or _backend.name != name:
+        _backend = BACKENDS[name]()
+    return _backend
+
+
+def get_backend() -> OcrBackend:
+    if _backend is None:
+        return set_backend()
+    return _backend
+
+
+@metrics.timed("tesseract")
+def image_to_string(image, config: str = "") -> str:
+    return get_backend().image_to_string(image, config)
+
+
+@metrics.timed("tesseract")
+def image_to_lines(image, config: str = "") -> List[Tuple[int, int, str]]:
+    return get_backend().image_to_lines(image, config)
+
+
+# Tesseract's own threads only fight with the other tesseracts for cores when several run at once.
+# Every tesseract started inside the block uses one thread, the environment is put back after it.
+@contextlib.contextmanager
+def single_threaded() -> Iterator[None]:
+    previous = os.environ.get("OMP_THREAD_LIMIT")
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop("OMP_THREAD_LIMIT", None)
+        else:
+            os.environ["OMP_THREAD_LIMIT"] = previous
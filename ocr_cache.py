@@ -0,0 +1,205 @@
+# \package ocrCache
+#
+#     \brief   On-disk cache of OCR results, so re-running the same labels skips tesseract.
+#
+#     Keys are content addressed: a hash of the pdf page (or of the image itself), the crop coordinates,
+#     the tesseract config and the version of the preprocessing applied before OCR. Entries are evicted
+#     least recently used first once the cache holds more than max_entries results. The pdf page text
+#     page_text caches is kept in a table of its own, with its own limit.
+#
+
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+from PyPDF2 import PdfReader
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+import metrics
+import ocr_backend
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".label_ocr_cache.sqlite")
+DEFAULT_MAX_ENTRIES = 200000
+# pdfplumber page text and words (page_text) are far larger than an OCR result, so they are kept apart,
+# in a table of their own with its own, smaller limit, and never push OCR results out
+DEFAULT_MAX_PAGE_ENTRIES = 20000
+# Only check the size of the cache every this many inserts
+EVICTION_INTERVAL = 1000
+# Cache hits only note the time they were used; the notes are written every this many hits or with the eviction pass
+TOUCH_INTERVAL = 1000
+
+# Kinds of entry, each a table of the cache file
+OCR = "ocr"
+PAGE_TEXT = "page_text"
+
+
+class OcrCache:
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_page_entries: int = DEFAULT_MAX_PAGE_ENTRIES):
+        self.path = path
+        self.max_entries = {OCR: max_entries, PAGE_TEXT: max_page_entries}
+        self._inserts = 0
+        # last_used of the entries read since the last flush, by kind and key
+        self._touched: Dict[str, Dict[str, float]] = {kind: {} for kind in self.max_entries}
+        self._touches = 0
+        # Several label worker processes share the file, so wait on locks instead of failing.
+        # Within a process the pipeline's threads share this connection, one statement at a time.
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for kind in self.max_entries:
+            self._db.execute(f"CREATE TABLE IF NOT EXISTS {kind} "
+                             "(key TEXT PRIMARY KEY, text TEXT NOT NULL, last_used REAL NOT NULL)")
+            self._db.execute(f"CREATE INDEX IF NOT EXISTS {kind}_last_used ON {kind} (last_used)")
+        self._db.commit()
+
+    # A hit is not written back at once: every write takes the file's lock, which the -j workers would queue on
+    def get(self, key: str, kind: str = OCR) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute(f"SELECT text FROM {kind} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                metrics.count("ocr_cache_misses")
+                return None
+            metrics.count("ocr_cache_hits")
+            self._touched[kind][key] = time.time()
+            self._touches += 1
+            if self._touches % TOUCH_INTERVAL == 0:
+                self.flush()
+            return row[0]
+
+    def put(self, key: str, text: str, kind: str = OCR) -> None:
+        with self._lock:
+            self._db.execute(f"INSERT OR REPLACE INTO {kind} (key, text, last_used) VALUES (?, ?, ?)",
+                             (key, text, time.time()))
+            self._db.commit()
+            self._touched[kind].pop(key, None)
+            self._inserts += 1
+            if self._inserts % EVICTION_INTERVAL == 0:
+                self.evict()
+
+    # Write the last_used of the entries read since the last flush
+    def flush(self) -> None:
+        with self._lock:
+            if not any(self._touched.values()):
+                return
+            for kind, touched in self._touched.items():
+                self._db.executemany(f"UPDATE {kind} SET last_used = ? WHERE key = ?",
+                                     [(last_used, key) for key, last_used in touched.items()])
+                touched.clear()
+            self._db.commit()
+
+    # Drop the least recently used entries of each kind until it is back to its max_entries
+    def evict(self) -> None:
+        with self._lock:
+            self.flush()
+            for kind, max_entries in self.max_entries.items():
+                count = self._db.execute(f"SELECT COUNT(*) FROM {kind}").fetchone()[0]
+                if count <= max_entries:
+                    continue
+                self._db.execute(f"DELETE FROM {kind} WHERE key IN "
+                                 f"(SELECT key FROM {kind} ORDER BY last_used LIMIT ?)", (count - max_entries,))
+                self._db.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            for kind, touched in self._touched.items():
+                touched.clear()
+                self._db.execute(f"DELETE FROM {kind}")
+            self._db.commit()
+            self._db.execute("VACUUM")
+
+    def close(self) -> None:
+        with self._lock:
+            self.flush()
+            self._db.close()
+
+
+_cache: Optional[OcrCache] = None
+_cache_path: Optional[str] = None
+
+
+# Select the cache file for this process. None turns caching off.
+def configure(path: Optional[str] = DEFAULT_CACHE_PATH) -> Optional[OcrCache]:
+    global _cache, _cache_path
+    if path == _cache_path and (path is None or _cache is not None):
+        return _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = OcrCache(path) if path is not None else None
+    _cache_path = path
+    return _cache
+
+
+def get_cache() -> Optional[OcrCache]:
+    return _cache
+
+
+def clear(path: str = DEFAULT_CACHE_PATH) -> None:
+    if os.path.exists(path):
+        cache = OcrCache(path)
+        cache.clear()
+        cache.close()
+
+
+def make_key(*parts) -> str:
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+def image_digest(image) -> str:
+    digest = hashlib.sha1(f"{image.mode} {image.size}".encode("utf-8"))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def _hash_pdf_object(obj, digest, seen) -> None:
+    if isinstance(obj, IndirectObject):
+        # Shared objects (fonts, images, the parent page tree) are only walked once
+        if obj.idnum in seen:
+            digest.update(f"ref {obj.idnum}".encode("utf-8"))
+            return
+        seen.add(obj.idnum)
+        obj = obj.get_object()
+
+    if isinstance(obj, StreamObject):
+        digest.update(obj.get_data())
+    if isinstance(obj, DictionaryObject):
+        for key in sorted(obj.keys()):
+            if key in ("/Parent", "/StructParents"):
+                continue
+            digest.update(key.encode("utf-8"))
+            _hash_pdf_object(obj.raw_get(key), digest, seen)
+    elif isinstance(obj, ArrayObject):
+        for item in obj:
+            _hash_pdf_object(item, digest, seen)
+    else:
+        digest.update(repr(obj).encode("utf-8"))
+
+
+# Content hashes of pages first_page..last_page (1-based, inclusive). Two pages that draw the same
+# content and images hash the same, whichever file or position they come from.
+def page_digests(pdf_path: str, first_page: int, last_page: int) -> List[str]:
+    reader = PdfReader(pdf_path)
+    digests = []
+    for index in range(first_page - 1, last_page):
+        digest = hashlib.sha1()
+        _hash_pdf_object(reader.pages[index], digest, set())
+        digests.append(digest.hexdigest())
+    return digests
+
+
+# ocr_backend.image_to_string, answered from the cache when this exact image has been read before
+def cached_image_to_string(image, config: str = "", preprocess_version: int = 0) -> str:
+    if _cache is None:
+        return ocr_backend.image_to_string(image, config)
+
+    key = make_key(image_digest(image), config, preprocess_version)
+    text = _cache.get(key)
+    if text is None:
+        text = ocr_backend.image_to_string(image, config)
+        _cache.put(key, text)
+    return text
@@ -0,0 +1,101 @@
+# \package pageText
+#
+#     \brief   Text of pdf pages, extracted by several processes at once and cached between runs.
+#
+#     pdfplumber's layout analysis is CPU bound and runs one page after another. Here the pages still missing
+#     from the cache are split into ranges, and every worker process opens the file once and extracts its range.
+#     Results are stored in the OCR result cache file (ocr_cache) when one is configured, in a table of their own,
+#     keyed by a hash of the file and the page, so reading the same slips or labels again skips pdfplumber entirely.
+#
+
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+import pdfplumber
+
+import metrics
+import ocr_cache
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+# With fewer pages than this per worker, starting the processes costs more than it saves
+MIN_PAGES_PER_WORKER = 4
+# Bump when what is extracted from a page changes, so cached results from the old extraction are not reused
+EXTRACTION_VERSION = 1
+
+
+def file_digest(pdf_path: str) -> str:
+    digest = hashlib.sha1()
+    with open(pdf_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# page.extract_text() of every page
+def page_texts(pdf_path: str, workers: int = DEFAULT_WORKERS) -> List[str]:
+    return _extract_all(pdf_path, "text", workers)
+
+
+# page.extract_words() of every page
+def page_words(pdf_path: str, workers: int = DEFAULT_WORKERS) -> List[List[dict]]:
+    return [json.loads(words) for words in _extract_all(pdf_path, "words", workers)]
+
+
+def _extract_page(page, kind: str) -> str:
+    if kind == "words":
+        return json.dumps(page.extract_words())
+    return page.extract_text()
+
+
+# Extract pages page_numbers (1-based) of the file, opening it only once
+def _extract_pages(pdf_path: str, page_numbers: List[int], kind: str) -> List[str]:
+    with pdfplumber.open(pdf_path, pages=page_numbers) as pdf:
+        return [_extract_page(page, kind) for page in pdf.pages]
+
+
+def _page_key(digest: str, page_number: int, kind: str) -> str:
+    return ocr_cache.make_key("page", digest, page_number, kind, pdfplumber.__version__, EXTRACTION_VERSION)
+
+
+# Consecutive page numbers in groups, for splitting the missing pages between the workers
+def _page_ranges(page_numbers: List[int], workers: int) -> List[List[int]]:
+    size = max(MIN_PAGES_PER_WORKER, -(-len(page_numbers) // max(1, workers)))
+    return [page_numbers[start:start + size] for start in range(0, len(page_numbers), size)]
+
+
+@metrics.timed("page_text")
+def _extract_all(pdf_path: str, kind: str, workers: int) -> List[str]:
+    with pdfplumber.open(pdf_path) as pdf:
+        page_count = len(pdf.pages)
+
+    cache = ocr_cache.get_cache()
+    keys: Dict[int, str] = {}
+    results: Dict[int, str] = {}
+    if cache is not None:
+        digest = file_digest(pdf_path)
+        for page_number in range(1, page_count + 1):
+            keys[page_number] = _page_key(digest, page_number, kind)
+            text = cache.get(keys[page_number], ocr_cache.PAGE_TEXT)
+            if text is not None:
+                results[page_number] = text
+
+    missing = [page_number for page_number in range(1, page_count + 1) if page_number not in results]
+    metrics.count("pages_extracted", len(missing))
+    ranges = _page_ranges(missing, workers)
+    if len(ranges) > 1 and workers > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(ranges))) as executor:
+            extracted: List[Tuple[List[int], List[str]]] = list(zip(
+                ranges, executor.map(_extract_pages, [pdf_path] * len(ranges), ranges, [kind] * len(ranges))))
+    else:
+        extracted = [(page_numbers, _extract_pages(pdf_path, page_numbers, kind)) for page_numbers in ranges]
+
+    for page_numbers, texts in extracted:
+        for page_number, text in zip(page_numbers, texts):
+            results[page_number] = text
+            if cache is not None:
+                cache.put(keys[page_number], text, ocr_cache.PAGE_TEXT)
+
+    return [results[page_number] for page_number in range(1, page_count + 1)]
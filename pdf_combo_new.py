@@ -7,21 +7,49 @@
 
 import argparse
 import re
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from typing import List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional, Set
 from dataclasses import dataclass
 import dataclasses
 import json
 import os
 
+import numpy as np
 from PIL import Image
 import pdf2image
-import pytesseract
 from tqdm import tqdm
-import tabula
 import pandas as pd
-from PyPDF2 import PdfFileWriter, PdfFileReader
-import pdfplumber
+from PyPDF2 import PdfReader
+from rapidfuzz import fuzz, process
+
+import assignment
+import metrics
+import ocr_backend
+import ocr_cache
+import page_text
+import pdf_output
+import profiling
+from pipeline import Pipeline, Stage
+from tabula_session import TabulaSession
+
+
+# greedy gives every slip the first label that fits it, optimal pairs all slips and labels for the best total fit
+MATCH_MODES = ("greedy", "optimal")
+# Weights of the evidence that a packing slip and a shipping label belong to the same order, in optimal matching
+REFERENCE_WEIGHT = 3.0
+NAME_WEIGHT = 2.0
+ADDRESS_WEIGHT = 1.0
+ZIP_WEIGHT = 1.0
+# A slip and a label that don't share a reference number need names at least this similar (0-1) to be paired
+MIN_NAME_SIMILARITY = 0.8
+# Slips and labels are only compared when they share a reference number, or a ZIP code and this many leading name
+# letters. Either alone links most of a big batch together.
+NAME_BLOCK_PREFIX = 3
+# Threads rendering label pages and threads reading them, when the labels are parsed as a pipeline
+PIPELINE_RENDER_WORKERS = 2
+PIPELINE_OCR_WORKERS = os.cpu_count() or 1
 
 
 @dataclass
@@ -134,9 +162,9 @@ def _parseSingleShippingLabel_NotHSN(label_image, crop_coordinates: List[Tuple[i
     # the last label that we looped through. This will either be a valid label or the last attempt.
     last_parsed_label = None
     for coords in crop_coordinates:
-        cropped_label = label_image.crop(coords)
-        text = str(pytesseract.image_to_string(
-            cropped_label, config='--psm 6'))
+        with metrics.timer("crop"):
+            cropped_label = label_image.crop(coords)
+        text = ocr_cache.cached_image_to_string(cropped_label, config='--psm 6')
 
         last_parsed_label = get_details_list_from_shipping_label(text)
         if last_parsed_label.full_name != "Label_Error":
@@ -174,61 +202,67 @@ def _parseShippingLabels_NotHSN(label_images: List, crop_coordinates: List[Tuple
     return output, errors
 
 
-def _parseShippingLabels_HSN(label_images, crop_coordinates) -> Tuple[List[ShippingLabel], List[int]]:
-    output: List[ShippingLabel] = []
-    errors: List[int] = []
-
-    for i, label in tqdm(enumerate(label_images), total=len(label_images)):
-        last_parsed_label = None
-        for coords in crop_coordinates:
+def _parseSingleShippingLabel_HSN(label, page_num: int, crop_coordinates: List[Tuple[int, int, int, int]]) -> ShippingLabel:
+    last_parsed_label = None
+    for coords in crop_coordinates:
+        with metrics.timer("crop"):
             cropped_label = label.crop(coords).convert("L")
-            text = str(pytesseract.image_to_string(cropped_label))
-
-            last_parsed_label = ShippingLabel(
-                page_num=i,
-                full_name="Label_Error",
-                reference_num="",
-                addr_line1="",
-                addr_line2="",
-                addr_line3="",
-                addr_line4=""
-            )
-
-            lines = text.split("\n")
-            for line in lines:
-
-                if line.find("Trx Ref No") != -1:
-                    name_coordinates = (0, 300, 1215, 475)
+        text = ocr_cache.cached_image_to_string(cropped_label)
+
+        last_parsed_label = ShippingLabel(
+            page_num=page_num,
+            full_name="Label_Error",
+            reference_num="",
+            addr_line1="",
+            addr_line2="",
+            addr_line3="",
+            addr_line4=""
+        )
+
+        lines = text.split("\n")
+        for line in lines:
+
+            if line.find("Trx Ref No") != -1:
+                name_coordinates = (0, 300, 1215, 475)
+                with metrics.timer("crop"):
                     name_image = label.crop(name_coordinates).convert("L")
-                    name_text = str(pytesseract.image_to_string(name_image))
-                    name_text = name_text.split('\n')
-                    name_text = name_text[1 % len(name_text)]
-
-                    split_line = line.split(".:")
-                    last_parsed_label.full_name = name_text
-                    split_line[1] = split_line[1].replace(":", "")
-                    split_line[1] = split_line[1].strip()
-                    last_parsed_label.reference_num = split_line[1].strip()
-                    break
-                elif line.find(" - ") != -1:
-                    split_line = line.split(" - ")
+                name_text = ocr_cache.cached_image_to_string(name_image)
+                name_text = name_text.split('\n')
+                name_text = name_text[1 % len(name_text)]
+
+                split_line = line.split(".:")
+                last_parsed_label.full_name = name_text
+                split_line[1] = split_line[1].replace(":", "")
+                split_line[1] = split_line[1].strip()
+                last_parsed_label.reference_num = split_line[1].strip()
+                break
+            elif line.find(" - ") != -1:
+                split_line = line.split(" - ")
 
-                    split_line[0] = split_line[0].replace("#", "")
-                    last_parsed_label.full_name = split_line[0]
+                split_line[0] = split_line[0].replace("#", "")
+                last_parsed_label.full_name = split_line[0]
 
-                    split_line[1] = split_line[1].replace(":", "")
-                    split_line[1] = split_line[1].strip()
-                    last_parsed_label.reference_num = split_line[1]
-                    break
+                split_line[1] = split_line[1].replace(":", "")
+                split_line[1] = split_line[1].strip()
+                last_parsed_label.reference_num = split_line[1]
+                break
 
-            last_parsed_label.reference_num = re.split(
-                r"[a-zA-Z]+", last_parsed_label.reference_num)[0]
+        last_parsed_label.reference_num = re.split(
+            r"[a-zA-Z]+", last_parsed_label.reference_num)[0]
 
-            if last_parsed_label.full_name != "Label_Error":
-                break
+        if last_parsed_label.full_name != "Label_Error":
+            break
 
-        assert(last_parsed_label is not None)
-        output.append(last_parsed_label)
+    assert(last_parsed_label is not None)
+    return last_parsed_label
+
+
+def _parseShippingLabels_HSN(label_images, crop_coordinates) -> Tuple[List[ShippingLabel], List[int]]:
+    output: List[ShippingLabel] = []
+    errors: List[int] = []
+
+    for i, label in tqdm(enumerate(label_images), total=len(label_images)):
+        output.append(_parseSingleShippingLabel_HSN(label, i, crop_coordinates))
 
     for i, label in enumerate(output):
         if label.full_name == "Label_Error":
@@ -237,10 +271,9 @@ def _parseShippingLabels_HSN(label_images, crop_coordinates) -> Tuple[List[Shipp
     return output, errors
 
 
-# This returns (parsed labels, indices of errored labels)
-def parseShippingLabel(mode: Mode) -> Tuple[List[ShippingLabel], List[int]]:
-    page_images: List = pdf2image.convert_from_path(
-        mode.labels_path, dpi=500, grayscale=True)
+# Crop coordinates of the address block on the labels of the mode's store, and of the reference number for stores
+# that print it somewhere special (None otherwise)
+def _labelCropCoordinates(mode: Mode) -> Tuple[List[Tuple[int, int, int, int]], Optional[Tuple[int, int, int, int]]]:
     crop_coordinates = []
 
     specialty_reference_number_coords = None
@@ -248,9 +281,7 @@ def parseShippingLabel(mode: Mode) -> Tuple[List[ShippingLabel], List[int]]:
     # HSN is special
     if mode.name == Store.HSN.name:
         crop_coordinates = [(0, 1875, 1450, 2100), (0, 2850, 1000, 2950)]
-        return _parseShippingLabels_HSN(page_images, crop_coordinates)
-
-    if mode.name == Store.Target.name:
+    elif mode.name == Store.Target.name:
         # there are multiple possible locations for the information on the label.
         target1 = (70, 350, 1700, 820)  # Fedex Home Delivery
         target2 = (70, 400, 1700, 820)  # Fedex Home Delivery
@@ -267,9 +298,66 @@ def parseShippingLabel(mode: Mode) -> Tuple[List[ShippingLabel], List[int]]:
             (70, 400, 1700, 820),
             (144, 407, 1950, 730)]
 
-    # Do special handling for each reference number
-    labels, errors = _parseShippingLabels_NotHSN(
-        page_images, crop_coordinates, specialty_reference_number_coords, mode.name)
+    return crop_coordinates, specialty_reference_number_coords
+
+
+# Render and read the labels one page at a time, rendering the next pages while the ones before are OCRed.
+# Returns the same (parsed labels, indices of errored labels) as the sequential parsers.
+def _parseShippingLabelsPipelined(mode: Mode, crop_coordinates: List[Tuple[int, int, int, int]],
+                                  specialty_reference_number_coords: Optional[Tuple[int, int, int, int]]) -> Tuple[List[ShippingLabel], List[int]]:
+    page_count = pdf2image.pdfinfo_from_path(mode.labels_path)["Pages"]
+
+    def render(page_num: int):
+        metrics.count("pages_rendered")
+        with metrics.timer("rasterize"):
+            return page_num, pdf2image.convert_from_path(mode.labels_path, dpi=500, grayscale=True,
+                                                         first_page=page_num + 1, last_page=page_num + 1)[0]
+
+    def read(page) -> ShippingLabel:
+        page_num, label_image = page
+        if mode.name == Store.HSN.name:
+            return _parseSingleShippingLabel_HSN(label_image, page_num, crop_coordinates)
+        label = _parseSingleShippingLabel_NotHSN(label_image, crop_coordinates, specialty_reference_number_coords,
+                                                 mode.name)
+        label.page_num = page_num
+        return label
+
+    stages = Pipeline([Stage("render", render, PIPELINE_RENDER_WORKERS),
+                       Stage("ocr", read, PIPELINE_OCR_WORKERS)])
+    # Several tesseracts run at once, each should stay on one core
+    with ocr_backend.single_threaded():
+        output = list(tqdm(stages.run(range(page_count)), total=page_count))
+    print(stages.report())
+
+    errors = [i for i, label in enumerate(output) if label.full_name == "Label_Error"]
+    return output, errors
+
+
+# This returns (parsed labels, indices of errored labels)
+def parseShippingLabel(mode: Mode, pipelined: bool = False) -> Tuple[List[ShippingLabel], List[int]]:
+    # Profiled as its own stage on whichever thread reads the labels
+    with profiling.stage("labels"):
+        return _parseShippingLabel(mode, pipelined)
+
+
+def _parseShippingLabel(mode: Mode, pipelined: bool) -> Tuple[List[ShippingLabel], List[int]]:
+    crop_coordinates, specialty_reference_number_coords = _labelCropCoordinates(mode)
+
+    if pipelined:
+        labels, errors = _parseShippingLabelsPipelined(mode, crop_coordinates, specialty_reference_number_coords)
+    else:
+        with metrics.timer("rasterize"):
+            page_images: List = pdf2image.convert_from_path(
+                mode.labels_path, dpi=500, grayscale=True)
+        metrics.count("pages_rendered", len(page_images))
+
+        # HSN is special
+        if mode.name == Store.HSN.name:
+            return _parseShippingLabels_HSN(page_images, crop_coordinates)
+
+        # Do special handling for each reference number
+        labels, errors = _parseShippingLabels_NotHSN(
+            page_images, crop_coordinates, specialty_reference_number_coords, mode.name)
 
     if mode.name == Store.Hibbett.name:
         for label_index in range(len(labels)):
@@ -429,148 +517,310 @@ class AddressUtil:
 
 # region Packing Slips
 
+# A packing slip field is (scan area, column, row): the mode's scan area it is read from (a Mode field name),
+# then the column and row of the table tabula finds in that area on the slip's page.
+SlipField = Tuple[str, int, int]
 
-def processBedBathPackingSlips(mode: Mode) -> List[PackingSlip]:
-    # collect shipping info: this is for BedBath
-    order_info_list = tabula.read_pdf(
-        mode.slips_path, area=mode.order_scan, pages='all', pandas_options={'header': None})
-    ship_to_list = tabula.read_pdf(mode.slips_path, area=mode.ship_scan,
-                                   stream=False, pages='all', pandas_options={'header': None})
-
-    result = []
-    for (i, (order, ship)) in enumerate(zip(order_info_list, ship_to_list)):
-        ship = ship[0]
-        # process recipient inf
-
-        name = ship[1]
-        addr = ""
-        city_state_zip = ""
-        # includes secondary address (lot or apartment)
-        if len(ship) == 5:
-            addr = ship[2] + " " + ship[3]
-            city_state_zip = ship[4]
-        else:
-            addr = ship[2]
-            city_state_zip = ship[3]
-
-        reference_num = order[1][0]
-
-        result.append(PackingSlip(name=name, addr=addr,
-                      city_state_zip=city_state_zip, reference_num=reference_num, page=i))
-    return result
-
-
-def processHsnPackingSlips(mode: Mode) -> List[PackingSlip]:
-    order_info_list = tabula.read_pdf(
-        mode.slips_path, area=mode.order_scan, pages='all', pandas_options={'header': None})
-    ship_to_list = tabula.read_pdf(mode.slips_path, area=mode.ship_scan, guess=False,
-                                   pages='all', pandas_options={'header': None}, multiple_tables=True)
 
-    slips = []
-    for (i, (order, ship)) in enumerate(zip(order_info_list, ship_to_list)):
-
-        # This will be in the form of "Package ID:<the number>"
-        reference_number = order[0][0]
-        # Getting a negative index of a list goes from the end. We want the last element
-        reference_number = reference_number.split(":")[-1]
-
-        ship = ship[0]
-
-        slips.append(PackingSlip(
-            name=ship[0], addr=ship[1], city_state_zip=ship[2], reference_num=reference_number, page=i))
-
-    return slips
-
-
-def processTargetPackingSlips(mode: Mode) -> List[PackingSlip]:
-
-    order_info_list = tabula.read_pdf(
-        mode.slips_path, area=mode.order_scan, pages='all', pandas_options={'header': None})
-    ship_to_list = tabula.read_pdf(
-        mode.slips_path, area=mode.ship_scan, pages='all', pandas_options={'header': None})
-
-    ret_list = []
-
-    for (i, (order, ship)) in enumerate(zip(order_info_list, ship_to_list)):
-        order = order[0]
-        ship = ship[1]
-
-        reference_num = str(order[0])
-        reference_num = reference_num[-6:]
-        name = ship[1]
-        address = ship[2]
-        city_state_zip = ship[4]
-
-        ret_list.append(PackingSlip(
-            name, address, city_state_zip, reference_num, page=i))
-
-    return ret_list
-
-
-def processBelkPackingSlips(mode: Mode) -> List[PackingSlip]:
-    order_info_list = tabula.read_pdf(
-        mode.slips_path, area=mode.order_scan, pages="all", pandas_options={"header": None})
-    ship_to_list = tabula.read_pdf(
-        mode.slips_path, area=mode.ship_scan, pages="all", pandas_options={"header": None})
-
-    ret_list = []
-
-    for (i, (order, ship)) in enumerate(zip(order_info_list, ship_to_list)):
-        ship = ship[0]
-
-        name = ship[1]
-        addr = ship[2]
-        city_state_zip = ship[3]
-
-        reference_num = order[1][0]
+@dataclass
+class SlipLayout:
+    name: SlipField
+    addr: SlipField
+    city_state_zip: SlipField
+    reference_num: SlipField
+    # Only keep the text after the last occurrence of this separator in the reference number
+    ref_separator: str = ""
+    # Only keep this many characters from the end of the reference number, 0 keeps all of it
+    ref_suffix: int = 0
+    # When the address column has this many rows the address has a second line (lot or apartment),
+    # which is added to addr, and city/state/zip is one row further down
+    two_line_addr_rows: int = 0
+
+
+SLIP_LAYOUTS = {
+    Store.Target.name: SlipLayout(name=("ship_scan", 1, 1), addr=("ship_scan", 1, 2),
+                                  city_state_zip=("ship_scan", 1, 4), reference_num=("order_scan", 0, 0),
+                                  ref_suffix=6),
+    Store.Belk.name: SlipLayout(name=("ship_scan", 0, 1), addr=("ship_scan", 0, 2),
+                                city_state_zip=("ship_scan", 0, 3), reference_num=("order_scan", 1, 0)),
+    Store.Hibbett.name: SlipLayout(name=("ship_scan", 2, 0), addr=("ship_scan", 2, 1),
+                                   city_state_zip=("ship_scan", 2, 2), reference_num=("order_scan", 0, 0),
+                                   ref_suffix=4),
+    # This will be in the form of "Package ID:<the number>"
+    Store.HSN.name: SlipLayout(name=("ship_scan", 0, 0), addr=("ship_scan", 0, 1),
+                               city_state_zip=("ship_scan", 0, 2), reference_num=("order_scan", 0, 0),
+                               ref_separator=":"),
+    Store.BedBath.name: SlipLayout(name=("ship_scan", 0, 1), addr=("ship_scan", 0, 2),
+                                   city_state_zip=("ship_scan", 0, 3), reference_num=("order_scan", 1, 0),
+                                   two_line_addr_rows=5),
+}
+SLIP_LAYOUTS[Store.GSI.name] = SLIP_LAYOUTS[Store.Hibbett.name]
+
+SLIP_RECORD_COLUMNS = ["name", "addr", "city_state_zip", "reference_num", "page"]
+
+
+# Read every field of layout from the slips pdf in one tabula pass.
+# Returns one row per page, with the columns of SLIP_RECORD_COLUMNS.
+def extractSlipRecords(mode: Mode, layout: SlipLayout) -> pd.DataFrame:
+    fields = [layout.name, layout.addr, layout.city_state_zip, layout.reference_num]
+    area_names = list(dict.fromkeys(field[0] for field in fields))
+    area_tables = TabulaSession(mode.slips_path).read_areas(
+        [getattr(mode, area_name) for area_name in area_names], pandas_options={'header': None})
+
+    records = {column: [] for column in SLIP_RECORD_COLUMNS}
+    # Pages where an area came back without a table can't be lined up with the other areas, stop at the shortest
+    for (i, page_tables) in enumerate(zip(*area_tables)):
+        tables = dict(zip(area_names, page_tables))
+
+        def cell(field: SlipField, row_offset: int = 0):
+            area_name, column, row = field
+            return tables[area_name][column][row + row_offset]
+
+        addr = cell(layout.addr)
+        city_state_zip_offset = 0
+        if layout.two_line_addr_rows and len(tables[layout.addr[0]][layout.addr[1]]) == layout.two_line_addr_rows:
+            addr = addr + " " + cell(layout.addr, 1)
+            city_state_zip_offset = 1
+
+        reference_num = cell(layout.reference_num)
+        if layout.ref_separator:
+            reference_num = reference_num.split(layout.ref_separator)[-1]
+        if layout.ref_suffix:
+            reference_num = str(reference_num)[-layout.ref_suffix:]
+
+        records["name"].append(cell(layout.name))
+        records["addr"].append(addr)
+        records["city_state_zip"].append(cell(layout.city_state_zip, city_state_zip_offset))
+        records["reference_num"].append(reference_num)
+        records["page"].append(i)
+
+    # object columns keep every value exactly as tabula read it, pandas would otherwise widen mixed ints and NaN to floats
+    return pd.DataFrame(records, columns=SLIP_RECORD_COLUMNS, dtype=object)
+
+
+@metrics.timed("slips")
+def processPackingSlips(mode: Mode) -> List[PackingSlip]:
+    with profiling.stage("slips"):
+        records = extractSlipRecords(mode, SLIP_LAYOUTS[mode.name])
+    return [PackingSlip(name, addr, city_state_zip, reference_num, page=int(page))
+            for name, addr, city_state_zip, reference_num, page in records.itertuples(index=False)]
 
-        ret_list.append(PackingSlip(
-            name, addr, city_state_zip, reference_num, page=i))
-    return ret_list
+# endregion
 
 
-def processHibbettPackingSlips(mode: Mode) -> List[PackingSlip]:
-    order_info_list = tabula.read_pdf(
-        mode.slips_path, area=mode.order_scan, pages='all', pandas_options={'header': None})
-    ship_to_list = tabula.read_pdf(
-        mode.slips_path, area=mode.ship_scan, pages='all', pandas_options={'header': None})
+# Pairs packing slips with shipping labels. Every label is used for at most one slip, in case two have the same name.
+# A slip takes the first unused label with its reference number. Failing that, it takes the first unused label with
+# its name, as long as some unused label that has no slip reference number carries that name.
+# Labels are indexed by reference number and name up front, so every match is a dictionary lookup.
+class LabelMatcher:
+    def __init__(self, labels: List[ShippingLabel], slip_reference_nums: Set[str]):
+        self._used = [False] * len(labels)
+        # Label indices in label order, used ones are skipped when they come up
+        self._by_ref: Dict[str, deque] = defaultdict(deque)
+        self._by_name: Dict[str, deque] = defaultdict(deque)
+        # Unused labels per name, only counting labels whose reference number is on no slip
+        self._unreferenced_names: Dict[str, int] = defaultdict(int)
+        self._referenced = []
 
-    ret_list = []
+        for i, label in enumerate(labels):
+            reference_num = str(label.reference_num).strip()
+            referenced = reference_num in slip_reference_nums
+            self._by_ref[reference_num].append(i)
+            self._by_name[label.full_name].append(i)
+            self._referenced.append(referenced)
+            if not referenced:
+                self._unreferenced_names[label.full_name.upper()] += 1
+        self._names = [label.full_name for label in labels]
+
+    # Index of the label for this slip in labels, or -1 when no unused label matches it
+    def match(self, slip: PackingSlip) -> int:
+        label_index = self._first_unused(self._by_ref, str(slip.reference_num).strip())
+        if label_index == -1 and self._unreferenced_names.get(slip.name.upper(), 0) > 0:
+            label_index = self._first_unused(self._by_name, slip.name.upper())
+
+        if label_index != -1:
+            self._use(label_index)
+        return label_index
+
+    def _first_unused(self, index: Dict[str, deque], key: str) -> int:
+        candidates = index.get(key)
+        while candidates:
+            if not self._used[candidates[0]]:
+                return candidates[0]
+            candidates.popleft()
+        return -1
 
-    for (i, (order, ship)) in enumerate(zip(order_info_list, ship_to_list)):
-        reference_num = str(order[0][0])
+    def _use(self, label_index: int) -> None:
+        self._used[label_index] = True
+        if not self._referenced[label_index]:
+            self._unreferenced_names[self._names[label_index].upper()] -= 1
+
+
+# The 5 digit ZIP code in a city/state/zip line, "" when there is none
+def _zip_code(city_state_zip) -> str:
+    match = re.search(r"\b(\d{5})(?:-\d{4})?\b", str(city_state_zip))
+    return match.group(1) if match else ""
+
+
+# Reference number to compare on, "" when it is missing
+def _reference_key(reference_num) -> str:
+    reference_num = str(reference_num).strip()
+    return "" if reference_num.upper() in ("", "N/A", "NAN") else reference_num
+
+
+# Keys a slip or label can be paired on. Without a ZIP code, the name prefix only links it to others without one.
+def _blocking_keys(reference_num: str, name: str, zip_code: str) -> List[Tuple[str, ...]]:
+    keys = []
+    if reference_num:
+        keys.append(("ref", reference_num))
+    if name:
+        keys.append(("zip_name", zip_code, name[:NAME_BLOCK_PREFIX]))
+    return keys
+
+
+# Pairs slips with labels for the best total score over reference number, name, address and ZIP, instead of
+# letting every slip take the first label that fits. Returns the label index for every slip, -1 for unmatched ones.
+def matchLabelsOptimally(slips: List[PackingSlip], labels: List[ShippingLabel]) -> List[int]:
+    slip_refs = [_reference_key(slip.reference_num) for slip in slips]
+    label_refs = [_reference_key(label.reference_num) for label in labels]
+    slip_names = [str(slip.name) for slip in slips]
+    label_names = [label.full_name for label in labels]
+    slip_addrs = [str(slip.addr).upper() for slip in slips]
+    label_addrs = [label.addr_line1.upper() for label in labels]
+    slip_zips = [_zip_code(slip.city_state_zip) for slip in slips]
+    label_zips = [_zip_code(label.addr_line2) for label in labels]
+
+    def score_block(slip_indices: List[int], label_indices: List[int]) -> np.ndarray:
+        names = process.cdist([slip_names[i] for i in slip_indices], [label_names[j] for j in label_indices],
+                              scorer=fuzz.ratio) / 100
+        addrs = process.cdist([slip_addrs[i] for i in slip_indices], [label_addrs[j] for j in label_indices],
+                              scorer=fuzz.ratio) / 100
+        refs = np.array([[slip_refs[i] != "" and slip_refs[i] == label_refs[j] for j in label_indices]
+                         for i in slip_indices], dtype=bool)
+        zips = np.array([[slip_zips[i] != "" and slip_zips[i] == label_zips[j] for j in label_indices]
+                         for i in slip_indices], dtype=bool)
+
+        score = REFERENCE_WEIGHT * refs + NAME_WEIGHT * names + ADDRESS_WEIGHT * addrs + ZIP_WEIGHT * zips
+        # Never pair a slip with a label that has neither its reference number nor a similar name
+        score[~refs & (names < MIN_NAME_SIMILARITY)] = -1
+        return score
+
+    slip_keys = [_blocking_keys(*key) for key in zip(slip_refs, slip_names, slip_zips)]
+    label_keys = [_blocking_keys(*key) for key in zip(label_refs, label_names, label_zips)]
+    return assignment.assign(slip_keys, label_keys, score_block, min_score=0)
+
+
+# Inverted index of the words on every label page, for finding the pages a name is on without scanning them all.
+# Lookups give exactly the pages where the lower case text occurs as a substring, like `text in page.lower()`.
+class LabelTextIndex:
+    # Length of the letter sequences that point from a piece of a word to the page words containing it
+    GRAM_LENGTH = 3
+
+    def __init__(self, label_texts: List[str]):
+        self.texts = [(text or "").lower() for text in label_texts]
+        self._pages_of_word: Dict[str, Set[int]] = defaultdict(set)
+        for page, text in enumerate(self.texts):
+            for word in text.split():
+                self._pages_of_word[word].add(page)
+
+        self._words_of_gram: Dict[str, Set[str]] = defaultdict(set)
+        for word in self._pages_of_word:
+            for start in range(len(word) - self.GRAM_LENGTH + 1):
+                self._words_of_gram[word[start:start + self.GRAM_LENGTH]].add(word)
+        self._word_lookups: Dict[str, Set[int]] = {}
+
+    # Pages with text (lower case) in them, in page order
+    def pages_containing(self, text: str) -> List[int]:
+        # Every word of text can only be found inside one word of a page, so only pages with all of them can match
+        words = text.split()
+        if not words:
+            candidates = set(range(len(self.texts)))
+        else:
+            candidates = set.intersection(*(self._pages_with_piece(word) for word in words))
+        if words == [text]:
+            return sorted(candidates)
+        return [page for page in sorted(candidates) if text in self.texts[page]]
+
+    # Pages with a word that has piece (no whitespace) in it
+    def _pages_with_piece(self, piece: str) -> Set[int]:
+        if piece not in self._word_lookups:
+            if len(piece) < self.GRAM_LENGTH:
+                words = self._pages_of_word.keys()
+            else:
+                grams = [self._words_of_gram.get(piece[start:start + self.GRAM_LENGTH], set())
+                         for start in range(len(piece) - self.GRAM_LENGTH + 1)]
+                words = set.intersection(*sorted(grams, key=len))
+            pages = set()
+            for word in words:
+                if piece in word:
+                    pages |= self._pages_of_word[word]
+            self._word_lookups[piece] = pages
+        return self._word_lookups[piece]
+
+
+# Greedy pairing of label pages with slips: every page, in order, takes the first slip that is still left and
+# whose page_scores has the page. Returns (slips in label page order, slips without a label).
+def matchSlipsToLabelPages(slips: List[PackingSlip], page_scores: List[Dict[int, float]],
+                           page_count: int) -> Tuple[List[PackingSlip], List[PackingSlip]]:
+    slips_on_page = defaultdict(list)
+    for i, scores in enumerate(page_scores):
+        for page in scores:
+            slips_on_page[page].append(i)
+
+    used = [False] * len(slips)
+    ordered = []
+    for page in range(page_count):
+        for i in slips_on_page.get(page, ()):
+            if not used[i]:
+                used[i] = True
+                ordered.append(slips[i])
+                break
+    return ordered, [slip for i, slip in enumerate(slips) if not used[i]]
 
-        name = ship[2][0]
-        addr = ship[2][1]
-        city_state_zip = ship[2][2]
 
-        ret_list.append(PackingSlip(name, addr, city_state_zip,
-                        reference_num[-4:], page=i))
+# Pairs every label page with at most one slip for the most total score over all pages. page_scores holds
+# {page: score} for every slip, only for the pages it can be paired with. Returns (slips in label page order,
+# slips without a label), like matchSlipsToLabelPages.
+def matchSlipsToLabelTexts(slips: List[PackingSlip], page_scores: List[Dict[int, float]],
+                           page_count: int) -> Tuple[List[PackingSlip], List[PackingSlip]]:
+    # Only pages and slips that could be paired end up in the same block
+    page_keys = [[] for _ in range(page_count)]
+    slip_keys = [[i] for i in range(len(slips))]
+    for i, scores in enumerate(page_scores):
+        for page in scores:
+            page_keys[page].append(i)
 
-    return ret_list
+    def score_block(pages: List[int], slip_indices: List[int]) -> np.ndarray:
+        return np.array([[page_scores[i].get(page, -1.0) for i in slip_indices] for page in pages])
 
-# endregion
+    slip_of_page = assignment.assign(page_keys, slip_keys, score_block, min_score=0)
+    ordered = [slips[i] for i in slip_of_page if i != -1]
+    paired = set(slip_of_page)
+    return ordered, [slip for i, slip in enumerate(slips) if i not in paired]
 
 
-def processAndSortPackingSlips(mode: Mode) -> Tuple[List[PackingSlip], List[PackingSlip]]:
+# With pipelined, the labels are rendered and read page by page on worker threads while tabula reads the slips
+def processAndSortPackingSlips(mode: Mode, match_mode: str = "greedy",
+                               pipelined: bool = False) -> Tuple[List[PackingSlip], List[PackingSlip]]:
 
     slips: List[PackingSlip] = []
 
-    if mode.name == Store.Target.name:
-        slips = processTargetPackingSlips(mode)
-    elif mode.name == Store.Belk.name:
-        #slips = processBelkPackingSlips(mode)
-        return belk_sort(mode)
-    elif mode.name == Store.HSN.name:
-        slips = processHsnPackingSlips(mode)
-    elif mode.name in [Store.Hibbett.name, Store.GSI.name]:
-        slips = processHibbettPackingSlips(mode)
-    # otherwise bedbath
+    if mode.name == Store.Belk.name:
+        #slips = processPackingSlips(mode)
+        return belk_sort(mode, match_mode)
+    elif mode.name == Store.BedBath.name:
+        return bedbath_sort(mode, match_mode)
+        #slips = processPackingSlips(mode)
+    # Target, HSN, Hibbett and GSI
+    elif pipelined:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            parsed_labels = executor.submit(parseShippingLabel, mode, True)
+            slips = processPackingSlips(mode)
+            label_output, label_errors = parsed_labels.result()
     else:
-        return bedbath_sort(mode)
-        #slips = processBedBathPackingSlips(mode)
+        slips = processPackingSlips(mode)
+        label_output, label_errors = parseShippingLabel(mode)
 
-    label_output, label_errors = parseShippingLabel(mode)
     labels: List[ShippingLabel] = checkShippingLabels(
         label_output, label_errors, slips)
 
@@ -583,17 +833,12 @@ def processAndSortPackingSlips(mode: Mode) -> Tuple[List[PackingSlip], List[Pack
     for slip in slips:
         slip.name = slip.name.replace(" ", "").upper()
 
-    non_matching = []
-    # We want to make sure that we're removing labels from the pool every time we match one to a slip, in case two have the same name.
-    unused_labels = labels.copy()
-
-    # This list contains all the labels that have reference numbers.
-    labels_with_ref_nums = [label for label in labels if str(
-        label.reference_num).strip() in [str(slip.reference_num).strip() for slip in slips]]
+    # Reference numbers of all the slips. Labels with one of these are matched by reference number.
+    slip_reference_nums = {str(slip.reference_num).strip() for slip in slips}
 
     # If two orders without valid reference numbers have the same name, then things could go poorly. Give a warning.
     _names = [
-        label.full_name for label in unused_labels if label not in labels_with_ref_nums]
+        label.full_name for label in labels if str(label.reference_num).strip() not in slip_reference_nums]
     if len(set(_names)) != len(_names):
         # Leave all the duplicates in the list
         for name in set(_names):
@@ -605,34 +850,21 @@ def processAndSortPackingSlips(mode: Mode) -> Tuple[List[PackingSlip], List[Pack
             print(name)
         print("----")
 
-    def get_slip_key(slip: PackingSlip) -> int:
-        names = [
-            label.full_name.upper() for label in unused_labels if label not in labels_with_ref_nums]
-        order_numbers = [str(label.reference_num).strip()
-                         for label in unused_labels]
-
-        if str(slip.reference_num).strip() in order_numbers:
-            label = [label for label in unused_labels if str(
-                slip.reference_num).strip() == str(label.reference_num).strip()][0]
-            unused_labels.remove(label)
-            return labels.index(label)
-
-        if slip.name.upper() in names:
-            label = [label for label in unused_labels if slip.name.upper()
-                     == label.full_name][0]
-            unused_labels.remove(label)
-            return labels.index(label)
-
-        # We want to separate all of the non-sorted slips.
-        non_matching.append(slip)
-
-        return -1
+    # Index of the matching label for every slip, -1 for slips without one
+    with metrics.timer("match"), profiling.stage("matching"):
+        if match_mode == "optimal":
+            label_indices = matchLabelsOptimally(slips, labels)
+        else:
+            matcher = LabelMatcher(labels, slip_reference_nums)
+            label_indices = [matcher.match(slip) for slip in slips]
 
-    ordered = sorted(slips, key=get_slip_key)
-    # Remove slips without matching labels
-    for slip in non_matching:
-        ordered.remove(slip)
+    # We want to separate all of the non-sorted slips.
+    non_matching = [slip for slip, label_index in zip(slips, label_indices) if label_index == -1]
+    matched = [(label_index, slip) for slip, label_index in zip(slips, label_indices) if label_index != -1]
+    ordered = [slip for _, slip in sorted(matched, key=lambda pair: pair[0])]
 
+    metrics.count("slips_matched", len(ordered))
+    metrics.count("slips_unmatched", len(non_matching))
     return ordered, non_matching
 
 
@@ -642,53 +874,40 @@ def exportPackingSlips(mode: Mode, slips: List[PackingSlip], no_match: List[Pack
         print("ERROR: No matches. Exiting..")
         return
 
-    unordered_file = open(mode.slips_path, "rb")
-    unordered_pdf = PdfFileReader(unordered_file)
+    unordered_pdf = PdfReader(mode.slips_path)
 
-    writer = PdfFileWriter()
     path = os.path.expanduser("~/Desktop")
     path = os.path.join(path, mode.name + "_reordered.pdf")
-    with open(path, "wb") as file:
-        for slip in slips:
-            page = unordered_pdf.getPage(slip.page)
-            writer.addPage(page)
-        writer.write(file)
+    pdf_output.write_pages(unordered_pdf, [slip.page for slip in slips], path)
 
     print(f"saved sorted packing slips to {mode.name}_reordered.pdf")
 
     # Don't make an empty PDF if there are no empty matches
     if len(no_match) == 0:
-        unordered_file.close()
         return
 
-    writer = PdfFileWriter()
     path = os.path.expanduser("~/Desktop")
     path = os.path.join(path, mode.name + "_noMatch.pdf")
-    with open(path, "wb") as file:
-        for slip in no_match:
-            page = unordered_pdf.getPage(slip.page)
-            writer.addPage(page)
-        writer.write(file)
+    pdf_output.write_pages(unordered_pdf, [slip.page for slip in no_match], path)
 
     print(
         f"saved packing slips without matching labels to {mode.name}_noMatch.pdf")
 
-    unordered_file.close()
-
 
 def read_reference_number_ups(image: Image, retailer_name: str) -> str:
     # expected coords for reference number
     coords = (0, 2820, 700, 2970)
-    cropped_image = image.crop(coords)
+    with metrics.timer("crop"):
+        cropped_image = image.crop(coords)
 
     # Only include relevant characters; this keeps OCR on course
     # DPI 300 is just an approximation
     # PSM level 6 means "Assume a single uniform block of text."
-    text = str(pytesseract.image_to_string(cropped_image,
-                                           config='''
+    text = ocr_cache.cached_image_to_string(cropped_image,
+                                            config='''
                           -c tessedit_char_whitelist="Trx Ref No.: 1234567890" 
                           --dpi 300 
-                          --psm 6'''))
+                          --psm 6''')
 
     fullRefNoSplit = text.split("Trx Ref No.: ")
     partialRefNoSplit = text.split("No")
@@ -713,9 +932,10 @@ def read_reference_number_ups(image: Image, retailer_name: str) -> str:
 
 
 def read_reference_number_fedex(image: Image, coords=(792, 842, 1122, 912)) -> str:
-    cropped_image = image.crop(coords).convert("L")
+    with metrics.timer("crop"):
+        cropped_image = image.crop(coords).convert("L")
 
-    text = str(pytesseract.image_to_string(cropped_image))
+    text = ocr_cache.cached_image_to_string(cropped_image)
 
     fullRefNoSplit = text.split("REF:")
     bedBathNoSplit = text.split("INV:")
@@ -746,6 +966,28 @@ def Main():
     parser.add_argument('-l', required=False, dest='shippingLabels',
                         metavar='labels', help='The PDF for the shipping labels')
     parser.add_argument('-o', default='slips_reordered.pdf')
+    parser.add_argument('--ocr-backend', default=ocr_backend.DEFAULT_BACKEND, dest='ocrBackend',
+                        choices=['auto'] + list(ocr_backend.BACKENDS),
+                        help='OCR engine. tesserocr keeps tesseract loaded instead of starting it for every crop')
+    parser.add_argument('--no-cache', action='store_true', dest='noCache',
+                        help='Always run OCR instead of reusing results from earlier runs')
+    parser.add_argument('--clear-cache', action='store_true', dest='clearCache',
+                        help='Empty the OCR result cache before sorting')
+    parser.add_argument('--match-mode', default="greedy", dest='matchMode', choices=MATCH_MODES,
+                        help='greedy gives every slip the first label that fits it, '
+                             'optimal pairs all slips and labels for the best overall fit')
+    parser.add_argument('--pipeline', action='store_true', dest='pipeline',
+                        help='Render and read label pages at the same time, while the packing slips are read, '
+                             'and report how busy each stage was')
+    parser.add_argument('--metrics', dest='metricsFile',
+                        help='Time every stage and write the timings and counters to this file at the end, '
+                             'as JSON for a .json file and as a Prometheus textfile otherwise')
+    parser.add_argument('--profile', nargs='?', const='profile', dest='profileDir', metavar='dir',
+                        help='Profile the slips, labels, matching and export stages, writing a .pstats and a '
+                             '.collapsed stack file per stage to dir (default ./profile), and print the hottest '
+                             'functions of each')
+    parser.add_argument('--profile-top', type=int, default=profiling.DEFAULT_TOP, dest='profileTop',
+                        help='Number of functions listed per stage in the profile summary')
     # TODO: add option for selecting store
 
     args = parser.parse_args()
@@ -760,66 +1002,85 @@ def Main():
     args.packingSlips = args.packingSlips.strip()
     args.shippingLabels = args.shippingLabels.strip()
 
+    if args.metricsFile:
+        metrics.enable()
+    ocr_backend.set_backend(args.ocrBackend)
+    if args.clearCache:
+        ocr_cache.clear()
+    if not args.noCache:
+        ocr_cache.configure()
     mode = get_mode(args.packingSlips, args.shippingLabels)
 
-    sorted_slips, no_match = processAndSortPackingSlips(mode)
-    exportPackingSlips(mode, sorted_slips, no_match)
+    if args.profileDir:
+        profiling.start(args.profileDir)
+    try:
+        sorted_slips, no_match = processAndSortPackingSlips(mode, args.matchMode, args.pipeline)
+        with profiling.stage("export"):
+            exportPackingSlips(mode, sorted_slips, no_match)
+    finally:
+        # Also written when the run fails or is interrupted with Ctrl+C
+        profiling.finish(args.profileTop)
+
+    if args.metricsFile:
+        metrics.export(args.metricsFile)
+        print(metrics.report())
+        print(f"Metrics written to {args.metricsFile}")
+
+# {page: number of the slip's name words on it}, for the pages with at least two of them
+def _bedbathPageScores(index: LabelTextIndex, slip: PackingSlip) -> Dict[int, float]:
+    counts = defaultdict(int)
+    for name in slip.name:
+        for page in index.pages_containing(name.lower()):
+            counts[page] += 1
+    return {page: float(count) for page, count in counts.items() if count >= 2}
+
+
+# {page: 1} for the pages with the slip's full name on them
+def _belkPageScores(index: LabelTextIndex, slip: PackingSlip) -> Dict[int, float]:
+    return {page: 1.0 for page in index.pages_containing(slip.name.lower())}
+
 
-def bedbath_sort(mode):
-    sorted = []
+def bedbath_sort(mode, match_mode="greedy"):
     slips = []
-    with pdfplumber.open(mode.slips_path) as pdf:
-        for index, page in enumerate(pdf.pages):
-            text = page.extract_text()
+    with profiling.stage("slips"):
+        for page_index, text in enumerate(page_text.page_texts(mode.slips_path)):
             lines = text.split('\n')
             for ind, line in enumerate(lines):
                 if 'Ordered By: Shipped To:' in line:
                     name = lines[ind + 1].split(' ')
                     break
 
-            slip = PackingSlip(name, 'n/a', 'n/a', 'n/a', page.page_number-1)
+            slip = PackingSlip(name, 'n/a', 'n/a', 'n/a', page_index)
             slips.append(slip)
-            
-    with pdfplumber.open(mode.labels_path) as pdf:
-        for page in pdf.pages:        
-            text = page.extract_text()
-
-            for index, slip in enumerate(slips):
-                count = 0
-                for name in slip.name:
-                    if name.lower() in text.lower():
-                        count += 1
-                        if count >= 2:
-                            sorted.append(slip)
-                            slips.pop(index)
-                            break
-                if count >= 2:
-                    break
 
-    return (sorted, slips)
+    with profiling.stage("labels"):
+        label_index = LabelTextIndex(page_text.page_texts(mode.labels_path))
+
+    with profiling.stage("matching"):
+        # A label is for a slip when at least two of the slip's name words are on it
+        page_scores = [_bedbathPageScores(label_index, slip) for slip in slips]
+        if match_mode == "optimal":
+            return matchSlipsToLabelTexts(slips, page_scores, len(label_index.texts))
+        return matchSlipsToLabelPages(slips, page_scores, len(label_index.texts))
 
-def belk_sort(mode):
+def belk_sort(mode, match_mode="greedy"):
     slips = []
-    ordered_slips = []
-    with pdfplumber.open(mode.slips_path) as pdf:
-        for page in pdf.pages:
-            text = page.extract_text()
+    with profiling.stage("slips"):
+        for page_index, text in enumerate(page_text.page_texts(mode.slips_path)):
             name = text.split('\n')[1]
             name = name.split(" ")
             name = f'{name[0]} {name[1]}'
-            slip = PackingSlip(name, 'n/a', 'n/a', 'n/a', page.page_number-1)
+            slip = PackingSlip(name, 'n/a', 'n/a', 'n/a', page_index)
             slips.append(slip)
-            
-    with pdfplumber.open(mode.labels_path) as pdf:
-        for page in pdf.pages:        
-            text = page.extract_text()
-            for ind, slip in enumerate(slips):
-                if slip.name.lower() in text.lower():
-                    ordered_slips.append(slip)
-                    slips.pop(ind)
-                    break
-    
-    return (ordered_slips, slips)
+
+    with profiling.stage("labels"):
+        label_index = LabelTextIndex(page_text.page_texts(mode.labels_path))
+
+    with profiling.stage("matching"):
+        page_scores = [_belkPageScores(label_index, slip) for slip in slips]
+        if match_mode == "optimal":
+            return matchSlipsToLabelTexts(slips, page_scores, len(label_index.texts))
+        return matchSlipsToLabelPages(slips, page_scores, len(label_index.texts))
 
 if __name__ == "__main__":
     Main()
@@ -0,0 +1,205 @@
+# \package pdfOutput
+#
+#     \brief   Writes pages picked from input pdfs to a new pdf one page at a time.
+#
+#     PdfWriter keeps every copied page, and every image on it, in memory until the whole document is written.
+#     PageStreamWriter writes the objects of a page to the output file as soon as the page is added, and lets
+#     the reader drop the streams it has copied. Objects are copied by reference, once per output file however
+#     many pages point at them, and streams with identical content (the same font or logo embedded again for
+#     every label) are written once and shared by all the pages that use them.
+#     The pages go to a temporary file next to the output, which only replaces the output once it is complete,
+#     so a failed write leaves whatever was at output_path before, never a truncated pdf.
+#
+
+import hashlib
+import os
+from io import BytesIO
+from typing import Dict, Iterable, List, Tuple
+
+from PyPDF2 import PageObject, PdfReader
+from PyPDF2.generic import (ArrayObject, DictionaryObject, IndirectObject, NameObject, NullObject, NumberObject,
+                            PdfObject, StreamObject)
+
+import metrics
+
+PDF_HEADER = b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n"
+CATALOG_NUMBER = 1
+PAGE_TREE_NUMBER = 2
+# Page keys that tie a page to the document it came from. Inherited attributes are already on the
+# pages PdfReader returns, so the page stands on its own without its old parent.
+EXCLUDED_PAGE_KEYS = ("/Parent", "/StructParents")
+
+SourceKey = Tuple[int, int, int]  # (id of the reader, object number, generation)
+
+
+class PageStreamWriter:
+    def __init__(self, output_path: str):
+        self.output_path = output_path
+        if os.path.exists(output_path):
+            # Fail now, not after every page is written, when the output is held open elsewhere (a pdf viewer)
+            open(output_path, "r+b").close()
+        self._temp_path = f"{output_path}.{os.getpid()}.part"
+        self._file = open(self._temp_path, "wb")
+        self._file.write(PDF_HEADER)
+        self._offsets: Dict[int, int] = {}
+        self._next_number = PAGE_TREE_NUMBER + 1
+        # Objects of the input files already in the output, and where
+        self._copied: Dict[SourceKey, IndirectObject] = {}
+        # Streams already in the output, by a hash of what was written for them
+        self._streams: Dict[str, IndirectObject] = {}
+        self._page_refs: List[IndirectObject] = []
+        # Streams copied for the current page, to be dropped from their reader once the page is written
+        self._released: List[Tuple[PdfReader, int, int]] = []
+
+    def __enter__(self) -> "PageStreamWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is not None:
+            self.discard()
+            return
+        try:
+            self.close()
+        except BaseException:
+            self.discard()
+            raise
+
+    def add_page(self, page: PageObject) -> None:
+        ref = self._allocate()
+        if page.indirect_reference is not None:
+            # Annotations point back at their page, they should find this copy of it
+            self._copied[self._source_key(page.indirect_reference)] = ref
+        copy = DictionaryObject()
+        for key, value in page.items():
+            if key not in EXCLUDED_PAGE_KEYS:
+                copy[NameObject(key)] = self._copy(value)
+        copy[NameObject("/Parent")] = IndirectObject(PAGE_TREE_NUMBER, 0, self)
+        self._write_object(ref.idnum, copy)
+        self._page_refs.append(ref)
+
+        for reader, idnum, generation in self._released:
+            reader.resolved_objects.pop((generation, idnum), None)
+        self._released = []
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        pages = DictionaryObject({
+            NameObject("/Type"): NameObject("/Pages"),
+            NameObject("/Kids"): ArrayObject(self._page_refs),
+            NameObject("/Count"): NumberObject(len(self._page_refs)),
+        })
+        self._write_object(PAGE_TREE_NUMBER, pages)
+        catalog = DictionaryObject({
+            NameObject("/Type"): NameObject("/Catalog"),
+            NameObject("/Pages"): IndirectObject(PAGE_TREE_NUMBER, 0, self),
+        })
+        self._write_object(CATALOG_NUMBER, catalog)
+
+        xref_offset = self._file.tell()
+        self._file.write(b"xref\n0 %d\n" % self._next_number)
+        self._file.write(b"0000000000 65535 f \n")
+        for number in range(1, self._next_number):
+            self._file.write(b"%010d 00000 n \n" % self._offsets[number])
+        trailer = DictionaryObject({
+            NameObject("/Size"): NumberObject(self._next_number),
+            NameObject("/Root"): IndirectObject(CATALOG_NUMBER, 0, self),
+        })
+        self._file.write(b"trailer\n")
+        trailer.write_to_stream(self._file, None)
+        self._file.write(b"\nstartxref\n%d\n%%%%EOF\n" % xref_offset)
+        self._file.close()
+        os.replace(self._temp_path, self.output_path)
+
+    # Give up on the output: the pages written so far are deleted and output_path is left as it was
+    def discard(self) -> None:
+        self._file.close()
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+    def _allocate(self) -> IndirectObject:
+        ref = IndirectObject(self._next_number, 0, self)
+        self._next_number += 1
+        return ref
+
+    @staticmethod
+    def _source_key(ref: IndirectObject) -> SourceKey:
+        return id(ref.pdf), ref.idnum, ref.generation
+
+    def _copy(self, obj: PdfObject) -> PdfObject:
+        if isinstance(obj, IndirectObject):
+            return self._copy_indirect(obj)
+        if isinstance(obj, StreamObject):
+            # Pages built in memory rather than read from a file hold their streams directly
+            return self._copy_stream(obj)
+        if isinstance(obj, DictionaryObject):
+            return DictionaryObject({NameObject(key): self._copy(value) for key, value in obj.items()})
+        if isinstance(obj, ArrayObject):
+            return ArrayObject([self._copy(item) for item in obj])
+        return obj
+
+    def _copy_indirect(self, ref: IndirectObject) -> PdfObject:
+        key = self._source_key(ref)
+        if key in self._copied:
+            return self._copied[key]
+
+        obj = ref.get_object()
+        if obj is None or isinstance(obj, NullObject):
+            return NullObject()
+        if isinstance(obj, DictionaryObject) and obj.get("/Type") in ("/Page", "/Pages"):
+            # A link to a page that is not in the output, or up into the page tree of the input
+            return NullObject()
+        if isinstance(obj, StreamObject):
+            copy = self._copy_stream(obj)
+            self._released.append((ref.pdf, ref.idnum, ref.generation))
+            self._copied[key] = copy
+            return copy
+
+        copy = self._allocate()
+        # Registered before the object is copied, so references back to it end here
+        self._copied[key] = copy
+        self._write_object(copy.idnum, self._copy(obj))
+        return copy
+
+    def _copy_stream(self, stream: StreamObject) -> IndirectObject:
+        copy = StreamObject()
+        for key, value in stream.items():
+            if key != "/Length":
+                copy[NameObject(key)] = self._copy(value)
+        # Still encoded, written back as it was read
+        copy._data = stream._data
+
+        data = BytesIO()
+        copy.write_to_stream(data, None)
+        data = data.getvalue()
+        digest = hashlib.sha1(data).hexdigest()
+        if digest not in self._streams:
+            ref = self._allocate()
+            self._write_bytes(ref.idnum, data)
+            self._streams[digest] = ref
+        return self._streams[digest]
+
+    def _write_object(self, number: int, obj: PdfObject) -> None:
+        data = BytesIO()
+        obj.write_to_stream(data, None)
+        self._write_bytes(number, data.getvalue())
+
+    def _write_bytes(self, number: int, data: bytes) -> None:
+        self._offsets[number] = self._file.tell()
+        self._file.write(b"%d 0 obj\n" % number)
+        self._file.write(data)
+        self._file.write(b"\nendobj\n")
+
+
+# Write pages page_indices (0-based, in that order) of reader to output_path
+@metrics.timed("pdf_write")
+def write_pages(reader: PdfReader, page_indices: Iterable[int], output_path: str) -> None:
+    with PageStreamWriter(output_path) as writer:
+        add_pages(writer, reader, page_indices)
+
+
+# Add pages page_indices (0-based, in that order) of reader to an open writer
+def add_pages(writer: PageStreamWriter, reader: PdfReader, page_indices: Iterable[int]) -> None:
+    for index in page_indices:
+        writer.add_page(reader.pages[index])
+        metrics.count("pages_written")
@@ -0,0 +1,182 @@
+# \package pipeline
+#
+#     \brief   Runs the stages of a batch (render, OCR, match) at the same time, each on different items.
+#
+#     Every stage has its own worker threads and hands its results to the next stage through a bounded queue,
+#     so poppler can render one page while tesseract reads the one before it and the one before that is looked
+#     up. A full queue holds the stage in front of it back, which keeps the number of rendered images in memory
+#     fixed. Rendering and OCR run in poppler/tesseract subprocesses or release the GIL, so threads are enough.
+#     Every worker records how long it spent working, waiting for input and waiting for room downstream.
+#
+
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+# Seconds between checks whether the pipeline was stopped, while blocked on a queue
+POLL_INTERVAL = 0.1
+
+# Marks the end of the items in a queue
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    name: str
+    function: Callable[[Any], Any]
+    workers: int = 1
+
+
+@dataclass
+class StageStats:
+    name: str
+    workers: int
+    items: int = 0
+    # Seconds, summed over the workers of the stage
+    busy: float = 0.0
+    # Waiting for the stage before to hand over an item
+    starved: float = 0.0
+    # Waiting for room in the queue to the stage after
+    blocked: float = 0.0
+
+    # Share of the stage's worker time spent working
+    def utilization(self, wall_time: float) -> float:
+        if wall_time <= 0:
+            return 0.0
+        return self.busy / (wall_time * self.workers)
+
+
+class _Stopped(Exception):
+    pass
+
+
+class Pipeline:
+    # queue_size is the number of items waiting in front of each stage, 2 per worker of that stage by default
+    def __init__(self, stages: List[Stage], queue_size: int = 0):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stats = [StageStats(stage.name, max(1, stage.workers)) for stage in stages]
+        self.wall_time = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    # Feed items through every stage. Yields the results of the last stage in the order of items.
+    def run(self, items: Iterable) -> Iterator:
+        self._stop.clear()
+        self._error = None
+        queues = [queue.Queue(maxsize=self.queue_size or 2 * stats.workers) for stats in self.stats]
+        results: queue.Queue = queue.Queue()
+        queues.append(results)
+        # Workers of a stage still running, the last one to finish passes the end on
+        running = [stats.workers for stats in self.stats]
+
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]), daemon=True)]
+        for n, (stage, stats) in enumerate(zip(self.stages, self.stats)):
+            for _ in range(stats.workers):
+                threads.append(threading.Thread(target=self._work, args=(n, stage, stats, queues, running),
+                                                name=f"pipeline-{stage.name}", daemon=True))
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            # Results come out of order when a stage has several workers, hold them until their turn
+            waiting: Dict[int, Any] = {}
+            next_index = 0
+            while True:
+                item = self._get(results)
+                if item is _DONE:
+                    break
+                index, result = item
+                waiting[index] = result
+                while next_index in waiting:
+                    yield waiting.pop(next_index)
+                    next_index += 1
+        except _Stopped:
+            pass
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            self.wall_time = time.perf_counter() - start
+        if self._error is not None:
+            raise self._error
+
+    def report(self) -> str:
+        lines = [f"{'stage':<12}{'workers':>8}{'items':>8}{'busy':>10}{'starved':>10}{'blocked':>10}{'util':>7}"]
+        for stats in self.stats:
+            lines.append(f"{stats.name:<12}{stats.workers:>8}{stats.items:>8}{stats.busy:>9.1f}s"
+                         f"{stats.starved:>9.1f}s{stats.blocked:>9.1f}s{stats.utilization(self.wall_time):>7.0%}")
+        lines.append(f"wall time {self.wall_time:.1f}s")
+        return "\n".join(lines)
+
+    def _feed(self, items: Iterable, first: queue.Queue) -> None:
+        try:
+            for item in enumerate(items):
+                self._put(first, item)
+            for _ in range(self.stats[0].workers):
+                self._put(first, _DONE)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            self._fail(e)
+
+    def _work(self, n: int, stage: Stage, stats: StageStats, queues: List[queue.Queue], running: List[int]) -> None:
+        source, target = queues[n], queues[n + 1]
+        try:
+            while True:
+                waited = time.perf_counter()
+                item = self._get(source)
+                started = time.perf_counter()
+                with self._lock:
+                    stats.starved += started - waited
+                if item is _DONE:
+                    break
+                index, value = item
+                result = stage.function(value)
+                finished = time.perf_counter()
+                self._put(target, (index, result))
+                with self._lock:
+                    stats.items += 1
+                    stats.busy += finished - started
+                    stats.blocked += time.perf_counter() - finished
+
+            with self._lock:
+                running[n] -= 1
+                last = running[n] == 0
+            if last:
+                next_workers = self.stats[n + 1].workers if n + 1 < len(self.stats) else 1
+                for _ in range(next_workers):
+                    self._put(target, _DONE)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            self._fail(e)
+
+    def _fail(self, error: BaseException) -> None:
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._stop.set()
+
+    def _get(self, source: queue.Queue):
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                return source.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                pass
+
+    def _put(self, target: queue.Queue, item) -> None:
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                target.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
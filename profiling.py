@@ -0,0 +1,253 @@
+# \package profiling
+#
+#     \brief   Profiles the named stages of a run (label parsing, slip parsing, matching, export) one by one.
+#
+#     Every stage gets its own cProfile profile, dumped as <stage>.pstats for pstats/snakeviz, and its own
+#     sampled call stacks, dumped as <stage>.collapsed in the "frame;frame;frame count" format flamegraph.pl,
+#     speedscope and py-spy use. Only one thread's stages are cProfiled at a time: before python 3.12 a profile
+#     only sees the thread that enabled it, from 3.12 on it sees every thread and only one can run at all. A stage
+#     entered on another thread while one is being cProfiled (the --pipeline label thread next to slip parsing)
+#     is only sampled. The sampler looks at every thread of the process, so the pipeline's render and OCR threads
+#     show up under the stage that started them.
+#     Threads that are only waiting on a lock or a queue are left out of the samples, a thread waiting for a
+#     tesseract or poppler subprocess is not. Work done in other processes (the -j label workers) is not seen.
+#     Stages not being profiled cost a single check, so the stage markers stay in the code.
+#
+
+import contextlib
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional
+
+# Seconds between two samples of the call stacks
+SAMPLE_INTERVAL = 0.005
+DEFAULT_TOP = 15
+# A thread whose innermost python frame is in one of these files is blocked, not working
+IDLE_FILES = ("threading.py", "queue.py", "selectors.py")
+
+
+@dataclass
+class StageProfile:
+    name: str
+    # None when another profiler was already active and cProfile could not be started for this stage
+    profile: Optional[cProfile.Profile] = None
+    # Collapsed call stack -> number of samples
+    samples: Counter = field(default_factory=Counter)
+    wall_time: float = 0.0
+    # Part of wall_time spent next to a stage cProfiled on another thread, not in the profile
+    sampled_only_time: float = 0.0
+
+
+class Profiler:
+    def __init__(self, output_dir: str, sample_interval: float = SAMPLE_INTERVAL):
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.stages: Dict[str, StageProfile] = {}
+        self._lock = threading.Lock()
+        # Stages each thread is inside of, innermost last, by thread id
+        self._thread_stages: Dict[int, List[StageProfile]] = defaultdict(list)
+        # Every stage being run anywhere, latest entered last. Samples of threads outside of any stage go to the last.
+        self._active: List[StageProfile] = []
+        # The thread whose stages are being cProfiled, the others are only sampled until it leaves its stages
+        self._profiled_thread: Optional[int] = None
+        self._sampler: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        thread_id = threading.get_ident()
+        with self._lock:
+            stack = self._thread_stages[thread_id]
+            outer = stack[-1] if stack else None
+            if outer is not None and outer.name == name:
+                # Already inside this stage
+                outer = None
+                current = None
+            else:
+                current = self.stages.get(name)
+                if current is None:
+                    current = self.stages[name] = StageProfile(name, cProfile.Profile())
+                stack.append(current)
+                self._active.append(current)
+                if self._profiled_thread is None:
+                    self._profiled_thread = thread_id
+                profiled = self._profiled_thread == thread_id
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name="profiling-sampler", daemon=True)
+                self._sampler.start()
+        if current is None:
+            yield
+            return
+
+        if profiled:
+            # The outer stage's profile holds only its own time, not that of the stages inside it
+            if outer is not None and outer.profile is not None:
+                outer.profile.disable()
+            self._enable(current)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            current.wall_time += elapsed
+            if profiled:
+                if current.profile is not None:
+                    current.profile.disable()
+                if outer is not None:
+                    self._enable(outer)
+            else:
+                current.sampled_only_time += elapsed
+            with self._lock:
+                stack.pop()
+                self._active.remove(current)
+                if profiled and not stack:
+                    self._profiled_thread = None
+
+    @staticmethod
+    def _enable(stage: StageProfile) -> None:
+        if stage.profile is None:
+            return
+        try:
+            stage.profile.enable()
+        except ValueError:
+            # A profiler started outside of this one (python -m cProfile) already runs, from python 3.12 on
+            # there can only be one. The stage keeps its samples only.
+            print(f"Another profiler is running, {stage.name} is only sampled")
+            stage.profile = None
+
+    def _sample(self) -> None:
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        while not self._stop.wait(self.sample_interval):
+            frames = sys._current_frames()
+            with self._lock:
+                if not self._active:
+                    continue
+                latest = self._active[-1]
+                owners = {thread_id: stack[-1] for thread_id, stack in self._thread_stages.items() if stack}
+            for thread_id, frame in frames.items():
+                if thread_id == own_id or os.path.basename(frame.f_code.co_filename) in IDLE_FILES:
+                    continue
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                owners.get(thread_id, latest).samples[";".join(reversed(stack))] += 1
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    # Write <stage>.pstats and <stage>.collapsed for every stage. Returns the paths written.
+    def write(self) -> List[str]:
+        os.makedirs(self.output_dir, exist_ok=True)
+        paths = []
+        for stage in self.stages.values():
+            if stage.profile is not None:
+                path = os.path.join(self.output_dir, f"{stage.name}.pstats")
+                stage.profile.dump_stats(path)
+                paths.append(path)
+            path = os.path.join(self.output_dir, f"{stage.name}.collapsed")
+            with open(path, "w") as f:
+                for stack, samples in stage.samples.most_common():
+                    f.write(f"{stack} {samples}\n")
+            paths.append(path)
+        return paths
+
+    # The top functions of every stage by their own time, and that time added up per package
+    def summary(self, top: int = DEFAULT_TOP) -> str:
+        lines = []
+        for stage in self.stages.values():
+            lines.append(f"== {stage.name}: {stage.wall_time:.2f}s, {sum(stage.samples.values())} samples")
+            if stage.sampled_only_time:
+                lines.append(f"{stage.sampled_only_time:.2f}s of it ran next to a stage profiled on another thread "
+                             f"and is only in the samples")
+            if stage.profile is None:
+                continue
+            try:
+                stats = pstats.Stats(stage.profile).stats
+            except TypeError:
+                # Nothing was recorded
+                continue
+            lines.append(f"{'own':>9}{'total':>9}{'calls':>9}  function")
+            by_own_time = sorted(stats.items(), key=lambda item: -item[1][2])
+            for (file_name, line, function), (_, calls, own, total, _) in by_own_time[:top]:
+                lines.append(f"{own:>8.2f}s{total:>8.2f}s{calls:>9}  {_function_name(file_name, line, function)}")
+
+            packages = Counter()
+            for (file_name, _, _), (_, _, own, _, callers) in stats.items():
+                if file_name == "~" and callers:
+                    # Built in functions count for whoever called them most, subprocess for waitpid and read
+                    file_name = max(callers.items(), key=lambda caller: caller[1][3])[0][0]
+                packages[_package(file_name)] += own
+            lines.append("own time by package: " + ", ".join(f"{package} {seconds:.2f}s"
+                                                             for package, seconds in packages.most_common(8)))
+        return "\n".join(lines)
+
+
+def _function_name(file_name: str, line: int, function: str) -> str:
+    if file_name == "~":
+        # Built in functions, e.g. "<method 'poll' of 'select.poll' objects>"
+        return function
+    return f"{function} ({os.path.basename(file_name)}:{line})"
+
+
+# Top level package of a profiled function: the site-packages package (PIL, pandas, pytesseract, ...),
+# the standard library module (subprocess, where waiting for tesseract shows up), or this repo's module
+def _package(file_name: str) -> str:
+    if file_name == "~":
+        return "builtins"
+    if file_name.startswith("<"):
+        # "<frozen importlib._bootstrap>", "<string>"
+        return file_name
+    parts = os.path.normpath(file_name).split(os.sep)
+    for marker in ("site-packages", "dist-packages"):
+        if marker in parts[:-1]:
+            return os.path.splitext(parts[parts.index(marker) + 1])[0]
+    for n, part in enumerate(parts[1:-1], 1):
+        if part.startswith("python3") and parts[n - 1].lower() == "lib":
+            return os.path.splitext(parts[n + 1])[0]
+    return os.path.splitext(parts[-1])[0]
+
+
+_profiler: Optional[Profiler] = None
+
+
+# Profile every stage from now on, writing the files to output_dir
+def start(output_dir: str, sample_interval: float = SAMPLE_INTERVAL) -> Profiler:
+    global _profiler
+    _profiler = Profiler(output_dir, sample_interval)
+    return _profiler
+
+
+# Stop profiling, write the files and print the summary
+def finish(top: int = DEFAULT_TOP) -> None:
+    global _profiler
+    if _profiler is None:
+        return
+    profiler, _profiler = _profiler, None
+    profiler.stop()
+    paths = profiler.write()
+    print(profiler.summary(top))
+    print(f"Profiles written to {profiler.output_dir}: {', '.join(os.path.basename(path) for path in paths)}")
+
+
+# Profile the block as stage name, when profiling was started
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    if _profiler is None:
+        yield
+        return
+    with _profiler.stage(name):
+        yield
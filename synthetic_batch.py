@@ -0,0 +1,338 @@
+# \package syntheticBatch
+#
+#     \brief   Generates label batches of any size for load testing, with the answers alongside.
+#
+#     Labels are 4x6" scanned-style pages, one image per page like the carrier labels, with a "Trx Ref No.:" line
+#     inside the strip read_reference_number_ups or read_reference_number_usps reads (UPS_REF_COORDS and
+#     USPS_REF_COORDS, at their LABEL_DPI scale). Label SKUs are taken from the conversion table, whose labels
+#     carry the new SKU and whose pick list rows the old one, and from made-up SKUs that need no conversion.
+#     Swaps OCR is known to make (O/0, S/5, 1/I, the ones fuzzy_replacements undoes) are printed into a share of
+#     the references. The matching pick list is a ShipStation "Product Pick List" that read_pick_list reads
+#     natively or with tabula. ground_truth.json says, for every label page, the SKU printed on it and the pick
+#     list row it should be sorted to, so accuracy can be scored next to throughput.
+#
+#     python synthetic_batch.py -n 5000 -o batch_5k --noise 0.05
+#
+
+import argparse
+import json
+import os
+import random
+import zlib
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from PyPDF2 import PageObject
+from PyPDF2.generic import DictionaryObject, EncodedStreamObject, NameObject, NumberObject
+
+import pdf_output
+from delivery_08_29 import LABEL_DPI, UPS_REF_COORDS, USPS_REF_COORDS, DEFAULT_CONVERSION_FILE
+
+# 4x6" label and US letter pick list pages, in pdf points
+LABEL_SIZE = (288, 432)
+PICK_LIST_SIZE = (612, 792)
+# Resolution the label images are drawn at. They are stored 1 bit deep, like the carriers' own labels.
+DEFAULT_LABEL_DPI = 200
+CARRIERS = ("ups", "usps")
+# Character swaps OCR makes on reference numbers, both ways round
+OCR_SWAPS = {"O": "0", "0": "O", "S": "5", "5": "S", "1": "I", "I": "1"}
+# Share of the labels whose SKU is taken from the conversion table
+DEFAULT_CONVERTED_SHARE = 0.5
+DEFAULT_SKU_COUNT = 300
+
+# Pick list layout, measured on the ShipStation pick lists: x of each column, row pitch and font sizes
+PICK_LIST_COLUMNS = {"item": 45.6, "description": 180.0, "location": 360.0, "required": 502.2}
+PICK_LIST_TABLE_TOP = 96.0
+PICK_LIST_ROW_PITCH = 37.2
+PICK_LIST_BOTTOM = 740.0
+PICK_LIST_FONT_SIZE = 8
+DESCRIPTIONS = ["CASE COVER NO SIZE SILICONE", "WATCH BAND COMPATIBLE WITH", "BRACELET NO SIZE BEAD STRETCH",
+                "MISC ELECTRO NO SIZE", "PHONE STAND HELMET DESIGN"]
+
+FIRST_NAMES = ["JAMES", "MARY", "ROBERT", "PATRICIA", "JOHN", "JENNIFER", "MICHAEL", "LINDA", "DAVID", "ELIZABETH"]
+LAST_NAMES = ["SMITH", "JOHNSON", "WILLIAMS", "BROWN", "JONES", "GARCIA", "MILLER", "DAVIS", "WILSON", "MOORE"]
+STREETS = ["MAIN ST", "OAK AVE", "PINE RD", "MAPLE DR", "CEDAR LN", "ELM ST", "LAKE BLVD"]
+CITIES = [("SPRINGFIELD", "IL", "62701"), ("AUSTIN", "TX", "73301"), ("DENVER", "CO", "80201"),
+          ("PORTLAND", "OR", "97201"), ("COLUMBUS", "OH", "43004"), ("RALEIGH", "NC", "27601")]
+
+
+@dataclass
+class SyntheticLabel:
+    page: int
+    carrier: str
+    # SKU the label is for, and as printed after the order number of the reference line, OCR swaps included
+    sku: str
+    printed: str
+    # Pick list item the label should be sorted to, and that item's row in the pick list
+    pick_list_item: str
+    pick_list_rank: int = -1
+    # (position in the SKU, character it should be, character printed)
+    swaps: List[Tuple[int, str, str]] = field(default_factory=list)
+    # Name in the ship to block, the reference line starts with it
+    recipient: str = ""
+    # The whole reference line drawn on the label, see reference_line
+    reference: str = ""
+
+
+def read_conversion_pairs(conversion_file_path: str) -> List[Tuple[str, str]]:
+    import pandas as pd
+
+    conversions = pd.read_excel(conversion_file_path)
+    return [(str(old).upper().strip(), str(new).upper().strip()) for old, new in conversions.values[:, :2]]
+
+
+# (SKU printed on the label, pick list item) for sku_count products
+def make_products(rng: random.Random, sku_count: int, conversion_pairs: List[Tuple[str, str]],
+                  converted_share: float = DEFAULT_CONVERTED_SHARE) -> List[Tuple[str, str]]:
+    converted_count = min(len(conversion_pairs), round(sku_count * converted_share))
+    products = [(new, old) for old, new in rng.sample(conversion_pairs, converted_count)]
+    # Made-up SKUs are shaped like the bracelet SKUs on the pick lists, and are their own pick list item
+    made_up = rng.sample(range(100000), sku_count - converted_count)
+    products += [(f"BCY{chr(ord('A') + n % 26)}{n // 26:04d}", ) * 2 for n in made_up]
+    return products
+
+
+def add_ocr_noise(rng: random.Random, sku: str, noise: float) -> Tuple[str, List[Tuple[int, str, str]]]:
+    printed = list(sku)
+    swaps = []
+    for i, char in enumerate(sku):
+        if char in OCR_SWAPS and rng.random() < noise:
+            printed[i] = OCR_SWAPS[char]
+            swaps.append((i, char, printed[i]))
+    return "".join(printed), swaps
+
+
+# The reference line as it is printed on the labels, an order of one of the SKU: "KEITH FOX-1XCAB130742".
+# The labels print the SKU without its hyphens. This is the form delivery_08_29.clean_reference_text reads.
+def reference_line(recipient: str, printed_sku: str) -> str:
+    return f"{recipient}-1X{printed_sku.replace('-', '')}"
+
+
+def make_labels(rng: random.Random, count: int, products: List[Tuple[str, str]], noise: float,
+                carrier: str = "mixed") -> List[SyntheticLabel]:
+    labels = []
+    for page in range(count):
+        sku, pick_list_item = rng.choice(products)
+        printed, swaps = add_ocr_noise(rng, sku, noise)
+        label_carrier = rng.choice(CARRIERS) if carrier == "mixed" else carrier
+        recipient = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+        labels.append(SyntheticLabel(page, label_carrier, sku, printed, pick_list_item, swaps=swaps,
+                                     recipient=recipient, reference=reference_line(recipient, printed)))
+    return labels
+
+
+# Pick list rows (item, quantity) sorted by item like ShipStation's, and every label's row in it
+def make_pick_list(labels: List[SyntheticLabel]) -> List[Tuple[str, int]]:
+    quantities = Counter(label.pick_list_item for label in labels)
+    rows = sorted(quantities.items())
+    rank = {item: i for i, (item, _) in enumerate(rows)}
+    for label in labels:
+        label.pick_list_rank = rank[label.pick_list_item]
+    return rows
+
+
+def _font(size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.load_default(size=size)
+
+
+def _scaled(coords: Tuple[int, int, int, int], dpi: int) -> Tuple[int, ...]:
+    return tuple(round(c * dpi / LABEL_DPI) for c in coords)
+
+
+# The label page as an image at dpi, with the reference line in its carrier's strip and nothing in the other one
+def draw_label(rng: random.Random, label: SyntheticLabel, dpi: int = DEFAULT_LABEL_DPI,
+               speckle: float = 0.0) -> Image.Image:
+    width, height = (round(size * dpi / 72) for size in LABEL_SIZE)
+    image = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    unit = dpi / 100
+
+    ups_strip = _scaled(UPS_REF_COORDS, dpi)
+    usps_strip = _scaled(USPS_REF_COORDS, dpi)
+    strip = ups_strip if label.carrier == "ups" else usps_strip
+
+    # Carrier block above the UPS strip
+    draw.rectangle((int(4 * unit), int(4 * unit), width - int(4 * unit), ups_strip[1] - int(4 * unit)), width=2)
+    draw.text((int(12 * unit), int(12 * unit)), "UPS GROUND" if label.carrier == "ups" else "USPS GROUND ADVANTAGE",
+              font=_font(int(22 * unit)), fill=0)
+
+    # Ship to block and a barcode, between the strips
+    city, state, zip_code = rng.choice(CITIES)
+    address = [f"SHIP TO: {label.recipient}", f"{rng.randint(1, 9999)} {rng.choice(STREETS)}",
+               f"{city} {state} {zip_code}"]
+    top = ups_strip[3] + int(20 * unit)
+    for line in address:
+        draw.text((int(20 * unit), top), line, font=_font(int(14 * unit)), fill=0)
+        top += int(20 * unit)
+    x = int(20 * unit)
+    barcode_top, barcode_bottom = top + int(20 * unit), min(top + int(140 * unit), usps_strip[1] - int(20 * unit))
+    while x < width - int(20 * unit):
+        bar = rng.randint(1, 4) * max(1, int(unit))
+        draw.rectangle((x, barcode_top, x + bar - 1, barcode_bottom), fill=0)
+        x += bar + rng.randint(1, 4) * max(1, int(unit))
+
+    # The reference line, sized to the strip it has to be read from
+    left, strip_top, right, strip_bottom = strip
+    font = _font(max(8, int((strip_bottom - strip_top) * 0.7)))
+    draw.text((left + int(6 * unit), strip_top + (strip_bottom - strip_top) // 8), label.reference, font=font,
+              fill=0)
+
+    pixels = np.asarray(image) >= 128
+    if speckle > 0:
+        # Scanner dust: flip a share of the pixels
+        pixels = pixels ^ (np.random.default_rng(rng.getrandbits(32)).random(pixels.shape) < speckle)
+    return Image.fromarray(pixels)
+
+
+def _image_page(image: Image.Image, page_size: Tuple[int, int]) -> PageObject:
+    xobject = EncodedStreamObject()
+    xobject.update({
+        NameObject("/Type"): NameObject("/XObject"),
+        NameObject("/Subtype"): NameObject("/Image"),
+        NameObject("/Width"): NumberObject(image.width),
+        NameObject("/Height"): NumberObject(image.height),
+        NameObject("/ColorSpace"): NameObject("/DeviceGray"),
+        NameObject("/BitsPerComponent"): NumberObject(1),
+        NameObject("/Filter"): NameObject("/FlateDecode"),
+    })
+    xobject._data = zlib.compress(image.convert("1").tobytes())
+
+    page = PageObject.create_blank_page(None, *page_size)
+    page[NameObject("/Resources")] = DictionaryObject({
+        NameObject("/XObject"): DictionaryObject({NameObject("/Im0"): xobject}),
+    })
+    page[NameObject("/Contents")] = _content_stream(f"q {page_size[0]} 0 0 {page_size[1]} 0 0 cm /Im0 Do Q")
+    return page
+
+
+def _content_stream(content: str) -> EncodedStreamObject:
+    stream = EncodedStreamObject()
+    stream[NameObject("/Filter")] = NameObject("/FlateDecode")
+    stream._data = zlib.compress(content.encode("latin-1"))
+    return stream
+
+
+def write_labels(rng: random.Random, labels: Iterable[SyntheticLabel], output_path: str,
+                 dpi: int = DEFAULT_LABEL_DPI, speckle: float = 0.0) -> None:
+    with pdf_output.PageStreamWriter(output_path) as writer:
+        for label in labels:
+            writer.add_page(_image_page(draw_label(rng, label, dpi, speckle), LABEL_SIZE))
+
+
+def _pdf_string(text: str) -> str:
+    return "(" + text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+
+# Text drawn with its top at top (pdf points from the top of the page), like pdfplumber reports it
+def _text(font: str, size: float, x: float, top: float, text: str) -> str:
+    baseline = PICK_LIST_SIZE[1] - top - size * 0.8
+    return f"BT /{font} {size} Tf {x:.1f} {baseline:.1f} Td {_pdf_string(text)} Tj ET"
+
+
+def write_pick_list(rng: random.Random, rows: List[Tuple[str, int]], output_path: str) -> None:
+    fonts = DictionaryObject({
+        NameObject(f"/{name}"): DictionaryObject({
+            NameObject("/Type"): NameObject("/Font"),
+            NameObject("/Subtype"): NameObject("/Type1"),
+            NameObject("/BaseFont"): NameObject(f"/{base_font}"),
+            NameObject("/Encoding"): NameObject("/WinAnsiEncoding"),
+        })
+        for name, base_font in (("F1", "Helvetica"), ("F2", "Helvetica-Bold"))
+    })
+    rows_per_page = int((PICK_LIST_BOTTOM - PICK_LIST_TABLE_TOP) // PICK_LIST_ROW_PITCH)
+    columns = PICK_LIST_COLUMNS
+
+    with pdf_output.PageStreamWriter(output_path) as writer:
+        for start in range(0, max(1, len(rows)), rows_per_page):
+            content = []
+            if start == 0:
+                content.append(_text("F1", PICK_LIST_FONT_SIZE, 472.2, 21.6, "Generated synthetic batch"))
+                content.append(_text("F2", 16.5, 18.0, 27.1, "Product Pick List"))
+                for key, title in (("item", "Item #"), ("description", "Description"),
+                                   ("location", "Warehouse Location"), ("required", "# Required")):
+                    content.append(_text("F2", 9.5, columns[key] if key != "required" else 480.9, 65.7, title))
+            top = PICK_LIST_TABLE_TOP if start == 0 else PICK_LIST_TABLE_TOP - 60
+            for item, quantity in rows[start:start + rows_per_page]:
+                description = rng.choice(DESCRIPTIONS).split(" ")
+                content.append(_text("F2", PICK_LIST_FONT_SIZE, columns["item"], top, item))
+                content.append(_text("F1", PICK_LIST_FONT_SIZE, columns["description"], top,
+                                     " ".join(description[:4])))
+                content.append(_text("F1", PICK_LIST_FONT_SIZE, columns["description"], top + 9.6,
+                                     " ".join(description[4:]) or "-"))
+                content.append(_text("F1", PICK_LIST_FONT_SIZE, columns["location"], top, f"A-{rng.randint(1, 40)}"))
+                content.append(_text("F2", 12, columns["required"], top, str(quantity)))
+                top += PICK_LIST_ROW_PITCH
+
+            page = PageObject.create_blank_page(None, *PICK_LIST_SIZE)
+            page[NameObject("/Resources")] = DictionaryObject({NameObject("/Font"): fonts})
+            page[NameObject("/Contents")] = _content_stream("\n".join(content))
+            writer.add_page(page)
+
+
+# Write labels.pdf, pick_list.pdf and ground_truth.json for count labels to output_dir
+def generate_batch(output_dir: str, count: int, seed: int = 0, noise: float = 0.0, speckle: float = 0.0,
+                   carrier: str = "mixed", sku_count: int = DEFAULT_SKU_COUNT,
+                   conversion_file_path: str = DEFAULT_CONVERSION_FILE, dpi: int = DEFAULT_LABEL_DPI) -> Dict[str, str]:
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    conversion_pairs = read_conversion_pairs(conversion_file_path) if conversion_file_path else []
+    products = make_products(rng, sku_count, conversion_pairs)
+    labels = make_labels(rng, count, products, noise, carrier)
+    rows = make_pick_list(labels)
+
+    paths = {name: os.path.join(output_dir, file_name) for name, file_name in
+             (("labels", "labels.pdf"), ("pick_list", "pick_list.pdf"), ("ground_truth", "ground_truth.json"))}
+    write_labels(rng, labels, paths["labels"], dpi, speckle)
+    write_pick_list(rng, rows, paths["pick_list"])
+    with open(paths["ground_truth"], "w") as f:
+        json.dump({"seed": seed, "noise": noise, "speckle": speckle, "conversion_file": conversion_file_path,
+                   "pick_list": [item for item, _ in rows], "labels": [asdict(label) for label in labels]}, f)
+    return paths
+
+
+def load_ground_truth(ground_truth_path: str) -> List[SyntheticLabel]:
+    with open(ground_truth_path) as f:
+        ground_truth = json.load(f)
+    return [SyntheticLabel(**dict(label, swaps=[tuple(swap) for swap in label["swaps"]]))
+            for label in ground_truth["labels"]]
+
+
+# Share of the labels sorted to their pick list row. sorted_labels are sort_slips' ShippingLabels.
+def score_labels(sorted_labels, ground_truth: List[SyntheticLabel]) -> Optional[float]:
+    if not ground_truth:
+        return None
+    expected = {label.page: label.pick_list_rank for label in ground_truth}
+    correct = sum(1 for label in sorted_labels
+                  if label.pick_list_rank == expected.get(label.pdf_index))
+    return correct / len(ground_truth)
+
+
+def Main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic label pdf, its pick list and the answers, '
+                                                 'for load testing the label sorter.')
+    parser.add_argument('-n', type=int, required=True, dest='count', help='Number of labels')
+    parser.add_argument('-o', required=True, dest='outputDir', help='Folder to write the batch to')
+    parser.add_argument('--seed', type=int, default=0, help='Same seed, same batch')
+    parser.add_argument('--noise', type=float, default=0.0,
+                        help='Chance of every O, 0, S, 5, 1 and I of a reference being printed as its OCR confusion')
+    parser.add_argument('--speckle', type=float, default=0.0, help='Share of label pixels flipped, like scanner dust')
+    parser.add_argument('--carrier', default='mixed', choices=('mixed',) + CARRIERS,
+                        help='Carrier layout of the labels, mixed picks one per label')
+    parser.add_argument('--skus', type=int, default=DEFAULT_SKU_COUNT, dest='skuCount',
+                        help='Number of different products in the batch')
+    parser.add_argument('-c', default=DEFAULT_CONVERSION_FILE, dest='conversionFile',
+                        help='UPC conversion file the converted SKUs are taken from')
+    parser.add_argument('--dpi', type=int, default=DEFAULT_LABEL_DPI, help='Resolution the labels are drawn at')
+    args = parser.parse_args()
+
+    paths = generate_batch(args.outputDir, args.count, args.seed, args.noise, args.speckle, args.carrier,
+                           args.skuCount, args.conversionFile, args.dpi)
+    for name, path in paths.items():
+        print(f"{name}: {path}")
+
+
+if __name__ == "__main__":
+    Main()
@@ -0,0 +1,105 @@
+# \package tabulaSession
+#
+#     \brief   Reads several areas of every page of a pdf with one tabula call.
+#
+#     Each tabula.read_pdf call makes tabula-java load and parse the whole document again. A session sends
+#     all the areas that are read with the same options in a single call, so the document is parsed once,
+#     and splits the tables that come back into one list per area, the same lists separate calls return.
+#     The JVM itself is started by tabula-py on the first call and stays up for the rest of the process.
+#     The tables come back as tabula-java's json and are turned into DataFrames here, the way read_pdf does it.
+#
+
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import tabula
+
+import metrics
+
+Area = Tuple[float, float, float, float]  # (top, left, bottom, right) in pdf points, tabula's order
+
+
+class TabulaSession:
+    def __init__(self, pdf_path: str, pages="all"):
+        self.pdf_path = pdf_path
+        self.pages = pages
+
+    # One list of DataFrames per area, in the order given. Each list holds the tables of that area for every page,
+    # exactly what tabula.read_pdf(pdf_path, area=area, pages=pages, ...) returns for the area on its own.
+    def read_areas(self, areas: Sequence[Area], pandas_options: Optional[dict] = None,
+                   **options) -> List[List[pd.DataFrame]]:
+        return [data_frames(tables, pandas_options) for tables in self.read_raw_areas(areas, **options)]
+
+    # Like read_areas, but the tables are left as tabula's json
+    def read_raw_areas(self, areas: Sequence[Area], **options) -> List[List[dict]]:
+        areas = [tuple(area) for area in areas]
+        # tabula only treats area as several areas when it is a list of lists
+        with metrics.timer("tabula"):
+            raw_tables = tabula.read_pdf(self.pdf_path, pages=self.pages, area=[list(area) for area in areas],
+                                         output_format="json", **options)
+        per_area = [[] for _ in areas]
+        for table in raw_tables:
+            per_area[_table_area(table, areas)].append(table)
+        return per_area
+
+
+# The DataFrames tabula.read_pdf makes of tabula-java's json tables. Empty cells are NaN, the header row is taken
+# out of the table as read_csv would ("header" and "names" are read_csv's options, "columns" names them outright),
+# and columns that are all numbers are converted unless a dtype is given.
+def data_frames(tables: List[dict], pandas_options: Optional[dict] = None) -> List[pd.DataFrame]:
+    pandas_options = dict(pandas_options or {})
+    columns = pandas_options.pop("names", pandas_options.pop("columns", None))
+    header = pandas_options.pop("header", "infer")
+    pandas_options.pop("encoding", None)
+    if header == "infer":
+        header = None if columns else 0
+
+    frames = []
+    for table in tables:
+        if not table["data"]:
+            continue
+        rows = [[cell["text"] or np.nan for cell in row] for row in table["data"]]
+        table_columns = columns
+        if isinstance(header, int) and not columns:
+            table_columns = _unique_columns(rows.pop(header))
+
+        frame = pd.DataFrame(data=rows, columns=table_columns, **pandas_options)
+        if not pandas_options.get("dtype"):
+            for column in frame.columns:
+                try:
+                    frame[column] = pd.to_numeric(frame[column])
+                except (ValueError, TypeError):
+                    pass
+        frames.append(frame)
+    return frames
+
+
+# Header cells as read_csv names the columns: "Unnamed: n" for empty ones, ".n" added to repeated ones
+def _unique_columns(header_row: list) -> List[str]:
+    unnamed = iter(range(len(header_row)))
+    names = [f"Unnamed: {next(unnamed)}" if name is np.nan else name for name in header_row]
+    counts: Dict[str, int] = defaultdict(int)
+    for index, name in enumerate(names):
+        count = counts[name]
+        while count > 0:
+            counts[name] = count + 1
+            name = f"{name}.{count}"
+            count = counts[name]
+        names[index] = name
+        counts[name] = count + 1
+    return names
+
+
+# Index of the area a table came from. tabula crops the page to the area before looking for the table,
+# so the table is inside its area, and the area whose centre is closest is the one it was read from.
+def _table_area(table: dict, areas: Sequence[Area]) -> int:
+    centre_y = table["top"] + table["height"] / 2
+    centre_x = table["left"] + table["width"] / 2
+
+    def distance(area: Area) -> float:
+        top, left, bottom, right = area
+        return abs((top + bottom) / 2 - centre_y) + abs((left + right) / 2 - centre_x)
+
+    return min(range(len(areas)), key=lambda i: distance(areas[i]))
@@ -0,0 +1,71 @@
+import random
+
+import numpy as np
+
+import assignment
+import pdf_combo_new as combo
+
+FIRST_NAMES = ["JAMES", "MARY", "JOHN", "JENNIFER", "MICHAEL", "LINDA", "DAVID", "JESSICA", "JOSEPH", "SARAH",
+               "CHRISTINE", "KEITH", "KIMBERLY", "KATHERINE", "DENISE", "MARIA", "DANIEL", "DEBORAH", "PAUL", "LISA"]
+LAST_NAMES = ["SMITH", "JOHNSON", "WILLIAMS", "BROWN", "JONES", "GARCIA", "MILLER", "DAVIS", "RODRIGUEZ", "MARTINEZ",
+              "WILSON", "ANDERSON", "TAYLOR", "THOMAS", "MOORE", "JACKSON", "MARTIN", "LEE", "WHITE", "HARRIS"]
+
+
+# A batch shaped like a real one: a few hundred ZIP codes, common names, and a third of the labels whose
+# reference number was not read
+def _batch(rng, orders):
+    zips = [f"{rng.randint(10000, 99999)}" for _ in range(300)]
+    slips, labels = [], []
+    for order in range(orders):
+        name = f"{rng.choice(FIRST_NAMES)}{rng.choice(LAST_NAMES)}{order}"
+        addr = f"{rng.randint(1, 9999)} MAIN ST"
+        zip_code = rng.choice(zips)
+        reference = f"{rng.randint(10 ** 9, 10 ** 10 - 1)}"
+        slips.append(combo.PackingSlip(name, addr, f"SPRINGFIELD, IL {zip_code}", reference, page=order))
+        labels.append(combo.ShippingLabel(order, name, addr, f"SPRINGFIELD IL {zip_code}-1234", "", "",
+                                          reference if rng.random() > 0.3 else "N/A"))
+    order = list(range(orders))
+    rng.shuffle(order)
+    return slips, [labels[i] for i in order], order
+
+
+def test_big_batches_stay_in_small_blocks(monkeypatch):
+    sizes = []
+    blocks = assignment.blocks
+
+    def recorded_blocks(left_keys, right_keys):
+        found = blocks(left_keys, right_keys)
+        sizes.extend(len(left) + len(right) for left, right in found)
+        return found
+
+    monkeypatch.setattr(assignment, "blocks", recorded_blocks)
+    slips, labels, order = _batch(random.Random(5), 5000)
+    label_indices = combo.matchLabelsOptimally(slips, labels)
+
+    assert max(sizes) <= 40
+    # Every slip found its own label, wherever it was shuffled to
+    assert [order[index] for index in label_indices] == list(range(len(slips)))
+
+
+def test_blocks_past_the_limit_are_paired_greedily():
+    # Everything shares one key, so all of it is one block
+    left_keys = [["k", ("own", i)] for i in range(6)]
+    right_keys = [["k", ("own", j)] for j in range(6)]
+    score = np.array([[3.0 if i == j else 1.0 for j in range(6)] for i in range(6)])
+
+    def score_block(left, right):
+        return score[np.ix_(left, right)]
+
+    dense = assignment.assign(left_keys, right_keys, score_block)
+    greedy = assignment.assign(left_keys, right_keys, score_block, max_block_size=4)
+    assert dense == greedy == list(range(6))
+
+
+def test_only_pairs_sharing_a_key_are_made():
+    # 0 and 1 are linked through the right item 0, but left 1 shares no key with right 1
+    left_keys = [["a"], ["b"]]
+    right_keys = [["a", "b"], ["a"]]
+    pairing = assignment.assign(left_keys, right_keys, lambda left, right: np.ones((len(left), len(right))))
+    assert pairing[1] in (0, -1) and pairing[0] != pairing[1]
+    assert assignment.assign(left_keys, right_keys, lambda left, right: np.ones((len(left), len(right))),
+                             max_block_size=2)[1] in (0, -1)
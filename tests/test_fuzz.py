@@ -0,0 +1,68 @@
+import os
+import random
+import re
+
+import pandas as pd
+import pytest
+
+import delivery_08_29 as delivery
+
+CONVERSION_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), delivery.DEFAULT_CONVERSION_FILE)
+
+# The rules as fuzz applied them before it was compiled into a translation table, one re.sub per rule
+OLD_FUZZY_REPLACEMENTS = {
+    r'[OQ]': '0',
+    r'[S]': '5',
+    r'[-]': '',
+    r'[1|]': 'I',
+    r'[\s]': '',
+    r'B00': 'B0',
+}
+
+
+def old_fuzz(text):
+    for k, v in OLD_FUZZY_REPLACEMENTS.items():
+        text = re.sub(k, v, text)
+    text = re.sub(r'II+', 'I', text)
+    if text.endswith("I"):
+        text = text[:-1] + "L"
+    if text.endswith("Z2"):
+        text = text[:-2] + "20"
+    return text
+
+
+def _conversion_skus():
+    skus = []
+    for old, new in pd.read_excel(CONVERSION_FILE).values[:, :2]:
+        for sku in (str(old), str(new)):
+            # As written in the workbook, and the way compile_conversion hands it to fuzz
+            skus += [sku, sku.upper().strip()]
+    return skus
+
+
+def test_rules_are_unchanged():
+    assert delivery.fuzzy_replacements == OLD_FUZZY_REPLACEMENTS
+
+
+def test_agrees_on_every_conversion_file_sku():
+    skus = _conversion_skus()
+    assert len(skus) > 1000
+    mismatches = [(sku, old_fuzz(sku), delivery.fuzz(sku)) for sku in skus if old_fuzz(sku) != delivery.fuzz(sku)]
+    assert mismatches == []
+
+
+# Letters and digits OCR mixes up, the characters the rules touch, and whitespace of every kind \s matches
+CONFUSABLE = "O0QoSs5Il1|-BZ2 \t\n\r\f\v  　AX8"
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_agrees_on_random_ocr_confusable_strings(seed):
+    rng = random.Random(seed)
+    for _ in range(5000):
+        text = "".join(rng.choice(CONFUSABLE) for _ in range(rng.randint(0, 16)))
+        assert delivery.fuzz(text) == old_fuzz(text), repr(text)
+
+
+@pytest.mark.parametrize("text", ["", "I", "II", "1|1", "B000", "BB000", "B0-0", "Z2", "Z 2", "IZ2", "B00Z2", "S-1 I"])
+def test_agrees_on_edge_cases(text):
+    assert delivery.fuzz(text) == old_fuzz(text)
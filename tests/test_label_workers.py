@@ -0,0 +1,31 @@
+import multiprocessing
+
+import pytest
+
+import delivery_08_29 as delivery
+
+
+def test_labels_are_read_in_this_process_by_default():
+    assert delivery.LabelOptions().workers == 1
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != "fork", reason="the patched reader only reaches forked workers")
+def test_workers_get_the_vocabulary_once_when_they_start(monkeypatch):
+    def read_label_window(label_file_name, first_page, last_page, options, vocabulary=None):
+        return [f"{first_page}-{last_page}:{len(vocabulary)}"]
+
+    submitted = []
+    submit = delivery.ProcessPoolExecutor.submit
+
+    def record_submit(self, function, *args):
+        submitted.append(args)
+        return submit(self, function, *args)
+
+    monkeypatch.setattr(delivery, "read_label_window", read_label_window)
+    monkeypatch.setattr(delivery.ProcessPoolExecutor, "submit", record_submit)
+    windows = [(1, 2), (3, 4), (5, 5)]
+    results = list(delivery._read_label_windows("labels.pdf", windows, delivery.LabelOptions(workers=2),
+                                                {"BCYA0001", "BCYB0002"}))
+
+    assert results == [["1-2:2"], ["3-4:2"], ["5-5:2"]]
+    assert all(not isinstance(arg, set) for args in submitted for arg in args)
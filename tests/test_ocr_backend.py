@@ -0,0 +1,19 @@
+import os
+
+import pytest
+
+import ocr_backend
+
+
+@pytest.mark.parametrize("previous", [None, "4"])
+def test_single_threaded_puts_the_thread_limit_back(previous, monkeypatch):
+    if previous is None:
+        monkeypatch.delenv("OMP_THREAD_LIMIT", raising=False)
+    else:
+        monkeypatch.setenv("OMP_THREAD_LIMIT", previous)
+
+    with pytest.raises(RuntimeError):
+        with ocr_backend.single_threaded():
+            assert os.environ["OMP_THREAD_LIMIT"] == "1"
+            raise RuntimeError
+    assert os.environ.get("OMP_THREAD_LIMIT") == previous
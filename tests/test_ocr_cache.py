@@ -0,0 +1,50 @@
+import sqlite3
+
+import ocr_cache
+
+
+def _last_used(path, kind, key):
+    with sqlite3.connect(path) as db:
+        return db.execute(f"SELECT last_used FROM {kind} WHERE key = ?", (key,)).fetchone()[0]
+
+
+def test_hits_are_written_with_the_eviction_pass(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = ocr_cache.OcrCache(path)
+    cache.put("a", "C38-103-SW1")
+    stored = _last_used(path, ocr_cache.OCR, "a")
+
+    assert cache.get("a") == "C38-103-SW1"
+    assert _last_used(path, ocr_cache.OCR, "a") == stored
+    cache.evict()
+    assert _last_used(path, ocr_cache.OCR, "a") > stored
+
+    assert cache.get("a") == "C38-103-SW1"
+    cache.close()
+    assert _last_used(path, ocr_cache.OCR, "a") > stored
+
+
+def test_evicts_the_least_recently_read(tmp_path):
+    cache = ocr_cache.OcrCache(str(tmp_path / "cache.sqlite"), max_entries=2)
+    cache.put("old", "1")
+    cache.put("read", "2")
+    cache.get("old")
+    cache.put("new", "3")
+    cache.evict()
+    assert [cache.get(key) for key in ("old", "read", "new")] == ["1", None, "3"]
+    cache.close()
+
+
+def test_page_text_has_its_own_limit(tmp_path):
+    cache = ocr_cache.OcrCache(str(tmp_path / "cache.sqlite"), max_entries=2, max_page_entries=1)
+    cache.put("ref", "C-AB1-103-38")
+    for page in range(3):
+        cache.put(f"page {page}", "[]", ocr_cache.PAGE_TEXT)
+    cache.evict()
+
+    assert cache.get("ref") == "C-AB1-103-38"
+    assert cache.get("page 2", ocr_cache.PAGE_TEXT) == "[]"
+    assert cache.get("page 0", ocr_cache.PAGE_TEXT) is None
+    # The kinds do not answer for each other
+    assert cache.get("ref", ocr_cache.PAGE_TEXT) is None
+    cache.close()
@@ -0,0 +1,31 @@
+import json
+import os
+
+import pytest
+
+import delivery_08_29 as delivery
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+with open(os.path.join(ROOT, "tests", "fixtures", "pick_lists", "tabula.json")) as f:
+    TABULA = json.load(f)["pick_lists"]
+
+# tabula also returns the page title and the column header from the first page's item column. They are no SKU,
+# so they never match a label, and only shift every rank by the same amount.
+TABULA_HEADER_CELLS = ("Product Pick List", "Item #")
+
+
+@pytest.mark.parametrize("pick_list", ["1.pdf", "3.pdf", "5.pdf", "7.pdf", "10.pdf", "11.pdf", "13.pdf"])
+def test_native_reader_matches_recorded_tabula_output(pick_list):
+    entries = delivery.read_pick_list_native(os.path.join(ROOT, pick_list))
+    assert entries == [entry for entry in TABULA[pick_list] if entry not in TABULA_HEADER_CELLS]
+
+
+def test_unrecognized_layout_falls_back_to_tabula(monkeypatch):
+    path = os.path.join(ROOT, "2.pdf")
+    assert delivery.read_pick_list_native(path) is None
+
+    read = []
+    monkeypatch.setattr(delivery, "read_pick_list_tabula", lambda pick_list_path: read.append(pick_list_path)
+                        or TABULA["2.pdf"])
+    assert delivery.read_pick_list(path) == TABULA["2.pdf"]
+    assert read == [path]
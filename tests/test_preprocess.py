@@ -0,0 +1,49 @@
+import io
+import os
+
+import numpy as np
+import pytest
+from PIL import Image, ImageEnhance, ImageFilter
+from PyPDF2 import PdfReader
+
+from delivery_08_29 import preprocess_image, preprocess_pixels
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def pil_preprocess(image):
+    return np.asarray(ImageEnhance.Contrast(image).enhance(3).filter(ImageFilter.MedianFilter()))
+
+
+# The scanned label image of the first page of a label pdf, in grey
+def label_image(name):
+    image = PdfReader(os.path.join(ROOT, name)).pages[0].images[0]
+    return Image.open(io.BytesIO(image.data)).convert("L")
+
+
+@pytest.mark.parametrize("name", ["2.pdf", "12.pdf"])
+def test_label_pixels_match_pil(name):
+    image = label_image(name)
+    assert np.array_equal(preprocess_pixels(np.asarray(image)), pil_preprocess(image))
+
+    # The reference strip at the bottom of the label, and the top left corner, on their own
+    for box in [(0, 700, image.width, 760), (0, 0, 301, 97)]:
+        crop = image.crop(box)
+        assert np.array_equal(preprocess_pixels(np.asarray(crop)), pil_preprocess(crop))
+        assert np.array_equal(np.asarray(preprocess_image(crop)), pil_preprocess(crop))
+
+
+def test_stack_matches_pil_crop_by_crop():
+    image = label_image("2.pdf")
+    crops = [image.crop((0, top, 700, top + 40)) for top in (0, 380, 740)]
+    stacked = preprocess_pixels(np.stack([np.asarray(crop) for crop in crops]))
+    for pixels, crop in zip(stacked, crops):
+        assert np.array_equal(pixels, pil_preprocess(crop))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_noise_matches_pil(seed):
+    rng = np.random.default_rng(seed)
+    height, width = rng.integers(1, 40, size=2)
+    pixels = rng.integers(0, 256, size=(height, width), dtype=np.uint8)
+    assert np.array_equal(preprocess_pixels(pixels), pil_preprocess(Image.fromarray(pixels)))
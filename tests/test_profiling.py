@@ -0,0 +1,46 @@
+import threading
+import time
+
+import profiling
+
+
+def _busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+# The --pipeline combo run parses slips on the main thread while the labels stage runs on an executor thread
+def test_concurrent_stages_are_cprofiled_one_thread_at_a_time(tmp_path):
+    profiler = profiling.Profiler(str(tmp_path), sample_interval=0.001)
+    slips_entered = threading.Event()
+    labels_done = threading.Event()
+
+    def labels():
+        slips_entered.wait()
+        with profiler.stage("labels"):
+            _busy(0.05)
+        labels_done.set()
+
+    thread = threading.Thread(target=labels)
+    thread.start()
+    with profiler.stage("slips"):
+        slips_entered.set()
+        with profiler.stage("matching"):
+            _busy(0.02)
+        labels_done.wait()
+    thread.join()
+
+    # Once slips is left, the next thread to enter a stage gets cProfiled
+    with profiler.stage("labels"):
+        _busy(0.01)
+    profiler.stop()
+
+    stages = profiler.stages
+    assert stages["slips"].sampled_only_time == 0.0
+    assert stages["matching"].sampled_only_time == 0.0
+    assert 0.05 <= stages["labels"].sampled_only_time < stages["labels"].wall_time
+    assert profiler._profiled_thread is None
+    assert sum(stages["labels"].samples.values()) > 0
+    profiler.write()
+    assert "only in the samples" in profiler.summary()
@@ -0,0 +1,58 @@
+import re
+
+import pytest
+
+import delivery_08_29 as delivery
+
+
+# clean_reference_text before hyphenated SKUs were kept whole
+def old_clean_reference_text(text):
+    text = re.sub(r'[^A-Z0-9]+$', '', text)
+    text = re.split(r'-\s*\d*[^xXyY]*[xXI1]\s*', text)[-1]
+    text = re.sub(r'\s', '', text)
+    return delivery.fuzz(text.upper())
+
+
+# Reference lines of the bundled labels (6.pdf and 12.pdf), as printed on them, with the SKU they carry
+BUNDLED_LABEL_LINES = [
+    ("KEITH FOX-1XCAB130742", "CAB130742"),
+    ("GINA SCEARCE-1XCAB127738", "CAB127738"),
+    ("PENNY WANG-1XCAB217742", "CAB217742"),
+    ("ELAINE PEREZ-1XCLWB26", "CLWB26"),
+    ("DENISE WALSH-1XFSWB120", "FSWB120"),
+    ("LUZ RUIZ-1XNFLAP1OAK", "NFLAP1OAK"),
+    ("VANESSA W-1XNFLAP1NYG", "NFLAP1NYG"),
+    ("GREG WEBB-1XNFLABF1LV42", "NFLABF1LV42"),
+    ("GROOVY LAST-1XCAB130742", "CAB130742"),
+    ("MRS HECKEL-1XCAB211838", "CAB211838"),
+    ("KIM SMITH-1XCAB131738", "CAB131738"),
+    ("ENIDA WINEKOFF-1XHCYB50", "HCYB50"),
+    ("KRISTIE VU-1XCSWB10", "CSWB10"),
+]
+
+
+@pytest.mark.parametrize("line, sku", BUNDLED_LABEL_LINES)
+def test_bundled_label_lines_read_as_before(line, sku):
+    assert delivery.clean_reference_text(line) == old_clean_reference_text(line) == delivery.fuzz(sku)
+
+
+# The same lines with the SKU printed with its hyphens, new (C-AB1-307-38) and old (C38-135-SW1) style,
+# and with hyphenated recipients
+@pytest.mark.parametrize("line, sku", [
+    ("KEITH FOX-1XC-AB1-307-42", "C-AB1-307-42"),
+    ("JOHN HULTQUIST-1XC-116-APP1", "C-116-APP1"),
+    ("GREG WEBB-1XNFL-AB1-NYJ-38", "NFL-AB1-NYJ-38"),
+    ("KEITH FOX-1XC38-135-SW1", "C38-135-SW1"),
+    ("KIM SMITH-2XC42-107-SW1", "C42-107-SW1"),
+    ("ANNE-MARIE YOUNG-1XCAB130742", "CAB130742"),
+    ("ANNE-MARIE YOUNG-1XC38-135-SW1", "C38-135-SW1"),
+    ("Trx Ref No.: 1234567-1 x C-AB1-307-38", "C-AB1-307-38"),
+])
+def test_hyphenated_skus_are_kept_whole(line, sku):
+    assert delivery.clean_reference_text(line) == delivery.fuzz(sku)
+
+
+# OCR misreads of the separator still fall back to the old split
+@pytest.mark.parametrize("line", ["KEITH FOX-IXCAB130742", "KEITH FOX-1 K XCAB130742", "CAB130742", "KEITH FOX-1XCAB130742."])
+def test_garbled_separators_read_as_before(line):
+    assert delivery.clean_reference_text(line) == old_clean_reference_text(line)
@@ -0,0 +1,26 @@
+from collections import defaultdict
+
+import delivery_08_29 as delivery
+
+UPC_LOOKUP = {delivery.fuzz("C-AB1-103-38"): "C38-103-SW1"}
+SKUS = {delivery.fuzz("C-AB1-103-38"), delivery.fuzz("C38-103-SW1")}
+
+
+def _match(upc_ref, sku_matcher):
+    label = delivery.ShippingLabel(pdf_index=4, pick_list_rank=delivery.MAX_LABEL_NUMBER, upc_ref=upc_ref)
+    packing_order = defaultdict(lambda: delivery.MAX_LABEL_NUMBER, {delivery.fuzz("C38-103-SW1"): 0})
+    return delivery.match_label(label, UPC_LOOKUP, packing_order, sku_matcher)
+
+
+def test_misread_is_left_alone_by_default(capsys):
+    assert delivery.LabelOptions().max_distance == 0
+    label = _match("CAB1X0338", delivery.SkuMatcher(SKUS))
+    assert label.pick_list_rank == delivery.MAX_LABEL_NUMBER
+    assert capsys.readouterr().out == ""
+
+
+def test_approximate_match_is_printed(capsys):
+    sku_matcher = delivery.SkuMatcher(SKUS, max_distance=1)
+    label = _match("CAB1X0338", sku_matcher)
+    assert (label.upc_ref, label.pick_list_rank) == ("C38-103-SW1", 0)
+    assert capsys.readouterr().out == "Label 5 read as CAB1X0338, matched to the closest SKU CABI0338\n"
@@ -0,0 +1,184 @@
+import json
+import os
+
+import pytest
+import tabula
+import tabula.io
+
+import pdf_combo_new as combo
+from pdf_combo_new import PackingSlip
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "slips")
+
+
+# The per-store loops SLIP_LAYOUTS replaced, copied unchanged from before TabulaSession: one tabula.read_pdf per area
+
+
+def processBedBathPackingSlips(mode):
+    # collect shipping info: this is for BedBath
+    order_info_list = tabula.read_pdf(
+        mode.slips_path, area=mode.order_scan, pages='all', pandas_options={'header': None})
+    ship_to_list = tabula.read_pdf(mode.slips_path, area=mode.ship_scan,
+                                   stream=False, pages='all', pandas_options={'header': None})
+
+    result = []
+    for (i, (order, ship)) in enumerate(zip(order_info_list, ship_to_list)):
+        ship = ship[0]
+        # process recipient inf
+
+        name = ship[1]
+        addr = ""
+        city_state_zip = ""
+        # includes secondary address (lot or apartment)
+        if len(ship) == 5:
+            addr = ship[2] + " " + ship[3]
+            city_state_zip = ship[4]
+        else:
+            addr = ship[2]
+            city_state_zip = ship[3]
+
+        reference_num = order[1][0]
+
+        result.append(PackingSlip(name=name, addr=addr,
+                      city_state_zip=city_state_zip, reference_num=reference_num, page=i))
+    return result
+
+
+def processHsnPackingSlips(mode):
+    order_info_list = tabula.read_pdf(
+        mode.slips_path, area=mode.order_scan, pages='all', pandas_options={'header': None})
+    ship_to_list = tabula.read_pdf(mode.slips_path, area=mode.ship_scan, guess=False,
+                                   pages='all', pandas_options={'header': None}, multiple_tables=True)
+
+    slips = []
+    for (i, (order, ship)) in enumerate(zip(order_info_list, ship_to_list)):
+
+        # This will be in the form of "Package ID:<the number>"
+        reference_number = order[0][0]
+        # Getting a negative index of a list goes from the end. We want the last element
+        reference_number = reference_number.split(":")[-1]
+
+        ship = ship[0]
+
+        slips.append(PackingSlip(
+            name=ship[0], addr=ship[1], city_state_zip=ship[2], reference_num=reference_number, page=i))
+
+    return slips
+
+
+def processTargetPackingSlips(mode):
+
+    order_info_list = tabula.read_pdf(
+        mode.slips_path, area=mode.order_scan, pages='all', pandas_options={'header': None})
+    ship_to_list = tabula.read_pdf(
+        mode.slips_path, area=mode.ship_scan, pages='all', pandas_options={'header': None})
+
+    ret_list = []
+
+    for (i, (order, ship)) in enumerate(zip(order_info_list, ship_to_list)):
+        order = order[0]
+        ship = ship[1]
+
+        reference_num = str(order[0])
+        reference_num = reference_num[-6:]
+        name = ship[1]
+        address = ship[2]
+        city_state_zip = ship[4]
+
+        ret_list.append(PackingSlip(
+            name, address, city_state_zip, reference_num, page=i))
+
+    return ret_list
+
+
+def processBelkPackingSlips(mode):
+    order_info_list = tabula.read_pdf(
+        mode.slips_path, area=mode.order_scan, pages="all", pandas_options={"header": None})
+    ship_to_list = tabula.read_pdf(
+        mode.slips_path, area=mode.ship_scan, pages="all", pandas_options={"header": None})
+
+    ret_list = []
+
+    for (i, (order, ship)) in enumerate(zip(order_info_list, ship_to_list)):
+        ship = ship[0]
+
+        name = ship[1]
+        addr = ship[2]
+        city_state_zip = ship[3]
+
+        reference_num = order[1][0]
+
+        ret_list.append(PackingSlip(
+            name, addr, city_state_zip, reference_num, page=i))
+    return ret_list
+
+
+def processHibbettPackingSlips(mode):
+    order_info_list = tabula.read_pdf(
+        mode.slips_path, area=mode.order_scan, pages='all', pandas_options={'header': None})
+    ship_to_list = tabula.read_pdf(
+        mode.slips_path, area=mode.ship_scan, pages='all', pandas_options={'header': None})
+
+    ret_list = []
+
+    for (i, (order, ship)) in enumerate(zip(order_info_list, ship_to_list)):
+        reference_num = str(order[0][0])
+
+        name = ship[2][0]
+        addr = ship[2][1]
+        city_state_zip = ship[2][2]
+
+        ret_list.append(PackingSlip(name, addr, city_state_zip,
+                        reference_num[-4:], page=i))
+
+    return ret_list
+
+
+OLD_PROCESSORS = {
+    combo.Store.Target: processTargetPackingSlips,
+    combo.Store.Belk: processBelkPackingSlips,
+    combo.Store.Hibbett: processHibbettPackingSlips,
+    combo.Store.GSI: processHibbettPackingSlips,
+    combo.Store.HSN: processHsnPackingSlips,
+    combo.Store.BedBath: processBedBathPackingSlips,
+}
+
+
+# Stands in for tabula-java under tabula-py's own read_pdf: the json tabula-java prints for the asked-for areas,
+# page by page and area by area within a page, the way it walks the document
+def fake_tabula_java(by_area):
+    calls = []
+
+    def run(options, java_options=None, path=None, encoding="utf-8", force_subprocess=False):
+        areas = options.area
+        areas = [tuple(area) for area in areas] if isinstance(areas[0], (list, tuple)) else [tuple(areas)]
+        calls.append(areas)
+        pages = sorted({table["page_number"] for tables in by_area.values() for table in tables})
+        return json.dumps([table for page in pages for area in areas
+                           for table in by_area[area] if table["page_number"] == page])
+
+    return run, calls
+
+
+@pytest.mark.parametrize("store", list(OLD_PROCESSORS), ids=lambda store: store.value)
+def test_layouts_read_the_same_slips_as_the_store_loops(store, tmp_path, monkeypatch):
+    slips_path = tmp_path / "slips.pdf"
+    slips_path.write_bytes(b"%PDF-1.4\n")
+    mode = combo.get_mode(str(slips_path), "labels.pdf", store)
+    assert tuple(mode.order_scan) != tuple(mode.ship_scan)
+    # Synthetic, hand-written slips (see the "synthetic" note in each file), not recorded tabula output
+    with open(os.path.join(FIXTURES, f"{store.value}.json")) as f:
+        fixture = json.load(f)
+    run, calls = fake_tabula_java({tuple(mode.order_scan): fixture["order_scan"],
+                                   tuple(mode.ship_scan): fixture["ship_scan"]})
+    monkeypatch.setattr(tabula.io, "_run", run)
+
+    expected = OLD_PROCESSORS[store](mode)
+    assert len(calls) == 2
+    slips = combo.processPackingSlips(mode)
+    # both areas in one call
+    assert [sorted(areas) for areas in calls[2:]] == [sorted([tuple(mode.order_scan), tuple(mode.ship_scan)])]
+
+    assert len(expected) == len(fixture["ship_scan"])
+    assert [vars(slip) for slip in slips] == [vars(slip) for slip in expected]
+    assert [type(slip.reference_num) for slip in slips] == [type(slip.reference_num) for slip in expected]
@@ -0,0 +1,32 @@
+import os
+from collections import defaultdict
+
+import delivery_08_29 as delivery
+import synthetic_batch
+
+CONVERSION_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), delivery.DEFAULT_CONVERSION_FILE)
+
+
+# Without OCR noise, the reference line of every label has to come back out of the production reader as the SKU
+# on it, and match that label to its ground truth pick list row
+def test_noise_free_batch_reads_back_to_ground_truth(tmp_path):
+    paths = synthetic_batch.generate_batch(str(tmp_path), 400, seed=7, noise=0.0,
+                                           conversion_file_path=CONVERSION_FILE, dpi=50)
+    ground_truth = synthetic_batch.load_ground_truth(paths["ground_truth"])
+    assert any("-" in label.sku for label in ground_truth)
+
+    pick_list = delivery.read_pick_list(paths["pick_list"], workers=1)
+    upc_lookup = delivery.read_conversion(CONVERSION_FILE)
+    packing_order = defaultdict(lambda: delivery.MAX_LABEL_NUMBER)
+    for i, entry in enumerate(pick_list):
+        packing_order[delivery.fuzz(entry)] = i
+    # Exact matches only, so an approximate match can't cover up a misread
+    sku_matcher = delivery.SkuMatcher(set(upc_lookup) | set(packing_order), max_distance=0)
+
+    labels = []
+    for label in ground_truth:
+        ref_number = delivery.clean_reference_text(label.reference)
+        assert ref_number == delivery.fuzz(label.sku)
+        labels.append(delivery.match_label(delivery.ShippingLabel(label.page, delivery.MAX_LABEL_NUMBER, ref_number),
+                                           upc_lookup, packing_order, sku_matcher))
+    assert synthetic_batch.score_labels(labels, ground_truth) == 1.0
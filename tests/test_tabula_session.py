@@ -0,0 +1,82 @@
+import copy
+
+import pandas as pd
+import pytest
+
+import tabula_session
+
+
+def _table(rows, top=0.0, left=0.0):
+    return {"top": top, "left": left, "width": 100.0, "height": 20.0,
+            "data": [[{"text": text} for text in row] for row in rows]}
+
+
+TABLES = [
+    _table([["Order", "", "Qty", "Qty"], ["PO-1001", "", "2", "1"], ["PO-1002", "x", "", "3"]]),
+    _table([]),
+    _table([["", ""], ["Ship To:", "Jane Doe"], ["12 Main St", "Springfield, IL 62704"]]),
+    _table([["0012", "1.5"]]),
+]
+
+
+@pytest.mark.parametrize("pandas_options, tables", [
+    (None, TABLES), ({"header": None}, TABLES), ({"header": None, "dtype": str}, TABLES),
+    # Tables of at least two rows and four columns
+    ({"header": 1}, TABLES[:3]), ({"names": ["a", "b", "c", "d"]}, TABLES[:2]),
+])
+def test_data_frames_match_tabula_read_pdf(pandas_options, tables):
+    # The private helper read_pdf uses, where this tabula-py still has it
+    extract_from = getattr(pytest.importorskip("tabula.io"), "_extract_from", None)
+    if extract_from is None:
+        pytest.skip("tabula-py no longer has _extract_from to compare with")
+    expected = extract_from(copy.deepcopy(tables), dict(pandas_options or {}))
+    actual = tabula_session.data_frames(copy.deepcopy(tables), pandas_options)
+    assert len(actual) == len(expected)
+    for frame, expected_frame in zip(actual, expected):
+        pd.testing.assert_frame_equal(frame, expected_frame)
+
+
+def test_data_frames_leaves_options_alone():
+    pandas_options = {"header": None}
+    tabula_session.data_frames(TABLES, pandas_options)
+    assert pandas_options == {"header": None}
+
+
+# Target's scan areas, which overlap: the order number box is inside the top right of the ship to box
+ORDER_AREA = (93, 472, 107, 545)
+SHIP_AREA = (100, 250, 225, 575)
+
+
+def _placed(text, top, left, width, height, page):
+    return {"page_number": page, "top": top, "left": left, "width": width, "height": height,
+            "data": [[{"text": text}]]}
+
+
+def test_read_areas_splits_tables_between_overlapping_areas(monkeypatch):
+    raw_tables = [
+        # page 1: a table in the order box, and one in the left of the ship box
+        _placed("ORDER-1", 94.0, 473.0, 71.0, 12.0, page=1),
+        _placed("SHIP-1", 101.0, 251.0, 200.0, 60.0, page=1),
+        # page 2: the order number sits in the overlap, the ship table runs under the order box too
+        _placed("ORDER-2", 100.5, 480.0, 60.0, 6.0, page=2),
+        _placed("SHIP-2", 101.0, 260.0, 310.0, 120.0, page=2),
+    ]
+    calls = []
+
+    def read_pdf(pdf_path, pages=None, area=None, output_format=None, **options):
+        calls.append(area)
+        return copy.deepcopy(raw_tables)
+
+    monkeypatch.setattr(tabula_session.tabula, "read_pdf", read_pdf)
+    session = tabula_session.TabulaSession("slips.pdf")
+
+    order_frames, ship_frames = session.read_areas([ORDER_AREA, SHIP_AREA], pandas_options={"header": None})
+    assert calls == [[list(ORDER_AREA), list(SHIP_AREA)]]
+    assert [frame[0][0] for frame in order_frames] == ["ORDER-1", "ORDER-2"]
+    assert [frame[0][0] for frame in ship_frames] == ["SHIP-1", "SHIP-2"]
+
+    # The areas come back in the order they are asked for
+    ship_frames, order_frames = session.read_areas([SHIP_AREA, ORDER_AREA], pandas_options={"header": None})
+    assert len(calls) == 2
+    assert [frame[0][0] for frame in order_frames] == ["ORDER-1", "ORDER-2"]
+    assert [frame[0][0] for frame in ship_frames] == ["SHIP-1", "SHIP-2"]
@@ -0,0 +1,69 @@
+import builtins
+
+import pytest
+from PyPDF2 import PdfReader, PdfWriter
+
+import delivery_08_29 as delivery
+import pdf_output
+
+
+@pytest.fixture
+def labels_pdf(tmp_path):
+    writer = PdfWriter()
+    for width in (100, 200, 300):
+        writer.add_blank_page(width, 100)
+    path = tmp_path / "labels.pdf"
+    with open(path, "wb") as f:
+        writer.write(f)
+    return str(path)
+
+
+def _slips(*pages):
+    return [delivery.ShippingLabel(page, rank, "SKU") for rank, page in enumerate(pages)]
+
+
+def test_opening_the_output_is_retried(labels_pdf, tmp_path, monkeypatch):
+    open_writer = pdf_output.PageStreamWriter
+    attempts = []
+
+    def busy_then_free(output_path):
+        attempts.append(output_path)
+        if len(attempts) == 1:
+            raise PermissionError(13, "Permission denied", output_path)
+        return open_writer(output_path)
+
+    prompts = []
+    monkeypatch.setattr(pdf_output, "PageStreamWriter", busy_then_free)
+    monkeypatch.setattr(builtins, "input", lambda prompt: prompts.append(prompt) or "")
+    output_path = str(tmp_path / "sorted.pdf")
+    delivery.write_pdf(_slips(2, 0), labels_pdf, output_path)
+
+    assert len(attempts) == 2 and len(prompts) == 1
+    assert [page.mediabox.width for page in PdfReader(output_path).pages] == [300, 100]
+
+
+def test_page_copy_errors_are_raised(labels_pdf, tmp_path, monkeypatch):
+    def no_prompt(prompt):
+        raise AssertionError("only opening the output is retried")
+
+    monkeypatch.setattr(builtins, "input", no_prompt)
+    with pytest.raises(IndexError):
+        delivery.write_pdf(_slips(0, 7), labels_pdf, str(tmp_path / "sorted.pdf"))
+
+
+def test_failed_write_leaves_the_old_output(labels_pdf, tmp_path):
+    output_path = tmp_path / "sorted.pdf"
+    output_path.write_bytes(b"previous run")
+    with pytest.raises(IndexError):
+        delivery.write_pdf(_slips(0, 7), labels_pdf, str(output_path))
+    assert output_path.read_bytes() == b"previous run"
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["labels.pdf", "sorted.pdf"]
+
+
+def test_output_appears_only_when_complete(labels_pdf, tmp_path):
+    output_path = tmp_path / "sorted.pdf"
+    with pdf_output.PageStreamWriter(str(output_path)) as writer:
+        pdf_output.add_pages(writer, PdfReader(labels_pdf), [1])
+        assert not output_path.exists()
+    assert [page.mediabox.width for page in PdfReader(str(output_path)).pages] == [200]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["labels.pdf", "sorted.pdf"]